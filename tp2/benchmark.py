@@ -0,0 +1,434 @@
+import argparse
+import fnmatch
+import hashlib
+import json
+import math
+import multiprocessing
+import os
+import platform
+import queue
+import random
+import resource
+import time
+from array import array
+from statistics import mean
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from raytracer import CPUS, PIXEL_SIZE, SAMPLERS, TILE_SIZE, Framebuffer, Material, Mesh, MeshInstance, PointLight, \
+    RenderOptions, SharedScene, Sphere, SphereSet, Vec3, default_camera, denoise_framebuffer, load_scene, make_camera, \
+    random_scene, read_scene_file, render_tiles, stats_report, vec3_at, write_image
+
+BENCHMARK_SEED = 2019
+MESH_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'meshes')
+# meshes are scaled so their longest side has this lenght and centered here, over the ground sphere
+MESH_SIZE = 2.5
+MESH_CENTER = Vec3(0, 0.25, 6)
+# samples per pixel of the cases given with -scene
+SCENE_FILE_SAMPLES = 4
+
+# name, scene, width, height, samples per pixel, shadow rays per hit (None: one per light), side of the packets (0: none)
+CASES = [
+    ('spheres-160x120-4', 'spheres', 160, 120, 4, None, 0),
+    ('spheres-160x120-16', 'spheres', 160, 120, 16, None, 0),
+    ('spheres-320x240-4', 'spheres', 320, 240, 4, None, 0),
+    ('cube-160x120-4', 'cube', 160, 120, 4, None, 0),
+    ('teapot-160x120-4', 'teapot', 160, 120, 4, None, 0),
+    ('teapot-320x240-4', 'teapot', 320, 240, 4, None, 0),
+    ('ateneam-160x120-4', 'ateneam', 160, 120, 4, None, 0),
+    ('venusm-160x120-4', 'venusm', 160, 120, 4, None, 0),
+    ('teapots-160x120-4', 'teapots', 160, 120, 4, None, 0),
+    ('teapots-160x120-4-p4', 'teapots', 160, 120, 4, None, 4),
+    ('sphereset-1e5-160x120-4', 'sphereset-100000', 160, 120, 4, None, 0),
+    ('sphereset-1e6-160x120-4', 'sphereset-1000000', 160, 120, 4, None, 0),
+    ('spherelist-300-160x120-4', 'spherelist-300', 160, 120, 4, None, 0),
+    ('spherelist-300-160x120-4-p4', 'spherelist-300', 160, 120, 4, None, 4),
+    ('lights-256-160x120-4', 'lights-256', 160, 120, 4, None, 0),
+    ('lights-256-160x120-4-ls2', 'lights-256', 160, 120, 4, 2, 0),
+]
+# the teapots scene is a grid of INSTANCE_ROWS x INSTANCE_COLUMNS instances of teapot.obj
+INSTANCE_ROWS = 5
+INSTANCE_COLUMNS = 10
+# longest side of each instance
+INSTANCE_SIZE = 0.9
+# the sphereset-<count> and spherelist-<count> scenes scatter their spheres inside this box
+SPHERE_FIELD = (Vec3(-12, -0.5, 3), Vec3(12, 3, 40))
+# the lights-<count> scenes scatter their lights inside this box, above the spheres
+LIGHT_FIELD = (Vec3(-8, 3, 0), Vec3(8, 6, 16))
+# the noise comparison renders the scene of the spheres-160x120 cases with every sampler and number of samples
+# per pixel, against a reference with NOISE_REFERENCE_SAMPLES drawn from NOISE_REFERENCE_SAMPLER
+NOISE_WIDTH = 160
+NOISE_HEIGHT = 120
+NOISE_SAMPLES = [1, 2, 4, 8, 16, 32, 64]
+NOISE_REFERENCE_SAMPLES = 1024
+NOISE_REFERENCE_SAMPLER = 'sobol'
+
+#######################################
+### SCENES
+#######################################
+
+def obj_bounds(file_name):
+    # min and max corner of the vertices of an OBJ file
+    low = [math.inf] * 3
+    high = [-math.inf] * 3
+    with open(file_name) as f:
+        for line in f:
+            if line.startswith('v '):
+                for k, value in enumerate(line.split()[1:4]):
+                    low[k] = min(low[k], float(value))
+                    high[k] = max(high[k], float(value))
+    return Vec3(*low), Vec3(*high)
+
+def mesh_scene(name):
+    # the ground, the mesh in the middle and a metal and a glass sphere beside it
+    file_name = os.path.join(MESH_DIR, name + '.obj')
+    low, high = obj_bounds(file_name)
+    extent = high - low
+    scale = MESH_SIZE / max(extent.x, extent.y, extent.z)
+    # Mesh places a vertex v at (v + position) * scale
+    position = MESH_CENTER * (1 / scale) - (low + high) * 0.5
+    shapes = [
+        Sphere(Vec3(0, -100, 20), 100, Material(type='lambert', albedo=Vec3(80, 80, 30), k_diffuse=0.8)),
+        Mesh(file_name, position, scale, Material(type='lambert', albedo=Vec3(200, 200, 200), k_diffuse=0.8)),
+        Sphere(Vec3(-2.5, 0, 7), 0.8, Material(type='reflective', albedo=Vec3(200, 60, 60), k_reflectance=0.6, fuzz=0.1)),
+        Sphere(Vec3(2.5, 0, 7), 0.8, Material(type='dielectric', albedo=Vec3(60, 200, 60), k_refraction=1.5, k_attenuation=0.3)),
+    ]
+    point_lights = [PointLight(Vec3(3, 3, 3), Vec3(255, 255, 255)), PointLight(Vec3(-3, 3, 3), Vec3(255, 255, 255))]
+    return shapes, point_lights
+
+def instances_scene(name):
+    # a grid of instances of one mesh standing on the ground sphere, each with its own turn and material,
+    # seen from above so the rows behind are not hidden by the front ones
+    file_name = os.path.join(MESH_DIR, name + '.obj')
+    low, high = obj_bounds(file_name)
+    extent = high - low
+    scale = INSTANCE_SIZE / max(extent.x, extent.y, extent.z)
+    mesh = Mesh(file_name, Vec3(), 1, None)
+    ground = Sphere(Vec3(0, -100, 20), 100, Material(type='lambert', albedo=Vec3(80, 80, 30), k_diffuse=0.8))
+    shapes = [ground]
+    for row in range(INSTANCE_ROWS):
+        for column in range(INSTANCE_COLUMNS):
+            x, z = (column - (INSTANCE_COLUMNS - 1) / 2) * INSTANCE_SIZE * 1.3, 5 + row * INSTANCE_SIZE * 1.6
+            # height of the ground under (x, z), the instance is turned around y so its lowest point stays the same
+            y = ground.center.y + math.sqrt(ground.radius ** 2 - x * x - (z - ground.center.z) ** 2) + extent.y * scale / 2
+            material = Material(type='lambert', albedo=Vec3(40 + 40 * row, 200 - 15 * column, 120), k_diffuse=0.8)
+            shapes.append(MeshInstance(mesh, material, Vec3(x, y, z) - (low + high) * (0.5 * scale), scale, Vec3(0, 36 * column, 0)))
+    # the lights are ahead of the camera, since it looks down at the grid
+    point_lights = [PointLight(Vec3(4, 6, 14), Vec3(255, 255, 255)), PointLight(Vec3(-4, 6, 14), Vec3(255, 255, 255))]
+    camera = make_camera(Vec3(0, 2.5, 0), Vec3(0, 0, 8), Vec3(0, 1, 0), PIXEL_SIZE * 100, .5)
+    return camera, shapes, point_lights
+
+def sphere_field_scene(count, loose=False):
+    # count small spheres scattered over a slab above the ground, one SphereSet drawn from the global random.
+    # the radii shrink with the spacing, so the field looks about as dense for any count. loose makes the
+    # same spheres one Sphere object each
+    low, high = SPHERE_FIELD
+    spacing = ((high.x - low.x) * (high.y - low.y) * (high.z - low.z) / count) ** (1 / 3)
+    palette = [
+        Material(type='lambert', albedo=Vec3(200, 80, 60), k_diffuse=0.8),
+        Material(type='lambert', albedo=Vec3(60, 160, 200), k_diffuse=0.8),
+        Material(type='lambert', albedo=Vec3(220, 200, 80), k_diffuse=0.8),
+        Material(type='reflective', albedo=Vec3(200, 200, 200), k_reflectance=0.7, fuzz=0),
+        Material(type='reflective', albedo=Vec3(200, 120, 200), k_reflectance=0.5, fuzz=0.3),
+        Material(type='dielectric', albedo=Vec3(60, 200, 60), k_refraction=1.5, k_attenuation=0.3),
+    ]
+    uniform = random.uniform
+    centers = array('d')
+    speeds = array('d')
+    for k in range(count):
+        centers.extend((uniform(low.x, high.x), uniform(low.y, high.y), uniform(low.z, high.z)))
+        # a tenth of them moving
+        speeds.extend((uniform(0, spacing), 0, 0) if random.random() < 0.1 else (0, 0, 0))
+    radii = array('d', [spacing * uniform(0.15, 0.35) for k in range(count)])
+    material_ids = array('i', [random.randrange(len(palette)) for k in range(count)])
+    ground = Sphere(Vec3(0, -100, 20), 100, Material(type='lambert', albedo=Vec3(80, 80, 30), k_diffuse=0.8))
+    if loose:
+        shapes = [ground] + [Sphere(vec3_at(centers, k), radii[k], palette[material_ids[k]], vec3_at(speeds, k)) for k in range(count)]
+    else:
+        shapes = [ground, SphereSet(centers, radii, palette, material_ids, speeds)]
+    point_lights = [PointLight(Vec3(4, 6, 14), Vec3(255, 255, 255)), PointLight(Vec3(-4, 6, 14), Vec3(255, 255, 255))]
+    camera = make_camera(Vec3(0, 2.5, 0), Vec3(0, 0, 8), Vec3(0, 1, 0), PIXEL_SIZE * 100, .5)
+    return camera, shapes, point_lights
+
+def many_lights_scene(count, width, height):
+    # the spheres scene lit by count lights of random colors instead of its two white ones
+    shapes, point_lights = random_scene(width, height)
+    low, high = LIGHT_FIELD
+    uniform = random.uniform
+    point_lights = [PointLight(Vec3(uniform(low.x, high.x), uniform(low.y, high.y), uniform(low.z, high.z)),
+        Vec3(uniform(20, 255), uniform(20, 255), uniform(20, 255))) for k in range(count)]
+    return shapes, point_lights
+
+def build_scene(scene, width, height):
+    # returns (camera, shapes, point_lights). scene is a built in name or the path of a scene file
+    if scene.endswith(('.json', '.toml')):
+        return load_scene(scene)[:3]
+    if scene == 'spheres':
+        return (default_camera(),) + random_scene(width, height)
+    if scene == 'teapots':
+        return instances_scene('teapot')
+    if scene.startswith('sphereset-'):
+        return sphere_field_scene(int(scene[len('sphereset-'):]))
+    if scene.startswith('spherelist-'):
+        return sphere_field_scene(int(scene[len('spherelist-'):]), loose=True)
+    if scene.startswith('lights-'):
+        return (default_camera(),) + many_lights_scene(int(scene[len('lights-'):]), width, height)
+    return (default_camera(),) + mesh_scene(scene)
+
+def scene_file_case(file_name):
+    # named after the file and rendered at the size it asks for. the scene is only validated and loaded by run_case
+    image = read_scene_file(file_name).get('image', {})
+    width, height = image.get('width', 160), image.get('height', 120)
+    name = os.path.basename(file_name) + '-' + str(width) + 'x' + str(height) + '-' + str(SCENE_FILE_SAMPLES)
+    return (name, os.path.abspath(file_name), width, height, SCENE_FILE_SAMPLES, None, 0)
+
+#######################################
+### RUNNING
+#######################################
+
+def run_case(case, engine, workers, tile_size, image_dir, results):
+    # runs in its own process, so the peak memory of the case and of its workers is not mixed with other cases
+    name, scene, width, height, samples, light_samples, packet = case
+    random.seed(BENCHMARK_SEED)
+    load_start = time.time()
+    camera, shapes, point_lights = build_scene(scene, width, height)
+    load_time = time.time() - load_start
+
+    options = RenderOptions(min_samples=samples, max_samples=samples, stats=True, light_samples=light_samples, packet=packet)
+    framebuffer = Framebuffer(width, height)
+    shared_scene = SharedScene(shapes, point_lights)
+    start_time = time.time()
+    try:
+        reports = render_tiles(engine, shared_scene, camera, framebuffer, options, workers, tile_size,
+            seed=random.getrandbits(64), progress=False)
+    finally:
+        shared_scene.unlink()
+    wall_time = time.time() - start_time
+
+    report = stats_report(width, height, wall_time, reports)
+    counters = report['counters']
+    primary_rays = report['primary_rays']
+    image_hash = hashlib.sha1()
+    for i in range(height):
+        image_hash.update(framebuffer.row_bytes(i))
+    if image_dir:
+        write_image(os.path.join(image_dir, name + '.png'), framebuffer)
+
+    results.put({
+        'name': name,
+        'scene': scene,
+        'width': width,
+        'height': height,
+        'samples': samples,
+        'light_samples': light_samples,
+        'packet': packet,
+        'shapes': len(shapes),
+        'lights': len(point_lights),
+        'load_time': load_time,
+        'wall_time': wall_time,
+        'primary_rays': primary_rays,
+        'secondary_rays': counters['secondary_rays'],
+        'shadow_rays': counters['shadow_rays'],
+        'primary_rays_per_second': primary_rays / wall_time,
+        'secondary_rays_per_second': counters['secondary_rays'] / wall_time,
+        'shadow_rays_per_second': counters['shadow_rays'] / wall_time,
+        # ru_maxrss is in kilobytes on linux. the workers are children of this process, the largest one is reported
+        'peak_memory_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'peak_worker_memory_kb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+        'image_sha1': image_hash.hexdigest(),
+        'counters': counters,
+        'depth_histogram': report['depth_histogram'],
+        'worker_phases': report['worker_phases'],
+    })
+
+#######################################
+### NOISE
+#######################################
+
+def render_mean(shared_scene, camera, engine, workers, tile_size, samples, sampler, seed, denoise=False):
+    # mean color of every pixel as floats, clamped like the image would be, 3 per pixel in row-major order,
+    # and the same after the denoiser of the ray tracer (None without denoise)
+    options = RenderOptions(min_samples=samples, max_samples=samples, sampler=sampler, denoise=denoise)
+    framebuffer = Framebuffer(NOISE_WIDTH, NOISE_HEIGHT, accumulate=True, aux=denoise)
+    render_tiles(engine, shared_scene, camera, framebuffer, options, workers, tile_size, seed=seed, progress=False)
+    clamp = lambda pixels: [min(255.0, max(0.0, v)) for v in pixels]
+    return clamp(framebuffer.pixels), clamp(denoise_framebuffer(framebuffer).pixels) if denoise else None
+
+def noise_error(image, reference):
+    # root mean square error per channel, in 0-255 units, of the image and of the image blurred by a 3x3 box.
+    # the blurred error is the part the eye does not average out: blue noise moves its error away from it
+    width, height = NOISE_WIDTH, NOISE_HEIGHT
+    errors = [a - b for a, b in zip(image, reference)]
+    blurred = 0
+    for i in range(height):
+        for j in range(width):
+            for c in range(3):
+                window = [errors[(y * width + x) * 3 + c] for y in range(max(0, i - 1), min(height, i + 2))
+                    for x in range(max(0, j - 1), min(width, j + 2))]
+                blurred += (sum(window) / len(window)) ** 2
+    return math.sqrt(mean([e * e for e in errors])), math.sqrt(blurred / len(errors))
+
+def equivalent_samples(curve, error):
+    # samples per pixel at which the error of a curve [(samples, error)] falls to error, interpolated
+    # on the log-log plot (None if it never does)
+    for (n0, e0), (n1, e1) in zip(curve, curve[1:]):
+        if e1 <= error:
+            if e0 <= error or e0 == e1:
+                return n0 if e0 <= error else n1
+            return n0 * (n1 / n0) ** (math.log(e0 / error) / math.log(e0 / e1))
+    return curve[0][0] if curve and curve[0][1] <= error else None
+
+def noise_study(engine, workers, tile_size, image_dir, denoise=False):
+    # the same scene rendered with every sampler at NOISE_SAMPLES samples per pixel, and the error of each
+    # image (and of it denoised, with denoise) against a reference with many more samples
+    random.seed(BENCHMARK_SEED)
+    camera, shapes, point_lights = build_scene('spheres', NOISE_WIDTH, NOISE_HEIGHT)
+    seed = random.getrandbits(64)
+    shared_scene = SharedScene(shapes, point_lights)
+    try:
+        start_time = time.time()
+        # an independent seed, the sequence of the reference must not be the one it judges
+        reference = render_mean(shared_scene, camera, engine, workers, tile_size, NOISE_REFERENCE_SAMPLES,
+            NOISE_REFERENCE_SAMPLER, random.getrandbits(64))[0]
+        print('Referencia: ' + NOISE_REFERENCE_SAMPLER + ' com ' + str(NOISE_REFERENCE_SAMPLES) + ' amostras por pixel em '
+            + str(round(time.time() - start_time, 2)) + ' s')
+        column = 26 if denoise else 18
+        print('amostras'.ljust(9) + ''.join(sampler.rjust(column) for sampler in SAMPLERS))
+        curves = {sampler: [] for sampler in SAMPLERS}
+        for samples in NOISE_SAMPLES:
+            line = str(samples).ljust(9)
+            for sampler in SAMPLERS:
+                start_time = time.time()
+                image, denoised = render_mean(shared_scene, camera, engine, workers, tile_size, samples, sampler, seed, denoise)
+                rmse, blurred_rmse = noise_error(image, reference)
+                point = {'samples': samples, 'rmse': rmse, 'blurred_rmse': blurred_rmse, 'wall_time': time.time() - start_time}
+                text = str(round(rmse, 2)) + ' / ' + str(round(blurred_rmse, 2))
+                if denoise:
+                    point['denoised_rmse'] = noise_error(denoised, reference)[0]
+                    text += ' / ' + str(round(point['denoised_rmse'], 2))
+                curves[sampler].append(point)
+                line += text.rjust(column)
+                for suffix, pixels in (('', image), ('-denoised', denoised)):
+                    if image_dir and pixels:
+                        framebuffer = Framebuffer(NOISE_WIDTH, NOISE_HEIGHT, accumulate=True)
+                        framebuffer.pixels[:] = pixels
+                        write_image(os.path.join(image_dir, 'noise-' + sampler + '-' + str(samples) + suffix + '.png'), framebuffer)
+            print(line)
+    finally:
+        shared_scene.unlink()
+
+    # how many samples every sampler needs for the error of the random sampler at the most samples
+    target = curves['random'][-1]
+    keys = [('rmse', 'rmse'), ('blurred_rmse', 'blurred_rmse')] + ([('denoised_rmse', 'rmse')] if denoise else [])
+    print('Erro (RMSE / RMSE borrado' + (' / RMSE da imagem filtrada contra o RMSE' if denoise else '') + ') do random com '
+        + str(target['samples']) + ' amostras alcancado com:')
+    summary = {}
+    for sampler in SAMPLERS:
+        summary[sampler] = {}
+        line = '  ' + sampler.ljust(10)
+        for key, target_key in keys:
+            samples = equivalent_samples([(point['samples'], point[key]) for point in curves[sampler]], target[target_key])
+            summary[sampler][key] = samples
+            line += (str(round(samples, 1)) + ' amostras (' + str(round(target['samples'] / samples, 2)) + 'x menos raios)'
+                if samples else 'mais de ' + str(NOISE_SAMPLES[-1]) + ' amostras').rjust(34)
+        print(line)
+    return {
+        'scene': 'spheres',
+        'width': NOISE_WIDTH,
+        'height': NOISE_HEIGHT,
+        'reference_samples': NOISE_REFERENCE_SAMPLES,
+        'reference_sampler': NOISE_REFERENCE_SAMPLER,
+        'denoise': denoise,
+        'curves': curves,
+        'samples_for_random_error': summary,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark do ray tracer com cenas fixas e sementes fixas')
+    parser.add_argument('-output', type=str, default='benchmark.json', help='arquivo JSON com os resultados')
+    parser.add_argument('-engine', choices=['python', 'numpy'], default='python', help='motor de intersecao')
+    parser.add_argument('-workers', type=int, default=CPUS, help='numero de processos de renderizacao')
+    parser.add_argument('-tile', type=int, default=TILE_SIZE, help='lado dos tiles em pixels')
+    parser.add_argument('-scene', type=str, action='append', help='adiciona um caso com esse arquivo de cena .json ou .toml, pode repetir')
+    parser.add_argument('-case', type=str, action='append', help='roda so os casos com esse nome (aceita * e ?), pode repetir')
+    parser.add_argument('-images', type=str, help='pasta onde salvar as imagens de cada caso')
+    parser.add_argument('-compare', type=str, help='JSON de uma execucao anterior para comparar tempo e imagens')
+    parser.add_argument('-list', action='store_true', help='lista os casos e sai')
+    parser.add_argument('-noise', action='store_true', help='em vez dos casos, compara o erro de cada amostrador (-sampler do ray tracer) por numero de amostras')
+    parser.add_argument('-denoise', action='store_true', help='com -noise, mede tambem o erro das imagens filtradas (-denoise do ray tracer)')
+    args = parser.parse_args()
+    if args.engine == 'numpy' and np is None:
+        parser.error('o motor numpy precisa da biblioteca numpy instalada')
+    if args.denoise and (not args.noise or np is None):
+        parser.error('-denoise so vale com -noise e precisa da biblioteca numpy instalada')
+    if args.images:
+        os.makedirs(args.images, exist_ok=True)
+
+    if args.noise:
+        noise = noise_study(args.engine, args.workers, args.tile, args.images, args.denoise)
+        with open(args.output, 'w') as f:
+            json.dump({
+                'seed': BENCHMARK_SEED,
+                'engine': args.engine,
+                'workers': args.workers,
+                'python': platform.python_version(),
+                'numpy': np.__version__ if np is not None else None,
+                'noise': noise,
+            }, f, indent=2)
+        print('Resultados salvos em ' + args.output)
+        return 0
+
+    all_cases = CASES + [scene_file_case(file_name) for file_name in args.scene or []]
+    cases = [case for case in all_cases if not args.case or any(fnmatch.fnmatch(case[0], pattern) for pattern in args.case)]
+    if args.list or not cases:
+        for case in all_cases:
+            print(case[0])
+        return 0 if args.list else 1
+    previous = {}
+    if args.compare:
+        with open(args.compare) as f:
+            previous = {result['name']: result for result in json.load(f)['cases']}
+
+    results = []
+    result_queue = multiprocessing.Queue()
+    for case in cases:
+        process = multiprocessing.Process(target=run_case, args=(case, args.engine, args.workers, args.tile, args.images, result_queue))
+        process.start()
+        result = None
+        while result is None:
+            try:
+                result = result_queue.get(timeout=1)
+            except queue.Empty:
+                if process.exitcode:
+                    raise RuntimeError('o caso ' + case[0] + ' terminou com codigo ' + str(process.exitcode))
+        process.join()
+        results.append(result)
+
+        line = result['name'].ljust(20) + ' ' + str(round(result['wall_time'], 2)).rjust(8) + ' s ' \
+            + str(int(result['primary_rays_per_second'])).rjust(8) + ' raios primarios/s ' \
+            + str(result['peak_worker_memory_kb'] // 1024).rjust(5) + ' MB'
+        if result['name'] in previous:
+            old = previous[result['name']]
+            line += '  ' + str(round(old['wall_time'] / result['wall_time'], 2)) + 'x'
+            line += ', imagem igual' if old['image_sha1'] == result['image_sha1'] else ', IMAGEM DIFERENTE'
+        print(line)
+
+    with open(args.output, 'w') as f:
+        json.dump({
+            'seed': BENCHMARK_SEED,
+            'engine': args.engine,
+            'workers': args.workers,
+            'tile': args.tile,
+            'cpus': CPUS,
+            'python': platform.python_version(),
+            'numpy': np.__version__ if np is not None else None,
+            'cases': results,
+        }, f, indent=2)
+    print('Resultados salvos em ' + args.output)
+    return 0
+
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,60 @@
 import argparse
+import bisect
+import hashlib
+import json
 import math
+import mmap
+import os
+from array import array
 import time
+import zlib
 import multiprocessing
+from multiprocessing import shared_memory
+import queue
 import random
+import socket
+import struct
+import threading
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+try:
+    import tomllib
+except ImportError:
+    tomllib = None
 
 PIXEL_SIZE = 0.01
 DISTRIBUTED_RAYS = 4
 VISION_RANGE = 2 ** 63 - 1
-CPUS = multiprocessing.cpu_count() * 2
+CPUS = multiprocessing.cpu_count()
+TILE_SIZE = 16
 OBJ_NEAR = 0.0005
 MIN_OCCLUSION = 0.4
 OCCLUSION_JITTER = 0.5
+BVH_LEAF_SIZE = 4
+MAX_DEPTH = 8
+ROULETTE_DEPTH = 3
+VARIANCE_THRESHOLD = 4.0
+
+# per process counters, merged by the main process at the end of a render. they are only
+# updated when INSTRUMENTATION is on (-stats), so the hot paths pay a single global lookup otherwise
+INSTRUMENTATION = False
+COUNTERS = {'secondary_rays': 0, 'shadow_rays': 0, 'sphere_tests': 0, 'triangle_tests': 0, 'box_tests': 0,
+    'hits': 0, 'shadow_early_exits': 0, 'packets': 0, 'culled_shapes': 0}
+# depth -> rays traced at that depth, also only with INSTRUMENTATION
+DEPTH_HISTOGRAM = {}
+# samples taken by a pixel -> number of pixels, always kept
+SAMPLE_HISTOGRAM = {}
+# phase -> seconds spent in it by this process, always kept
+PHASES = {}
+# RayRecorder of the worker when the render keeps the records of an incremental render, None otherwise
+RECORDER = None
+# OcclusionCache shared by the workers when the render caches the occlusion of the lights, None otherwise
+OCCLUSION_CACHE = None
+# lookups, hits, inserts and evictions of the occlusion cache by this process, kept whenever there is one
+CACHE_STATS = {'lookups': 0, 'hits': 0, 'inserts': 0, 'evictions': 0}
 
 #######################################
 ### AUXILIARY
@@ -27,6 +71,35 @@ def mean(array):
         sum += item
     return sum / len(array)
 
+def set_instrumentation(enabled):
+    global INSTRUMENTATION
+    INSTRUMENTATION = enabled
+
+def set_recorder(recorder):
+    global RECORDER
+    RECORDER = recorder
+
+def set_occlusion_cache(cache):
+    global OCCLUSION_CACHE
+    OCCLUSION_CACHE = cache
+
+def reset_stats():
+    # a forked worker starts with the tables of its parent
+    for key in COUNTERS:
+        COUNTERS[key] = 0
+    for key in CACHE_STATS:
+        CACHE_STATS[key] = 0
+    DEPTH_HISTOGRAM.clear()
+    SAMPLE_HISTOGRAM.clear()
+    PHASES.clear()
+
+def add_phase(phase, seconds):
+    PHASES[phase] = PHASES.get(phase, 0) + seconds
+
+def vec3_at(values, index):
+    # reads the index-th vector of a flat x, y, z sequence
+    return Vec3(values[3 * index], values[3 * index + 1], values[3 * index + 2])
+
 #######################################
 ### MATH PRIMITIVES
 #######################################
@@ -162,6 +235,21 @@ class PointLight:
     def __str__(self):
         return 'Light position: ' + str(self.position) + ' Color: ' + str(self.color)
 
+class LightTable:
+    # picks a fixed number of lights per hit in constant time whatever the number of lights. the term of a
+    # light in the shading only depends on where it is (blockers and incidence), never on its color, so there
+    # is nothing to importance sample by: lights are picked uniformly, every term keeps the weight 1 and the
+    # mean over the picked lights is an unbiased estimate of the mean over all of them
+    def __init__(self, point_lights):
+        self.count = len(point_lights)
+
+    def pick(self, u):
+        # the light picked by the sample value u in [0, 1), and the weight of its term
+        return min(int(u * self.count), self.count - 1), 1.0
+
+    def np_pick(self, u):
+        return np.minimum((u * self.count).astype(int), self.count - 1), 1.0
+
 class Material:
     def __init__(self, emitting=False, **kwargs):
         self.type = kwargs.get('type')
@@ -185,6 +273,48 @@ class Material:
     def __str__(self):
         return 'Type: ' + self.type + ' Albedo: ' +  str(self.albedo)
 
+MATERIAL_TYPES = ['lambert', 'reflective', 'dielectric', 'phong']
+LAMBERT, REFLECTIVE, DIELECTRIC, PHONG = range(len(MATERIAL_TYPES))
+
+class Shader:
+    # a Material compiled for the shading loop: an integer kind instead of attribute probing, every
+    # parameter present, and the weights of the material's own color and of its secondary ray precomputed
+    __slots__ = ('kind', 'color', 'k_secondary', 'fuzz', 'k_refraction')
+
+    def __init__(self, material):
+        self.kind = MATERIAL_TYPES.index(material.type)
+        param = lambda name: getattr(material, name, None) or 0
+        self.fuzz = param('fuzz')
+        self.k_refraction = param('k_refraction')
+        if self.kind == LAMBERT:
+            self.color = material.albedo * param('k_diffuse')
+            self.k_secondary = 0
+        elif self.kind == REFLECTIVE:
+            self.color = material.albedo * (1 - param('k_reflectance'))
+            self.k_secondary = param('k_reflectance')
+        elif self.kind == DIELECTRIC:
+            self.color = material.albedo * param('k_attenuation')
+            self.k_secondary = 1 - param('k_attenuation')
+        else:
+            # phong is not shaded by this renderer, its hits stay black
+            self.color = Vec3()
+            self.k_secondary = 0
+
+def compile_materials(shapes):
+    # gives every shape the Shader of its material, shapes sharing a material share the Shader. a sphere
+    # set has no shader of its own but one per material in its palette, picked by the sphere that was hit
+    shaders = {}
+    def shader_of(material):
+        if id(material) not in shaders:
+            shaders[id(material)] = Shader(material)
+        return shaders[id(material)]
+    for shape in shapes:
+        if isinstance(shape, SphereSet):
+            shape.shader = None
+            shape.shaders = [shader_of(material) for material in shape.materials]
+        else:
+            shape.shader = shader_of(shape.material)
+
 #######################################
 ### SHAPE PRIMITIVES
 #######################################
@@ -199,328 +329,3316 @@ class Sphere:
     def __str__(self):
         return 'Type of shape: sphere. Center: ' + str(self.center) + ' Radius: ' + str(self.radius) + '\nMaterial:\n\t' + str(self.material)
     
-    def normal(self, point):
-        return (point - self.center).normalize()
+    def normal(self, point, time=0):
+        # the sphere moves with speed_vec, so the normal is taken from where it is at that time
+        return (point - (self.center + self.speed_vec * time)).normalize()
+
+    def swept_bounds(self):
+        r = self.radius
+        return swept_box([self.center.x - r, self.center.y - r, self.center.z - r,
+            self.center.x + r, self.center.y + r, self.center.z + r], self.speed_vec)
+
+def swept_box(box, speed_vec):
+    # shapes move linearly with speed_vec over the shutter interval (time in [0, 1)), so the box at
+    # time 0 and the box at time 1 bound every position in between
+    moved = [value + offset for value, offset in zip(box, speed_vec.array() * 2)]
+    return array('d', [min(a, b) for a, b in zip(box[:3], moved[:3])] + [max(a, b) for a, b in zip(box[3:], moved[3:])])
+
+class SphereSet:
+    # many spheres as one shape: centers, radii, speeds (3, 1 and 3 floats per sphere) and material ids
+    # (into the materials palette) in flat arrays instead of one Sphere object each, with a BVH over
+    # their swept boxes. a hit reports the index of the sphere in the set the way a mesh reports a triangle
+    def __init__(self, centers, radii, materials, material_ids, speeds=None):
+        self.centers = array('d', centers)
+        self.radii = array('d', radii)
+        self.speeds = array('d', speeds) if speeds is not None else array('d', [0.0]) * len(self.centers)
+        self.material_ids = array('i', material_ids)
+        self.materials = materials
+        if not self.radii:
+            raise ValueError('um SphereSet precisa de pelo menos uma esfera')
+        self.material = None
+        self.speed_vec = Vec3()
+        self.bvh = linear_bvh(self.sphere_bounds())
+        print('BVH de ' + str(len(self.radii)) + ' esferas: ' + str(self.bvh.node_count()) + ' nos (' + str(self.bvh.leaf_count) \
+            + ' folhas, profundidade ' + str(self.bvh.depth) + ') construida em ' + str(self.bvh.build_time) + ' segundos')
+
+    def sphere_bounds(self):
+        # swept box of every sphere, 6 floats each
+        bounds = array('d')
+        c = self.centers
+        v = self.speeds
+        for k, r in enumerate(self.radii):
+            i = 3 * k
+            x, y, z = c[i], c[i+1], c[i+2]
+            mx, my, mz = x + v[i], y + v[i+1], z + v[i+2]
+            bounds.extend((min(x, mx) - r, min(y, my) - r, min(z, mz) - r, max(x, mx) + r, max(y, my) + r, max(z, mz) + r))
+        return bounds
+
+    def swept_bounds(self):
+        return self.node_bounds(0)
+
+    def node_bounds(self, node):
+        # the boxes of the hierarchy are already swept and in world space
+        return self.bvh.bounds[6 * node:6 * node + 6]
+
+    def normal_at(self, k, point, time=0):
+        i = 3 * k
+        c = self.centers
+        v = self.speeds
+        return (point - Vec3(c[i] + v[i] * time, c[i+1] + v[i+1] * time, c[i+2] + v[i+2] * time)).normalize()
+
+MESH_CACHE_DIR = '.meshcache'
+MESH_CACHE_MAGIC = b'TP2MESH3'
+# every flat array a Mesh owns, then the ones of its BVH
+MESH_ARRAYS = [('vertices', 'd'), ('vertex_normals', 'd'), ('faces', 'i'), ('normal_indices', 'i'),
+    ('tri_p0', 'd'), ('tri_e1', 'd'), ('tri_e2', 'd'), ('tri_normal', 'd')]
+BVH_ARRAYS = [('bounds', 'd'), ('nodes', 'i'), ('primitives', 'i')]
+# the flat arrays of a SphereSet
+SPHERE_SET_ARRAYS = [('centers', 'd'), ('radii', 'd'), ('speeds', 'd'), ('material_ids', 'i')]
+MESH_CACHE_HEADER = '=' + 'q' * (len(MESH_ARRAYS) + len(BVH_ARRAYS) + 2)
 
 class Mesh:
-    def __init__(self, file_name, position, scale, material, speed_vec=Vec3()):
+    def __init__(self, file_name, position, scale, material, speed_vec=Vec3(), cache=True):
         self.material = material
         self.speed_vec = speed_vec
-        self.vertices = []
-        self.faces = []
-        self.vertex_normals = []
-        self.normal_indices = []
+        start_time = time.time()
 
-        # loading obj
+        cache_file = mesh_cache_file(file_name, position, scale) if cache else None
+        if cache_file and os.path.exists(cache_file):
+            self.load_cache(cache_file)
+            print('Mesh ' + file_name + ' carregada do cache ' + cache_file + ': ' + str(len(self.faces) // 3) + ' triangulos, ' \
+                + str(self.bvh.node_count()) + ' nos, ' + str(time.time() - start_time) + ' segundos')
+            return
+
+        self.load_obj(file_name, position, scale)
+        self.build_triangle_table()
+        self.bvh = BVH(self.triangle_bounds())
+        print('BVH de ' + file_name + ': ' + str(len(self.faces) // 3) + ' triangulos, ' + str(self.bvh.node_count()) + ' nos (' \
+            + str(self.bvh.leaf_count) + ' folhas, profundidade ' + str(self.bvh.depth) + ') construida em ' + str(self.bvh.build_time) + ' segundos')
+        if cache_file:
+            self.save_cache(cache_file)
+        print('Mesh ' + file_name + ' carregada em ' + str(time.time() - start_time) + ' segundos')
+
+    def load_obj(self, file_name, position, scale):
+        # flat typed arrays: 3 floats per vertex/normal and 3 indices per triangle.
+        # lines are split on any whitespace and each kind is converted in one go instead of line by line
         with open(file_name, 'r') as obj:
-            for line in obj.readlines():
-                in_line = line.split()
-                if len(in_line) and in_line[0] != '#':
-                    if in_line[0] == 'v':
-                        self.vertices.append(Vec3(float(in_line[1]) * scale, float(in_line[2]) * scale, float(in_line[3]) * scale) + position * scale)
-                    elif in_line[0] == 'vn':
-                        self.vertex_normals.append(Vec3(float(in_line[1]), float(in_line[2]), float(in_line[3])))
-                    elif in_line[0] == 'f':
-                        for i in range(1, len(in_line)):
-                            indices = in_line[i].split('/')
-                            self.faces.append(int(indices[0]) - 1)
-                            self.normal_indices.append(int(indices[2]) - 1)
+            rows = [line.split() for line in obj]
+        # only x y z: an optional w or vertex color after them is ignored
+        vertex_values = [value for fields in rows if fields and fields[0] == 'v' for value in fields[1:4]]
+        offset = (position.x * scale, position.y * scale, position.z * scale)
+        self.vertices = array('d', [float(value) * scale + offset[k % 3] for k, value in enumerate(vertex_values)])
+        self.vertex_normals = array('d', map(float, [value for fields in rows if fields and fields[0] == 'vn' for value in fields[1:4]]))
+        # polygons with more than 3 corners are split in a fan around the first one
+        corners = [corner.split('/') for fields in rows if fields and fields[0] == 'f'
+            for k in range(2, len(fields) - 1) for corner in (fields[1], fields[k], fields[k + 1])]
+        self.faces = array('i', [int(corner[0]) - 1 for corner in corners])
+        # -1 when the face has no normal, shading falls back to the plane normal
+        self.normal_indices = array('i', [int(corner[2]) - 1 if len(corner) > 2 and corner[2] else -1 for corner in corners])
+
+    def build_triangle_table(self):
+        # struct of arrays with what the intersection needs per triangle: first vertex, the two edges
+        # leaving it and the unit plane normal, 3 floats each
+        v = self.vertices
+        faces = self.faces
+        self.tri_p0 = array('d')
+        self.tri_e1 = array('d')
+        self.tri_e2 = array('d')
+        self.tri_normal = array('d')
+        for i in range(0, len(faces), 3):
+            a, b, c = 3 * faces[i], 3 * faces[i+1], 3 * faces[i+2]
+            e1x, e1y, e1z = v[b] - v[a], v[b+1] - v[a+1], v[b+2] - v[a+2]
+            e2x, e2y, e2z = v[c] - v[a], v[c+1] - v[a+1], v[c+2] - v[a+2]
+            nx, ny, nz = e1y * e2z - e1z * e2y, e1z * e2x - e1x * e2z, e1x * e2y - e1y * e2x
+            lenght = math.sqrt(nx * nx + ny * ny + nz * nz) or 1
+            self.tri_p0.extend((v[a], v[a+1], v[a+2]))
+            self.tri_e1.extend((e1x, e1y, e1z))
+            self.tri_e2.extend((e2x, e2y, e2z))
+            self.tri_normal.extend((nx / lenght, ny / lenght, nz / lenght))
+
+    def swept_bounds(self):
+        return self.node_bounds(0)
+
+    def node_bounds(self, node):
+        # world space box swept by a node of the hierarchy over the shutter interval
+        return swept_box(self.bvh.bounds[6 * node:6 * node + 6], self.speed_vec)
+
+    def object_ray(self, ray, time):
+        # origin and direction of the ray in the space of the triangles and the BVH, as plain floats
+        speed = self.speed_vec
+        return (ray.start.x - speed.x * time, ray.start.y - speed.y * time, ray.start.z - speed.z * time,
+            ray.direction.x, ray.direction.y, ray.direction.z)
+
+    def normal_at(self, triangle, point=None, time=0):
+        # point and time are only used by the shapes whose normal depends on where they were hit (sphere sets)
+        i = 3 * triangle
+        ni0, ni1, ni2 = self.normal_indices[i], self.normal_indices[i+1], self.normal_indices[i+2]
+        if min(ni0, ni1, ni2) < 0:
+            return vec3_at(self.tri_normal, triangle)
+        return vec3_at(self.vertex_normals, ni0).interpolate(vec3_at(self.vertex_normals, ni1), vec3_at(self.vertex_normals, ni2))
+
+    def triangle_bounds(self):
+        bounds = array('d')
+        v = self.vertices
+        faces = self.faces
+        for i in range(0, len(faces), 3):
+            a, b, c = 3 * faces[i], 3 * faces[i+1], 3 * faces[i+2]
+            bounds.extend((min(v[a], v[b], v[c]), min(v[a+1], v[b+1], v[c+1]), min(v[a+2], v[b+2], v[c+2]),
+                max(v[a], v[b], v[c]), max(v[a+1], v[b+1], v[c+1]), max(v[a+2], v[b+2], v[c+2])))
+        return bounds
+
+    def save_cache(self, cache_file):
+        # header with the lenght of every array and the BVH stats, then the arrays, 8 byte aligned, in native byte order
+        data = [getattr(self, key) for key, typecode in MESH_ARRAYS] + [getattr(self.bvh, key) for key, typecode in BVH_ARRAYS]
+        try:
+            os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+            temp_file = cache_file + '.' + str(os.getpid())
+            with open(temp_file, 'wb') as f:
+                f.write(MESH_CACHE_MAGIC + struct.pack(MESH_CACHE_HEADER, *([len(values) for values in data] + [self.bvh.leaf_count, self.bvh.depth])))
+                for values in data:
+                    raw = values.tobytes()
+                    f.write(raw + b'\x00' * (-len(raw) % 8))
+            os.replace(temp_file, cache_file)
+        except OSError as e:
+            print('Nao foi possivel salvar o cache da mesh: ' + str(e))
+
+    def load_cache(self, cache_file):
+        with open(cache_file, 'rb') as f:
+            self.cache_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        buffer = memoryview(self.cache_map)
+        offset = len(MESH_CACHE_MAGIC)
+        counts = struct.unpack(MESH_CACHE_HEADER, buffer[offset:offset + struct.calcsize(MESH_CACHE_HEADER)])
+        offset += struct.calcsize(MESH_CACHE_HEADER)
+        views = []
+        for (key, typecode), count in zip(MESH_ARRAYS + BVH_ARRAYS, counts):
+            size = count * array(typecode).itemsize
+            views.append(buffer[offset:offset + size].cast(typecode))
+            offset += size + (-size % 8)
+        for (key, typecode), view in zip(MESH_ARRAYS, views):
+            setattr(self, key, view)
+        self.bvh = bvh_from_arrays(*views[len(MESH_ARRAYS):], leaf_count=counts[-2], depth=counts[-1])
+
+class MeshInstance(Mesh):
+    # a placement of the geometry of another Mesh. the vertex, normal and triangle arrays and the BVH are
+    # the mesh's own objects, so any number of instances costs no more memory than one; only the transform,
+    # the material and the speed are per instance. a vertex v of the mesh is placed at
+    # rotation * (v * scale) + position, rotation being degrees around x, then y, then z. rays are taken to
+    # mesh space instead, with the distances along them unchanged, so the traversal and the triangle tests
+    # are the same as for a Mesh. the scale is uniform so the rotated mesh normals stay normals
+    def __init__(self, mesh, material, position=Vec3(), scale=1, rotation=Vec3(), speed_vec=Vec3()):
+        for key, typecode in MESH_ARRAYS:
+            setattr(self, key, getattr(mesh, key))
+        self.bvh = mesh.bvh
+        self.material = material
+        self.speed_vec = speed_vec
+        self.position = position
+        self.scale = scale
+        self.rotation = rotation
+        self.matrix = rotation_matrix(rotation)
+
+    def object_ray(self, ray, time):
+        # inverse transform: translate back, rotate by the transpose and divide by the scale
+        m = self.matrix
+        inverse_scale = 1 / self.scale
+        px = ray.start.x - self.position.x - self.speed_vec.x * time
+        py = ray.start.y - self.position.y - self.speed_vec.y * time
+        pz = ray.start.z - self.position.z - self.speed_vec.z * time
+        dx, dy, dz = ray.direction.x, ray.direction.y, ray.direction.z
+        return ((m[0] * px + m[3] * py + m[6] * pz) * inverse_scale, (m[1] * px + m[4] * py + m[7] * pz) * inverse_scale,
+            (m[2] * px + m[5] * py + m[8] * pz) * inverse_scale, (m[0] * dx + m[3] * dy + m[6] * dz) * inverse_scale,
+            (m[1] * dx + m[4] * dy + m[7] * dz) * inverse_scale, (m[2] * dx + m[5] * dy + m[8] * dz) * inverse_scale)
+
+    def normal_at(self, triangle, point=None, time=0):
+        n = Mesh.normal_at(self, triangle)
+        m = self.matrix
+        return Vec3(m[0] * n.x + m[1] * n.y + m[2] * n.z, m[3] * n.x + m[4] * n.y + m[5] * n.z, m[6] * n.x + m[7] * n.y + m[8] * n.z)
+
+    def node_bounds(self, node):
+        # the box around the 8 transformed corners of the node box
+        b = self.bvh.bounds[6 * node:6 * node + 6]
+        m = self.matrix
+        corners = []
+        for x in (b[0], b[3]):
+            for y in (b[1], b[4]):
+                for z in (b[2], b[5]):
+                    corners.append([(m[3*k] * x + m[3*k + 1] * y + m[3*k + 2] * z) * self.scale + offset
+                        for k, offset in enumerate(self.position.array())])
+        return swept_box([min(c[k] for c in corners) for k in range(3)] + [max(c[k] for c in corners) for k in range(3)], self.speed_vec)
+
+def rotation_matrix(angles):
+    # row major 3x3 rotation by angles.x degrees around x, then angles.y around y, then angles.z around z
+    cx, sx = math.cos(math.radians(angles.x)), math.sin(math.radians(angles.x))
+    cy, sy = math.cos(math.radians(angles.y)), math.sin(math.radians(angles.y))
+    cz, sz = math.cos(math.radians(angles.z)), math.sin(math.radians(angles.z))
+    return (cz * cy, cz * sy * sx - sz * cx, cz * sy * cx + sz * sx,
+        sz * cy, sz * sy * sx + cz * cx, sz * sy * cx - cz * sx,
+        -sy, cy * sx, cy * cx)
+
+def mesh_cache_file(file_name, position, scale):
+    # keyed by the obj contents and by everything baked into the vertices or the hierarchy
+    key = hashlib.sha1()
+    with open(file_name, 'rb') as obj:
+        key.update(obj.read())
+    key.update(repr((scale, position.array(), BVH_LEAF_SIZE, array('i').itemsize)).encode('ascii') + MESH_CACHE_MAGIC)
+    return os.path.join(os.path.dirname(os.path.abspath(file_name)), MESH_CACHE_DIR, key.hexdigest() + '.mesh')
+
+#######################################
+### ACCELERATION STRUCTURES
+#######################################
+
+class BVH:
+    # flat bounding volume hierarchy: node n has its box in bounds[6n:6n+6] and (first, count) in nodes[2n:2n+2].
+    # leaves have count > 0 and own primitives[first:first+count], inner nodes have count == 0 and
+    # their children at first and first + 1
+    def __init__(self, primitive_bounds):
+        start_time = time.time()
+        count = len(primitive_bounds) // 6
+        self.bounds = array('d')
+        self.nodes = array('i')
+        self.primitives = array('i', range(count))
+        self.leaf_count = 0
+        self.depth = 0
+
+        centroids = [[(primitive_bounds[6*k + axis] + primitive_bounds[6*k + axis + 3]) / 2 for k in range(count)] for axis in range(3)]
+        self.bounds.extend([0.0] * 6)
+        self.nodes.extend((0, 0))
+        stack = [(0, 0, count, 1)]
+        while stack:
+            node, first, count, depth = stack.pop()
+            self.depth = max(self.depth, depth)
+            box = [math.inf] * 3 + [-math.inf] * 3
+            centroid_box = [math.inf] * 3 + [-math.inf] * 3
+            for k in self.primitives[first:first + count]:
+                for axis in range(3):
+                    box[axis] = min(box[axis], primitive_bounds[6*k + axis])
+                    box[axis + 3] = max(box[axis + 3], primitive_bounds[6*k + axis + 3])
+                    centroid_box[axis] = min(centroid_box[axis], centroids[axis][k])
+                    centroid_box[axis + 3] = max(centroid_box[axis + 3], centroids[axis][k])
+            self.bounds[6*node:6*node + 6] = array('d', box)
+
+            extents = [centroid_box[axis + 3] - centroid_box[axis] for axis in range(3)]
+            axis = extents.index(max(extents))
+            if count <= BVH_LEAF_SIZE or extents[axis] <= 0:
+                self.nodes[2*node] = first
+                self.nodes[2*node + 1] = count
+                self.leaf_count += 1
+                continue
+
+            # median split along the longest axis of the centroids
+            axis_centroids = centroids[axis]
+            self.primitives[first:first + count] = array('i', sorted(self.primitives[first:first + count], key=lambda k: axis_centroids[k]))
+            left = self.node_count()
+            self.bounds.extend([0.0] * 12)
+            self.nodes.extend((0, 0, 0, 0))
+            self.nodes[2*node] = left
+            self.nodes[2*node + 1] = 0
+            half = count // 2
+            stack.append((left, first, half, depth + 1))
+            stack.append((left + 1, first + half, count - half, depth + 1))
+
+        self.build_time = time.time() - start_time
+
+    def node_count(self):
+        return len(self.nodes) // 2
+
+def linear_bvh(primitive_bounds):
+    # the same flat hierarchy as BVH, built for very many primitives: the centroids are sorted once by
+    # their morton code (the bits of the quantized x, y and z interleaved, so the order follows a
+    # space filling curve), every node splits its range along the curve and the boxes are filled from
+    # the leaves up. there is no sort per node, so a million primitives take seconds instead of minutes
+    start_time = time.time()
+    count = len(primitive_bounds) // 6
+    low = [min(primitive_bounds[axis::6]) for axis in range(3)] if count else [0.0] * 3
+    high = [max(primitive_bounds[axis + 3::6]) for axis in range(3)] if count else [0.0] * 3
+    # centroids quantized to 10 bits per axis
+    quantize = [1023 / (2 * (high[axis] - low[axis])) if high[axis] > low[axis] else 0 for axis in range(3)]
+    spread = [morton_spread(k) for k in range(1024)]
+    codes = [spread[int((primitive_bounds[6*k] + primitive_bounds[6*k + 3] - 2 * low[0]) * quantize[0])] \
+        | spread[int((primitive_bounds[6*k + 1] + primitive_bounds[6*k + 4] - 2 * low[1]) * quantize[1])] << 1 \
+        | spread[int((primitive_bounds[6*k + 2] + primitive_bounds[6*k + 5] - 2 * low[2]) * quantize[2])] << 2 for k in range(count)]
+
+    bvh = BVH.__new__(BVH)
+    bvh.primitives = array('i', sorted(range(count), key=codes.__getitem__))
+    codes = [codes[k] for k in bvh.primitives]
+    bvh.nodes = array('i', (0, 0))
+    bvh.leaf_count = 0
+    bvh.depth = 0
+    # children always come after their parent, so the boxes can be filled in reverse node order
+    stack = [(0, 0, count, 1)]
+    while stack:
+        node, first, count, depth = stack.pop()
+        bvh.depth = max(bvh.depth, depth)
+        if count <= BVH_LEAF_SIZE:
+            bvh.nodes[2*node] = first
+            bvh.nodes[2*node + 1] = count
+            bvh.leaf_count += 1
+            continue
+        left = len(bvh.nodes) // 2
+        bvh.nodes.extend((0, 0, 0, 0))
+        bvh.nodes[2*node] = left
+        # split where the highest bit that differs in the range turns on, so the two halves are the two
+        # halves of a cell of the curve. a range of equal codes is split in the middle
+        lowest, highest = codes[first], codes[first + count - 1]
+        if lowest == highest:
+            half = count // 2
+        else:
+            bit = (lowest ^ highest).bit_length() - 1
+            half = bisect.bisect_left(codes, highest >> bit << bit, first, first + count) - first
+        stack.append((left, first, half, depth + 1))
+        stack.append((left + 1, first + half, count - half, depth + 1))
+
+    bounds = [0.0] * (3 * len(bvh.nodes))
+    nodes = bvh.nodes
+    primitives = bvh.primitives
+    for node in range(len(nodes) // 2 - 1, -1, -1):
+        first, count = nodes[2*node], nodes[2*node + 1]
+        b = 6 * node
+        if count:
+            ks = [6 * k for k in primitives[first:first + count]]
+            for axis in range(3):
+                bounds[b + axis] = min([primitive_bounds[k + axis] for k in ks])
+                bounds[b + axis + 3] = max([primitive_bounds[k + axis + 3] for k in ks])
+        else:
+            l, r = 6 * first, 6 * first + 6
+            for axis in range(3):
+                bounds[b + axis] = min(bounds[l + axis], bounds[r + axis])
+                bounds[b + axis + 3] = max(bounds[l + axis + 3], bounds[r + axis + 3])
+    bvh.bounds = array('d', bounds)
+    bvh.build_time = time.time() - start_time
+    return bvh
+
+def morton_spread(value):
+    # the 10 bits of value moved to every third bit
+    code = 0
+    for bit in range(10):
+        code |= (value >> bit & 1) << (3 * bit)
+    return code
+
+def bvh_from_arrays(bounds, nodes, primitives, leaf_count=0, depth=0):
+    # wraps an already built hierarchy (from the mesh cache or the shared scene)
+    bvh = BVH.__new__(BVH)
+    bvh.bounds = bounds
+    bvh.nodes = nodes
+    bvh.primitives = primitives
+    bvh.leaf_count = leaf_count
+    bvh.depth = depth
+    bvh.build_time = 0
+    return bvh
+
+def inverse_direction(dx, dy, dz):
+    return [1 / d if d != 0 else 1e30 for d in (dx, dy, dz)]
+
+def ray_box_entry(bounds, node, ox, oy, oz, ix, iy, iz, max_t):
+    # slab test, returns the entry distance or -1 if the box is missed or farther than max_t
+    b = 6 * node
+    t1 = (bounds[b] - ox) * ix
+    t2 = (bounds[b + 3] - ox) * ix
+    t_near, t_far = min(t1, t2), max(t1, t2)
+    t1 = (bounds[b + 1] - oy) * iy
+    t2 = (bounds[b + 4] - oy) * iy
+    t_near, t_far = max(t_near, min(t1, t2)), min(t_far, max(t1, t2))
+    t1 = (bounds[b + 2] - oz) * iz
+    t2 = (bounds[b + 5] - oz) * iz
+    t_near, t_far = max(t_near, min(t1, t2)), min(t_far, max(t1, t2))
+    if t_far < max(t_near, 0) or t_near > max_t:
+        return -1
+    return max(t_near, 0)
+
+def root_stack(bounds, roots, ox, oy, oz, ix, iy, iz, max_t):
+    # traversal stack that starts from the given subtrees instead of the root, the farther first so the
+    # nearer ones are visited first
+    stack = []
+    for node in roots:
+        t_entry = ray_box_entry(bounds, node, ox, oy, oz, ix, iy, iz, max_t)
+        if t_entry >= 0:
+            stack.append((node, t_entry))
+    stack.sort(key=lambda entry: entry[1], reverse=True)
+    return stack
+
+def mesh_closest_hit(ray, shape, time, roots=None):
+    # returns (t, triangle index) of the closest hit, or (-1, -1). roots, when given, are the only subtrees
+    # of the hierarchy the ray can reach (see PacketFrustum)
+    bvh = shape.bvh
+    bounds = bvh.bounds
+    nodes = bvh.nodes
+    p0 = shape.tri_p0
+    e1 = shape.tri_e1
+    e2 = shape.tri_e2
+    # the hierarchy is built over the mesh at rest, so boxes are tested against the ray in object space
+    ox, oy, oz, dx, dy, dz = shape.object_ray(ray, time)
+    ix, iy, iz = inverse_direction(dx, dy, dz)
+
+    closest_t = VISION_RANGE
+    closest = -1
+    if roots is None:
+        t_root = ray_box_entry(bounds, 0, ox, oy, oz, ix, iy, iz, closest_t)
+        stack = [(0, t_root)] if t_root >= 0 else []
+        boxes = 1
+    else:
+        stack = root_stack(bounds, roots, ox, oy, oz, ix, iy, iz, closest_t)
+        boxes = len(roots)
+    triangles = 0
+    while stack:
+        node, t_entry = stack.pop()
+        if t_entry >= closest_t:
+            continue
+        first, count = nodes[2*node], nodes[2*node + 1]
+        if count:
+            triangles += count
+            for k in bvh.primitives[first:first + count]:
+                # Möller–Trumbore over the precomputed records, with plain floats only
+                i = 3 * k
+                e1x, e1y, e1z = e1[i], e1[i+1], e1[i+2]
+                e2x, e2y, e2z = e2[i], e2[i+1], e2[i+2]
+                px, py, pz = dy * e2z - dz * e2y, dz * e2x - dx * e2z, dx * e2y - dy * e2x
+                det = e1x * px + e1y * py + e1z * pz
+                if -1e-12 < det < 1e-12:
+                    # parallel (or almost)
+                    continue
+                inv_det = 1 / det
+                tx, ty, tz = ox - p0[i], oy - p0[i+1], oz - p0[i+2]
+                u = (tx * px + ty * py + tz * pz) * inv_det
+                if u < 0 or u > 1:
+                    continue
+                qx, qy, qz = ty * e1z - tz * e1y, tz * e1x - tx * e1z, tx * e1y - ty * e1x
+                v = (dx * qx + dy * qy + dz * qz) * inv_det
+                if v < 0 or u + v > 1:
+                    continue
+                t = (e2x * qx + e2y * qy + e2z * qz) * inv_det
+                if t > OBJ_NEAR and t < closest_t:
+                    closest_t = t
+                    closest = k
+        else:
+            boxes += 2
+            t_left = ray_box_entry(bounds, first, ox, oy, oz, ix, iy, iz, closest_t)
+            t_right = ray_box_entry(bounds, first + 1, ox, oy, oz, ix, iy, iz, closest_t)
+            # push the farther child first so the nearer one is visited first
+            if t_left > t_right:
+                if t_left >= 0:
+                    stack.append((first, t_left))
+                if t_right >= 0:
+                    stack.append((first + 1, t_right))
+            else:
+                if t_right >= 0:
+                    stack.append((first + 1, t_right))
+                if t_left >= 0:
+                    stack.append((first, t_left))
+
+    if INSTRUMENTATION:
+        COUNTERS['box_tests'] += boxes
+        COUNTERS['triangle_tests'] += triangles
+    if closest < 0:
+        return -1, -1
+    return closest_t, closest
+
+def mesh_any_hit(ray, shape, time, max_t):
+    # like mesh_closest_hit, but returns True at the first triangle hit before max_t, in any order
+    bvh = shape.bvh
+    bounds = bvh.bounds
+    nodes = bvh.nodes
+    p0 = shape.tri_p0
+    e1 = shape.tri_e1
+    e2 = shape.tri_e2
+    ox, oy, oz, dx, dy, dz = shape.object_ray(ray, time)
+    ix, iy, iz = inverse_direction(dx, dy, dz)
+
+    stack = [0]
+    boxes = 0
+    triangles = 0
+    while stack:
+        node = stack.pop()
+        boxes += 1
+        if ray_box_entry(bounds, node, ox, oy, oz, ix, iy, iz, max_t) < 0:
+            continue
+        first, count = nodes[2*node], nodes[2*node + 1]
+        if not count:
+            stack.append(first + 1)
+            stack.append(first)
+            continue
+        triangles += count
+        for k in bvh.primitives[first:first + count]:
+            i = 3 * k
+            e1x, e1y, e1z = e1[i], e1[i+1], e1[i+2]
+            e2x, e2y, e2z = e2[i], e2[i+1], e2[i+2]
+            px, py, pz = dy * e2z - dz * e2y, dz * e2x - dx * e2z, dx * e2y - dy * e2x
+            det = e1x * px + e1y * py + e1z * pz
+            if -1e-12 < det < 1e-12:
+                continue
+            inv_det = 1 / det
+            tx, ty, tz = ox - p0[i], oy - p0[i+1], oz - p0[i+2]
+            u = (tx * px + ty * py + tz * pz) * inv_det
+            if u < 0 or u > 1:
+                continue
+            qx, qy, qz = ty * e1z - tz * e1y, tz * e1x - tx * e1z, tx * e1y - ty * e1x
+            v = (dx * qx + dy * qy + dz * qz) * inv_det
+            if v < 0 or u + v > 1:
+                continue
+            t = (e2x * qx + e2y * qy + e2z * qz) * inv_det
+            if t > OBJ_NEAR and t < max_t:
+                if INSTRUMENTATION:
+                    COUNTERS['box_tests'] += boxes
+                    COUNTERS['triangle_tests'] += triangles
+                    COUNTERS['shadow_early_exits'] += 1
+                return True
+    if INSTRUMENTATION:
+        COUNTERS['box_tests'] += boxes
+        COUNTERS['triangle_tests'] += triangles
+    return False
+
+def sphere_set_closest_hit(ray, shape, time, from_inside=False, roots=None):
+    # returns (t, sphere index) of the closest hit in a sphere set, or (-1, -1). from_inside is the root
+    # rule of sphere_solution applied to the whole set: a ray refracted into one of its spheres takes the
+    # far root of the spheres it starts in, which is only that one unless spheres of the set overlap.
+    # roots are the subtrees to start from, as in mesh_closest_hit.
+    # a set is deep and is walked by every ray, so the slab test of ray_box_entry is inlined here with
+    # comparisons instead of min and max calls
+    bvh = shape.bvh
+    bounds = bvh.bounds
+    nodes = bvh.nodes
+    primitives = bvh.primitives
+    centers = shape.centers
+    radii = shape.radii
+    speeds = shape.speeds
+    sx, sy, sz = ray.start.x, ray.start.y, ray.start.z
+    dx, dy, dz = ray.direction.x, ray.direction.y, ray.direction.z
+    ix, iy, iz = inverse_direction(dx, dy, dz)
+    a = dx * dx + dy * dy + dz * dz
+    sqrt = math.sqrt
+
+    closest_t = VISION_RANGE
+    closest = -1
+    if roots is None:
+        t_root = ray_box_entry(bounds, 0, sx, sy, sz, ix, iy, iz, closest_t)
+        stack = [(0, t_root)] if t_root >= 0 else []
+        boxes = 1
+    else:
+        stack = root_stack(bounds, roots, sx, sy, sz, ix, iy, iz, closest_t)
+        boxes = len(roots)
+    spheres = 0
+    while stack:
+        node, t_entry = stack.pop()
+        if t_entry >= closest_t:
+            continue
+        first, count = nodes[2*node], nodes[2*node + 1]
+        if count:
+            spheres += count
+            for k in primitives[first:first + count]:
+                # same operations as sphere_solution, on the arrays
+                i = 3 * k
+                ox = sx - (centers[i] + speeds[i] * time)
+                oy = sy - (centers[i+1] + speeds[i+1] * time)
+                oz = sz - (centers[i+2] + speeds[i+2] * time)
+                b = 2 * (ox * dx + oy * dy + oz * dz)
+                c = ox * ox + oy * oy + oz * oz - radii[k] * radii[k]
+                discriminant = b * b - 4 * a * c
+                if discriminant <= OBJ_NEAR:
+                    continue
+                s1 = (-b - sqrt(discriminant))/ (2 * a)
+                s2 = (-b + sqrt(discriminant))/ (2 * a)
+                if s1 > s2:
+                    s1, s2 = s2, s1
+                t = s2 if from_inside and s1 <= OBJ_NEAR else s1
+                if t >= OBJ_NEAR and t < closest_t:
+                    closest_t = t
+                    closest = k
+            continue
+
+        boxes += 2
+        entries = []
+        for child in (first, first + 1):
+            b = 6 * child
+            near = (bounds[b] - sx) * ix
+            far = (bounds[b + 3] - sx) * ix
+            if near > far:
+                near, far = far, near
+            t1 = (bounds[b + 1] - sy) * iy
+            t2 = (bounds[b + 4] - sy) * iy
+            if t1 > t2:
+                t1, t2 = t2, t1
+            if t1 > near:
+                near = t1
+            if t2 < far:
+                far = t2
+            t1 = (bounds[b + 2] - sz) * iz
+            t2 = (bounds[b + 5] - sz) * iz
+            if t1 > t2:
+                t1, t2 = t2, t1
+            if t1 > near:
+                near = t1
+            if t2 < far:
+                far = t2
+            if near < 0:
+                near = 0
+            if far >= near and near < closest_t:
+                entries.append((child, near))
+        # the farther child goes first so the nearer one is visited first
+        if len(entries) == 2 and entries[0][1] < entries[1][1]:
+            entries.reverse()
+        stack.extend(entries)
+
+    if INSTRUMENTATION:
+        COUNTERS['box_tests'] += boxes
+        COUNTERS['sphere_tests'] += spheres
+    if closest < 0:
+        return -1, -1
+    return closest_t, closest
+
+def sphere_set_any_hit(ray, shape, time, max_t):
+    # like sphere_set_closest_hit, but returns True at the first sphere hit before max_t
+    bvh = shape.bvh
+    bounds = bvh.bounds
+    nodes = bvh.nodes
+    primitives = bvh.primitives
+    centers = shape.centers
+    radii = shape.radii
+    speeds = shape.speeds
+    sx, sy, sz = ray.start.x, ray.start.y, ray.start.z
+    dx, dy, dz = ray.direction.x, ray.direction.y, ray.direction.z
+    ix, iy, iz = inverse_direction(dx, dy, dz)
+    a = dx * dx + dy * dy + dz * dz
+    sqrt = math.sqrt
+
+    stack = [0]
+    boxes = 0
+    spheres = 0
+    while stack:
+        node = stack.pop()
+        boxes += 1
+        b = 6 * node
+        near = (bounds[b] - sx) * ix
+        far = (bounds[b + 3] - sx) * ix
+        if near > far:
+            near, far = far, near
+        t1 = (bounds[b + 1] - sy) * iy
+        t2 = (bounds[b + 4] - sy) * iy
+        if t1 > t2:
+            t1, t2 = t2, t1
+        if t1 > near:
+            near = t1
+        if t2 < far:
+            far = t2
+        t1 = (bounds[b + 2] - sz) * iz
+        t2 = (bounds[b + 5] - sz) * iz
+        if t1 > t2:
+            t1, t2 = t2, t1
+        if t1 > near:
+            near = t1
+        if t2 < far:
+            far = t2
+        if far < 0 or far < near or near > max_t:
+            continue
+        first, count = nodes[2*node], nodes[2*node + 1]
+        if not count:
+            stack.append(first + 1)
+            stack.append(first)
+            continue
+        spheres += count
+        for k in primitives[first:first + count]:
+            i = 3 * k
+            ox = sx - (centers[i] + speeds[i] * time)
+            oy = sy - (centers[i+1] + speeds[i+1] * time)
+            oz = sz - (centers[i+2] + speeds[i+2] * time)
+            b = 2 * (ox * dx + oy * dy + oz * dz)
+            c = ox * ox + oy * oy + oz * oz - radii[k] * radii[k]
+            discriminant = b * b - 4 * a * c
+            if discriminant <= OBJ_NEAR:
+                continue
+            t = min((-b - sqrt(discriminant))/ (2 * a), (-b + sqrt(discriminant))/ (2 * a))
+            if t > OBJ_NEAR and t < max_t:
+                if INSTRUMENTATION:
+                    COUNTERS['box_tests'] += boxes
+                    COUNTERS['sphere_tests'] += spheres
+                    COUNTERS['shadow_early_exits'] += 1
+                return True
+    if INSTRUMENTATION:
+        COUNTERS['box_tests'] += boxes
+        COUNTERS['sphere_tests'] += spheres
+    return False
+
+#######################################
+### SAMPLERS
+#######################################
+
+# dimensions of a sample, in the order a path uses them: the position in the pixel (2), the lens (2),
+# the time, then BOUNCE_DIMENSIONS per bounce (the fuzz of a reflection and the russian roulette) and,
+# after the last bounce, LIGHT_DIMENSIONS per light for the jitter of the shadow rays. the sobol samplers
+# stratify pairs of dimensions (2k, 2k + 1), so the values used together start at even dimensions
+PIXEL_DIMENSION = 0
+LENS_DIMENSION = 2
+TIME_DIMENSION = 4
+BOUNCE_DIMENSION = 6
+BOUNCE_DIMENSIONS = 4
+FUZZ_OFFSET = 0
+ROULETTE_OFFSET = 3
+LIGHT_DIMENSIONS = 4
+LIGHT_PICK_OFFSET = 3
+SAMPLERS = ['random', 'halton', 'sobol', 'bluenoise']
+# bases of the halton dimensions, the dimensions past them fall back to hashed random numbers
+PRIMES = [p for p in range(2, 400) if all(p % d for d in range(2, int(p ** 0.5) + 1))]
+BLUE_NOISE_SIZE = 32
+BLUE_NOISE_SIGMA = 1.5
+# lazily built by blue_noise_mask, before the workers fork when the render uses it
+BLUE_NOISE = None
+MASK32 = 0xffffffff
+REVERSED_BYTES = [int('{:08b}'.format(k)[::-1], 2) for k in range(256)]
+
+def light_dimension(options, light):
+    return BOUNCE_DIMENSION + BOUNCE_DIMENSIONS * (options.max_depth + 1) + LIGHT_DIMENSIONS * light
+
+def hash32(value):
+    # integer hash with good avalanche (lowbias32), used to derive independent seeds per pixel and dimension
+    value &= MASK32
+    value ^= value >> 16
+    value = value * 0x7feb352d & MASK32
+    value ^= value >> 15
+    value = value * 0x846ca68b & MASK32
+    return value ^ value >> 16
+
+def reverse_bits32(value):
+    return REVERSED_BYTES[value & 255] << 24 | REVERSED_BYTES[value >> 8 & 255] << 16 \
+        | REVERSED_BYTES[value >> 16 & 255] << 8 | REVERSED_BYTES[value >> 24 & 255]
+
+def owen_scramble(value, seed):
+    # nested uniform scramble of a 32 bit binary fraction (or of a sample index): every digit is flipped
+    # depending on the digits before it. the laine-karras hash only carries bits upwards, so it runs on
+    # the reversed bits
+    value = reverse_bits32(value)
+    value = value + seed & MASK32
+    value ^= value * 0x6c50b47c & MASK32
+    value ^= value * 0xb82f1e52 & MASK32
+    value ^= value * 0xc7afe638 & MASK32
+    value ^= value * 0x8d22f6e6 & MASK32
+    return reverse_bits32(value)
+
+def sobol_generator_bytes():
+    # the second dimension of the sobol sequence is linear in the bits of the index, so it is the xor of
+    # the contributions of the 4 bytes of the index, tabulated here
+    columns = []
+    v = 1 << 31
+    for bit in range(32):
+        columns.append(v)
+        v ^= v >> 1
+    tables = []
+    for byte in range(4):
+        table = [0] * 256
+        for value in range(1, 256):
+            low = value & -value
+            table[value] = table[value ^ low] ^ columns[byte * 8 + low.bit_length() - 1]
+        tables.append(table)
+    return tables
+
+SOBOL_BYTES = sobol_generator_bytes()
+
+def sobol32(index, dimension):
+    # first two dimensions of the sobol sequence as 32 bit binary fractions: the van der corput sequence
+    # and the one whose generator matrix is the pascal matrix mod 2
+    if dimension == 0:
+        return reverse_bits32(index)
+    return SOBOL_BYTES[0][index & 255] ^ SOBOL_BYTES[1][index >> 8 & 255] ^ SOBOL_BYTES[2][index >> 16 & 255] \
+        ^ SOBOL_BYTES[3][index >> 24]
+
+def radical_inverse(base, index):
+    inverse = 1 / base
+    result = 0
+    digit = inverse
+    while index:
+        result += index % base * digit
+        index //= base
+        digit *= inverse
+    return result
+
+def blue_noise_mask():
+    # BLUE_NOISE_SIZE^2 thresholds in [0, 1), row-major, ordered so every prefix of the ranking is evenly
+    # spread over the torus: starting at pixel 0, the next pixel is always the one with the lowest gaussian
+    # energy from the pixels already taken (the largest void, as in the void-and-cluster method)
+    global BLUE_NOISE
+    if BLUE_NOISE is None:
+        size = BLUE_NOISE_SIZE
+        kernel = [[math.exp(-(min(dy, size - dy) ** 2 + min(dx, size - dx) ** 2) / (2 * BLUE_NOISE_SIGMA ** 2))
+            for dx in range(size)] for dy in range(size)]
+        energy = [0.0] * (size * size)
+        mask = [0.0] * (size * size)
+        for rank in range(size * size):
+            p = energy.index(min(energy))
+            mask[p] = (rank + 0.5) / (size * size)
+            py, px = divmod(p, size)
+            for y in range(size):
+                row = kernel[(y - py) % size]
+                row = row[size - px:] + row[:size - px]
+                base = y * size
+                energy[base:base + size] = [e + k for e, k in zip(energy[base:base + size], row)]
+            energy[p] = math.inf
+        BLUE_NOISE = mask
+    return BLUE_NOISE
+
+def make_sampler(name, seed=None):
+    # the random sampler draws nothing to be built, so renders with it keep their noise
+    if name == 'random':
+        return RandomSampler()
+    if seed is None:
+        seed = random.getrandbits(64)
+    return {'halton': HaltonSampler, 'sobol': SobolSampler, 'bluenoise': BlueNoiseSampler}[name](seed)
+
+class RandomSampler:
+    # independent numbers from the global random (or the numpy generator of the tile), drawn in the order
+    # the renderer asks for them. the first DISTRIBUTED_RAYS positions in the pixel are a fixed pattern
+    pattern = True
+
+    def start_pixel(self, i, j):
+        pass
+
+    def start_sample(self, index):
+        pass
+
+    def get(self, dimension):
+        return random.random()
+
+    def np_get(self, rng, i, j, k, dimension, count=None):
+        return rng.random(len(k) if count is None else (len(k), count))
+
+class HaltonSampler:
+    # the radical inverse of the sample index in the base of each dimension, shifted modulo 1 by an offset
+    # per pixel and dimension (cranley-patterson rotation), so pixels do not share their error
+    pattern = False
+
+    def __init__(self, seed):
+        self.seed = hash32(seed ^ hash32(seed >> 32))
+
+    def start_pixel(self, i, j):
+        self.pixel_seed = hash32(self.seed ^ hash32(i ^ hash32(j)))
+
+    def start_sample(self, index):
+        self.index = index
+
+    def get(self, dimension):
+        offset = hash32(self.pixel_seed ^ hash32(dimension))
+        if dimension >= len(PRIMES):
+            return hash32(offset + self.index) / 2 ** 32
+        value = radical_inverse(PRIMES[dimension], self.index) + offset / 2 ** 32
+        return value - 1 if value >= 1 else value
+
+    def np_get(self, rng, i, j, k, dimension, count=None):
+        values = np.stack([self.np_dimension(i, j, k, dimension + d) for d in range(count or 1)], axis=1)
+        return values[:, 0] if count is None else values
+
+    def np_dimension(self, i, j, k, dimension):
+        offset = np_hash32(np_pixel_seeds(self.seed, i, j) ^ np.uint32(hash32(dimension)))
+        if dimension >= len(PRIMES):
+            return np_hash32(offset + k.astype(np.uint32)) / 2 ** 32
+        value = np_radical_inverse(PRIMES[dimension], k) + offset / 2 ** 32
+        return np.where(value >= 1, value - 1, value)
+
+class SobolSampler:
+    # shuffled and scrambled sobol (burley 2020): every pair of dimensions is the 2d sobol sequence with its
+    # sample order shuffled by an owen scramble of the index, so the pairs are not correlated with each
+    # other, and its values owen scrambled. the seeds depend on the pixel, so pixels do not share their error
+    pattern = False
+
+    def __init__(self, seed):
+        self.seed = hash32(seed ^ hash32(seed >> 32))
+
+    def start_pixel(self, i, j):
+        self.pixel_seed = hash32(self.seed ^ hash32(i ^ hash32(j)))
+        # seeds of the index shuffle and of the two value scrambles of every pair, made as they are needed
+        self.pair_seeds = []
+
+    def start_sample(self, index):
+        self.index = index
+        self.pair = -1
+
+    def get(self, dimension):
+        # both values of a pair are made at once, the renderer asks for them one after the other
+        if dimension >> 1 != self.pair:
+            self.pair = dimension >> 1
+            while len(self.pair_seeds) <= self.pair:
+                pair_seed = hash32(self.pixel_seed ^ hash32(len(self.pair_seeds)))
+                self.pair_seeds.append((pair_seed, hash32(pair_seed + 1), hash32(pair_seed + 2)))
+            shuffle_seed, x_seed, y_seed = self.pair_seeds[self.pair]
+            index = owen_scramble(self.index, shuffle_seed)
+            self.values = (owen_scramble(sobol32(index, 0), x_seed) / 2 ** 32, owen_scramble(sobol32(index, 1), y_seed) / 2 ** 32)
+        return self.values[dimension & 1]
+
+    def np_get(self, rng, i, j, k, dimension, count=None):
+        seeds = np_pixel_seeds(self.seed, i, j)
+        values = np.stack([self.np_dimension(seeds, k, dimension + d) for d in range(count or 1)], axis=1)
+        return values[:, 0] if count is None else values
+
+    def np_dimension(self, seeds, k, dimension):
+        pair_seed = np_hash32(seeds ^ np.uint32(hash32(dimension >> 1)))
+        value = np_sobol32(np_owen_scramble(k.astype(np.uint32), pair_seed), dimension & 1)
+        return np_owen_scramble(value, np_hash32(pair_seed + np.uint32(1 + (dimension & 1)))) / 2 ** 32
+
+class BlueNoiseSampler(SobolSampler):
+    # the same scrambled sobol points in every pixel, shifted modulo 1 per pixel by a blue noise mask
+    # (blue noise dithered sampling, georgiev and fajardo 2016). the error is then spread like blue noise,
+    # with neighbouring pixels erring in opposite directions, which the eye (and a blur) averages out.
+    # every dimension reads the mask at its own toroidal shift so they are not correlated
+    def __init__(self, seed):
+        SobolSampler.__init__(self, seed)
+        self.mask = blue_noise_mask()
+        # the scrambles are shared by all pixels
+        self.pixel_seed = self.seed
+        self.pair_seeds = []
+        self.shifts = []
+
+    def start_pixel(self, i, j):
+        self.i, self.j = i, j
+
+    def get(self, dimension):
+        while len(self.shifts) <= dimension:
+            self.shifts.append(hash32(self.seed ^ hash32(len(self.shifts) + 1)))
+        shift = self.shifts[dimension]
+        size = BLUE_NOISE_SIZE
+        value = SobolSampler.get(self, dimension) + self.mask[(self.i + (shift & 0xffff)) % size * size + (self.j + (shift >> 16)) % size]
+        return value - 1 if value >= 1 else value
+
+    def np_get(self, rng, i, j, k, dimension, count=None):
+        seeds = np.full(len(k), self.seed, dtype=np.uint32)
+        mask = np.asarray(self.mask)
+        size = BLUE_NOISE_SIZE
+        values = []
+        for d in range(dimension, dimension + (count or 1)):
+            shift = hash32(self.seed ^ hash32(d + 1))
+            value = self.np_dimension(seeds, k, d) + mask[(i + (shift & 0xffff)) % size * size + (j + (shift >> 16)) % size]
+            values.append(np.where(value >= 1, value - 1, value))
+        values = np.stack(values, axis=1)
+        return values[:, 0] if count is None else values
+
+def np_hash32(values):
+    # hash32 over an array, in uint32 arithmetic that wraps around like the masked python version
+    values = np.asarray(values).astype(np.uint32)
+    values ^= values >> np.uint32(16)
+    values *= np.uint32(0x7feb352d)
+    values ^= values >> np.uint32(15)
+    values *= np.uint32(0x846ca68b)
+    return values ^ values >> np.uint32(16)
+
+def np_pixel_seeds(seed, i, j):
+    return np_hash32(np.uint32(seed) ^ np_hash32(np.asarray(i).astype(np.uint32) ^ np_hash32(j)))
+
+def np_reverse_bits32(values):
+    table = np.array(REVERSED_BYTES, dtype=np.uint32)
+    return table[values & 255] << np.uint32(24) | table[values >> np.uint32(8) & 255] << np.uint32(16) \
+        | table[values >> np.uint32(16) & 255] << np.uint32(8) | table[values >> np.uint32(24)]
+
+def np_owen_scramble(values, seeds):
+    values = np_reverse_bits32(values)
+    values = values + seeds
+    values ^= values * np.uint32(0x6c50b47c)
+    values ^= values * np.uint32(0xb82f1e52)
+    values ^= values * np.uint32(0xc7afe638)
+    values ^= values * np.uint32(0x8d22f6e6)
+    return np_reverse_bits32(values)
+
+def np_sobol32(index, dimension):
+    if dimension == 0:
+        return np_reverse_bits32(index)
+    tables = np.array(SOBOL_BYTES, dtype=np.uint32)
+    return tables[0][index & 255] ^ tables[1][index >> np.uint32(8) & 255] ^ tables[2][index >> np.uint32(16) & 255] \
+        ^ tables[3][index >> np.uint32(24)]
+
+def np_radical_inverse(base, index):
+    index = np.asarray(index, dtype=np.int64).copy()
+    result = np.zeros(len(index))
+    digit = 1 / base
+    while index.any():
+        result += index % base * digit
+        index //= base
+        digit /= base
+    return result
+
+#######################################
+### OCCLUSION CACHE
+#######################################
+
+# error bounds of the cache: hit points in the same cell of a grid of that spacing (world units) with
+# normals in the same of OCCLUSION_CACHE_NORMAL_STEPS bins per axis share an entry, which answers once it
+# averaged that many shadow rays. the time is not in the key, an entry averages the whole shutter just like
+# the samples of a pixel do
+OCCLUSION_CACHE_SPACING = 0.05
+OCCLUSION_CACHE_SAMPLES = 8
+OCCLUSION_CACHE_NORMAL_STEPS = 4
+# megabytes of shared memory of the table, and entries per bucket among which the least recently used is evicted
+OCCLUSION_CACHE_MEMORY = 64
+OCCLUSION_CACHE_WAYS = 4
+# key, sample count, blocked sum and last use of every entry
+OCCLUSION_CACHE_ENTRY = 32
+KEY_MASK = 2 ** 62 - 1
+
+class OcclusionCache:
+    # set-associative hash table of the fraction of the shapes that block a light, averaged over the shadow
+    # rays of the hit points of a cell of the cache (position, normal and light). every shading term
+    # of occlusion is that fraction at MIN_OCCLUSION plus the rest at the facing term of the shadow ray, so
+    # a hit on a ready entry only needs the direction to the light, not the shadow ray. the arrays are in
+    # shared memory inherited by the forked workers, which all read and fill the same table without locks:
+    # a race can only mix the updates of one entry, which then holds a slightly wrong average
+    def __init__(self, spacing=OCCLUSION_CACHE_SPACING, samples=OCCLUSION_CACHE_SAMPLES, memory=OCCLUSION_CACHE_MEMORY):
+        self.spacing = spacing
+        self.samples = samples
+        self.buckets = max(1, memory * 2 ** 20 // (OCCLUSION_CACHE_ENTRY * OCCLUSION_CACHE_WAYS))
+        self.capacity = self.buckets * OCCLUSION_CACHE_WAYS
+        # key 0 is an empty entry, and the clock starts at 1, so empty entries are always the least recently used
+        self.keys = multiprocessing.Array('q', self.capacity, lock=False)
+        self.counts = multiprocessing.Array('q', self.capacity, lock=False)
+        self.sums = multiprocessing.Array('d', self.capacity, lock=False)
+        self.stamps = multiprocessing.Array('q', self.capacity, lock=False)
+        self.clock = multiprocessing.Value('q', 1, lock=False)
+
+    def entries(self):
+        if np is not None:
+            return int(np.count_nonzero(self.views()[0]))
+        return sum(1 for key in self.keys if key)
+
+    def key(self, point, normal, light):
+        # the two engines hash the cell differently, a render only uses one of them
+        inverse = 1 / self.spacing
+        steps = OCCLUSION_CACHE_NORMAL_STEPS / 2
+        key = hash((math.floor(point.x * inverse), math.floor(point.y * inverse), math.floor(point.z * inverse),
+            math.floor((normal.x + 1) * steps), math.floor((normal.y + 1) * steps), math.floor((normal.z + 1) * steps), light)) & KEY_MASK
+        return key or 1
+
+    def tick(self):
+        self.clock.value += 1
+        return self.clock.value
+
+    def lookup(self, key):
+        # the blocked fraction of the entry of key once it averaged enough shadow rays, None before that
+        CACHE_STATS['lookups'] += 1
+        base = key % self.buckets * OCCLUSION_CACHE_WAYS
+        for slot in range(base, base + OCCLUSION_CACHE_WAYS):
+            if self.keys[slot] == key:
+                count = self.counts[slot]
+                if count < self.samples:
+                    return None
+                CACHE_STATS['hits'] += 1
+                self.stamps[slot] = self.tick()
+                return self.sums[slot] / count
+        return None
+
+    def add(self, key, blocked):
+        # adds the blocked fraction of a traced shadow ray to the entry of key, which takes the place of the
+        # least recently used entry of its bucket when it is not there
+        base = key % self.buckets * OCCLUSION_CACHE_WAYS
+        victim = base
+        for slot in range(base, base + OCCLUSION_CACHE_WAYS):
+            if self.keys[slot] == key:
+                break
+            if self.stamps[slot] < self.stamps[victim]:
+                victim = slot
+        else:
+            slot = victim
+            CACHE_STATS['inserts'] += 1
+            if self.keys[slot]:
+                CACHE_STATS['evictions'] += 1
+            self.keys[slot] = key
+            self.counts[slot] = 0
+            self.sums[slot] = 0.0
+        self.counts[slot] += 1
+        self.sums[slot] += blocked
+        self.stamps[slot] = self.tick()
+
+    def views(self):
+        # numpy arrays over the shared ones, made in the process that uses them
+        if not hasattr(self, 'np_keys'):
+            self.np_keys = np.frombuffer(self.keys, dtype=np.int64)
+            self.np_counts = np.frombuffer(self.counts, dtype=np.int64)
+            self.np_sums = np.frombuffer(self.sums, dtype=np.float64)
+            self.np_stamps = np.frombuffer(self.stamps, dtype=np.int64)
+        return self.np_keys, self.np_counts, self.np_sums, self.np_stamps
+
+    def np_key(self, points, normals, lights):
+        cells = np.floor(points / self.spacing).astype(np.int64)
+        bins = np.floor((normals + 1) * (OCCLUSION_CACHE_NORMAL_STEPS / 2)).astype(np.int64)
+        low = high = np.zeros(len(points), dtype=np.uint32)
+        for field in (cells[:, 0], cells[:, 1], cells[:, 2], bins[:, 0], bins[:, 1], bins[:, 2], np.broadcast_to(lights, len(points))):
+            field = np.asarray(field).astype(np.uint32)
+            low = np_hash32(low ^ field)
+            high = np_hash32(high + field + np.uint32(0x9e3779b9))
+        keys = (high.astype(np.int64) >> 2) << 32 | low.astype(np.int64)
+        return np.where(keys == 0, 1, keys)
+
+    def np_lookup(self, keys):
+        # blocked fractions of the ready entries of keys, nan where there is none
+        keys_table, counts, sums, stamps = self.views()
+        slots = (keys % self.buckets * OCCLUSION_CACHE_WAYS)[:, None] + np.arange(OCCLUSION_CACHE_WAYS)
+        found = keys_table[slots] == keys[:, None]
+        slot = slots[np.arange(len(keys)), found.argmax(axis=1)]
+        count = counts[slot]
+        ready = found.any(axis=1) & (count >= self.samples)
+        stamps[slot[ready]] = self.tick()
+        CACHE_STATS['lookups'] += len(keys)
+        CACHE_STATS['hits'] += int(ready.sum())
+        return np.where(ready, sums[slot] / np.maximum(count, 1), np.nan)
+
+    def np_needed(self, keys):
+        # which of the rays of keys still have to be traced for their entries to get ready: the first ones of
+        # every key, as many as its entry still lacks. the others can wait and read the entry
+        keys_table, counts, sums, stamps = self.views()
+        slots = (keys % self.buckets * OCCLUSION_CACHE_WAYS)[:, None] + np.arange(OCCLUSION_CACHE_WAYS)
+        found = keys_table[slots] == keys[:, None]
+        have = np.where(found.any(axis=1), counts[slots[np.arange(len(keys)), found.argmax(axis=1)]], 0)
+        order = np.argsort(keys, kind='stable')
+        ordered = keys[order]
+        starts = np.flatnonzero(np.r_[True, ordered[1:] != ordered[:-1]])
+        rank = np.arange(len(keys)) - np.repeat(starts, np.diff(np.r_[starts, len(keys)]))
+        needed = np.empty(len(keys), dtype=bool)
+        needed[order] = rank < self.samples - have[order]
+        return needed
+
+    def np_add(self, keys, blocked):
+        # add for arrays. keys new to the table are inserted one per bucket per round, and the rest
+        # (more new keys of the same bucket, or repeats of a key) wait for the next round
+        keys_table, counts, sums, stamps = self.views()
+        pending = np.arange(len(keys))
+        stamp = self.tick()
+        while len(pending):
+            base = keys[pending] % self.buckets * OCCLUSION_CACHE_WAYS
+            slots = base[:, None] + np.arange(OCCLUSION_CACHE_WAYS)
+            found = keys_table[slots] == keys[pending][:, None]
+            present = found.any(axis=1)
+            slot = slots[present, found[present].argmax(axis=1)]
+            np.add.at(counts, slot, 1)
+            np.add.at(sums, slot, blocked[pending[present]])
+            stamps[slot] = stamp
+            new = np.flatnonzero(~present)
+            first = new[np.unique(base[new], return_index=True)[1]]
+            victim = slots[first, stamps[slots[first]].argmin(axis=1)]
+            CACHE_STATS['inserts'] += len(victim)
+            CACHE_STATS['evictions'] += int(np.count_nonzero(keys_table[victim]))
+            keys_table[victim] = keys[pending[first]]
+            counts[victim] = 1
+            sums[victim] = blocked[pending[first]]
+            stamps[victim] = stamp
+            pending = pending[np.setdiff1d(new, first)]
+
+#######################################
+### PACKET TRACING
+#######################################
+
+# the cone of a packet is widened by that many radians against rounding. the hierarchy of a shape is
+# culled down to at most PACKET_FRONTIER subtrees, which every ray of the packet then tests instead of the root
+PACKET_ANGLE_MARGIN = 1e-6
+PACKET_FRONTIER = 8
+
+class PacketFrustum:
+    # bounding cone of the primary rays of a block of pixels. they all leave the eye towards a point of the
+    # footprint of their pixel moved by the lens offset, and that direction is affine in each of the two
+    # footprint and the two lens coordinates, so it lies in the convex hull of the 16 directions at their
+    # extremes. the cone around those holds every ray of the block, and what is out of it is hit by none
+    def __init__(self, rows, columns, width, height, eye, up, right, ipc, lens_radius):
+        # eye, up, right and ipc (the center of the image plane) are x, y, z sequences, so the engines
+        # can pass either Vec3s or numpy arrays
+        sqrt_dist_rays = math.sqrt(DISTRIBUTED_RAYS)
+        corners = []
+        for x in (columns.start - width / 2 + sqrt_dist_rays - 1, columns.stop - 1 - width / 2 + sqrt_dist_rays):
+            for y in (height / 2 - rows.stop + sqrt_dist_rays, height / 2 - rows.start + sqrt_dist_rays):
+                pixel_pos = [ipc[l] + (right[l] * x + up[l] * y) * PIXEL_SIZE for l in range(3)]
+                for u in (0.0, 1.0):
+                    for v in (0.0, 1.0):
+                        lens = (u * (ipc[0] - pixel_pos[0]) * PIXEL_SIZE * 10 * lens_radius,
+                            v * (ipc[1] - pixel_pos[1]) * PIXEL_SIZE * 10 * lens_radius, 0.0)
+                        corners.append(Vec3(*[pixel_pos[l] - eye[l] + lens[l] for l in range(3)]).normalize())
+        axis = Vec3()
+        for corner in corners:
+            axis += corner
+        self.eye = Vec3(float(eye[0]), float(eye[1]), float(eye[2]))
+        self.axis = axis.normalize()
+        self.angle = max(math.acos(max(-1.0, min(1.0, self.axis.dot(corner)))) for corner in corners) + PACKET_ANGLE_MARGIN
+
+    def sees_sphere(self, center, radius):
+        to_center = center - self.eye
+        distance = to_center.lenght()
+        if distance <= radius:
+            return True
+        angle = math.acos(max(-1.0, min(1.0, to_center.dot(self.axis) / distance)))
+        return angle <= self.angle + math.asin(radius / distance)
+
+    def sees_box(self, box):
+        # through the sphere around the box
+        center = Vec3((box[0] + box[3]) / 2, (box[1] + box[4]) / 2, (box[2] + box[5]) / 2)
+        return self.sees_sphere(center, Vec3(box[3] - box[0], box[4] - box[1], box[5] - box[2]).lenght() / 2)
+
+    def frontier(self, shape):
+        # the subtrees of the hierarchy of shape in the cone: nodes are replaced by their children in the
+        # cone, breadth first, while that keeps them within PACKET_FRONTIER. leaves are kept as they are
+        nodes = shape.bvh.nodes
+        kept = []
+        pending = [0] if self.sees_box(shape.node_bounds(0)) else []
+        while pending and len(kept) + len(pending) < PACKET_FRONTIER:
+            node = pending.pop(0)
+            first, count = nodes[2*node], nodes[2*node + 1]
+            if count:
+                kept.append(node)
+            else:
+                pending.extend(child for child in (first, first + 1) if self.sees_box(shape.node_bounds(child)))
+        return kept + pending
+
+    def cull(self, shapes):
+        # indices of the shapes some ray of the packet may hit, and the frontier of those with a hierarchy by index
+        visible = []
+        roots = {}
+        for k, shape in enumerate(shapes):
+            if isinstance(shape, Sphere):
+                # a moving sphere stays in the sphere around the middle of its path. hollow spheres have negative radii
+                speed = shape.speed_vec
+                if not self.sees_sphere(shape.center + speed * 0.5, abs(shape.radius) + speed.lenght() / 2):
+                    continue
+            else:
+                frontier = self.frontier(shape)
+                if not frontier:
+                    continue
+                roots[k] = frontier
+            visible.append(k)
+        if INSTRUMENTATION:
+            COUNTERS['packets'] += 1
+            COUNTERS['culled_shapes'] += len(shapes) - len(visible)
+        return visible, roots
+
+def packet_block(i, j, size):
+    # rows and columns of the size x size block of the image that holds pixel (i, j)
+    top, left = i - i % size, j - j % size
+    return range(top, top + size), range(left, left + size)
 
 #######################################
 ### RAY INTERSECT HANDLING
 #######################################
 
-def trace_rays_in_row(shapes, point_lights, i, width, height, camera_eye, camera_up, camera_right, camera_front, focal_dist, aperture, array):
-    for j in range(width):
-        result = trace_rays(shapes, point_lights, i, j, width, height, camera_eye, camera_up, camera_right, camera_front, focal_dist, aperture)
-        for k in range(3):
-            array[i * width * 3 + j * 3 + k] = int(math.floor(result[k]))
+class RenderOptions:
+    # knobs that every worker needs, passed down with the tile instead of being module constants
+    def __init__(self, max_depth=MAX_DEPTH, roulette_depth=ROULETTE_DEPTH, min_samples=DISTRIBUTED_RAYS,
+            max_samples=DISTRIBUTED_RAYS, variance_threshold=VARIANCE_THRESHOLD, stats=False, sampler='random', record=False,
+            denoise=False, light_samples=None, packet=0):
+        self.max_depth = max_depth
+        self.roulette_depth = roulette_depth
+        # a pixel stops sampling once the variance of its mean color (per channel, 0-255 units)
+        # falls below variance_threshold, never before min_samples nor after max_samples
+        self.min_samples = min_samples
+        self.max_samples = max_samples
+        self.variance_threshold = variance_threshold
+        # turns INSTRUMENTATION on in the workers
+        self.stats = stats
+        # name of the sample sequence, one of SAMPLERS
+        self.sampler = sampler
+        # the workers keep a RayRecorder and send its records with every tile
+        self.record = record
+        # the workers also write the guides of the denoiser (albedo, normal and depth of the first hit) to the framebuffer
+        self.denoise = denoise
+        # shadow rays per hit: one per light when None, else that many lights picked from a LightTable
+        self.light_samples = light_samples
+        # side in pixels of the blocks whose primary rays are culled together against the shapes (PacketFrustum), 0 for none
+        self.packet = packet
+
+    def adaptive(self):
+        return self.max_samples > self.min_samples
 
-def trace_rays(shapes, point_lights, i, j, width, height, camera_eye, camera_up, camera_right, camera_front, focal_dist, aperture):
+    def first_test(self, pattern):
+        # first sample count at which a pixel may stop. the variance of the fixed pattern of the first
+        # DISTRIBUTED_RAYS samples says nothing about the rest of the pixel, so with it the test waits for
+        # at least one jittered sample
+        return max(self.min_samples, DISTRIBUTED_RAYS + 1 if pattern else 2)
+
+    def samples_lights(self, light_count):
+        return self.light_samples is not None and self.light_samples < light_count
+
+def trace_tile(shapes, point_lights, rows, columns, width, height, camera_eye, camera_up, camera_right, camera_front, focal_dist, aperture, framebuffer, options, sampler, pixels=None):
+    # pixels (flat indices into the image) are the only ones traced when given, the others keep their color
+    if pixels is None:
+        pixels = [i * width + j for i in rows for j in columns]
+        colors = []
+    else:
+        colors = None
+    aux = [] if options.denoise else None
+    light_table = LightTable(point_lights) if options.samples_lights(len(point_lights)) else None
+    # visible shapes and frontiers of the packets, by block. pixels keep their order, so the samplers draw the same values
+    packets = {}
+    packet = None
+    for pixel in pixels:
+        i, j = divmod(pixel, width)
+        if options.packet:
+            block = packet_block(i, j, options.packet)
+            if block not in packets:
+                frustum = PacketFrustum(*block, width, height, camera_eye, camera_up, camera_right, camera_eye + camera_front * focal_dist, aperture / 2)
+                visible, roots = frustum.cull(shapes)
+                packets[block] = ([shapes[k] for k in visible], {shapes[k]: frontier for k, frontier in roots.items()})
+            packet = packets[block]
+        sampler.start_pixel(i, j)
+        if RECORDER is not None:
+            RECORDER.start_pixel(pixel)
+        color = trace_rays(shapes, point_lights, i, j, width, height, camera_eye, camera_up, camera_right, camera_front, focal_dist, aperture, options, sampler, aux, light_table, packet)
+        if colors is None:
+            framebuffer.write_tile(range(i, i + 1), range(j, j + 1), color, aux)
+            aux = [] if options.denoise else None
+        else:
+            colors.extend(color)
+    if colors is not None:
+        framebuffer.write_tile(rows, columns, colors, aux)
+
+def trace_rays(shapes, point_lights, i, j, width, height, camera_eye, camera_up, camera_right, camera_front, focal_dist, aperture, options, sampler, aux=None, light_table=None, packet=None):
+    # returns the mean color of the pixel. the means of its AUX_CHANNELS guides are appended to aux when given.
+    # with a light_table every hit traces options.light_samples shadow rays to lights picked from it.
+    # packet is the (shapes, frontiers) of the block of the pixel when primary rays are traced in packets
     lens_radius = aperture / 2
     ipc = camera_eye + camera_front * focal_dist
-    colors = []
     sqrt = math.sqrt
-    for k in range(DISTRIBUTED_RAYS):
-        sqrt_dist_rays = sqrt(DISTRIBUTED_RAYS)
-        sampling_offset = (sqrt_dist_rays - (k % sqrt_dist_rays / sqrt_dist_rays), \
-                            sqrt_dist_rays - (k / sqrt_dist_rays / sqrt_dist_rays))
+    sqrt_dist_rays = sqrt(DISTRIBUTED_RAYS)
+    adaptive = options.adaptive()
+    first_test = options.first_test(sampler.pattern)
+    # running mean and sum of squared deviations of the samples (welford), per channel
+    count = 0
+    average = [0, 0, 0]
+    deviations = [0, 0, 0]
+    guides = None
+    if aux is not None:
+        aux_sums = [0.0] * AUX_CHANNELS
+    while count < options.max_samples:
+        sampler.start_sample(count)
+        if sampler.pattern and count < DISTRIBUTED_RAYS:
+            sampling_offset = (sqrt_dist_rays - (count % sqrt_dist_rays / sqrt_dist_rays), \
+                                sqrt_dist_rays - (count / sqrt_dist_rays / sqrt_dist_rays))
+        else:
+            # samples past the fixed pattern are jittered over the same footprint
+            sampling_offset = (sqrt_dist_rays - sampler.get(PIXEL_DIMENSION), sqrt_dist_rays - sampler.get(PIXEL_DIMENSION + 1))
         # ray = eye + t * (pixel_pos - eye)
         pixel_pos = ipc + (camera_right * (j - width/2 + sampling_offset[0]) + camera_up * (height/2 - i + sampling_offset[1])) * PIXEL_SIZE
-        offset = Vec3(random.random() * (ipc - pixel_pos).x * PIXEL_SIZE * 10, random.random() * (ipc - pixel_pos).y * PIXEL_SIZE * 10, 0.0) * lens_radius
+        offset = Vec3(sampler.get(LENS_DIMENSION) * (ipc - pixel_pos).x * PIXEL_SIZE * 10, sampler.get(LENS_DIMENSION + 1) * (ipc - pixel_pos).y * PIXEL_SIZE * 10, 0.0) * lens_radius
         ray = Ray(camera_eye, pixel_pos - camera_eye + offset)
-        time = random.random()
-        
-        params = []
-        for s in shapes:
-            params.append(intersects(ray, s, shapes, time))
-        
-        min_t = VISION_RANGE
-        color = None
-        for p in params:
-            if p[0] >= OBJ_NEAR and p[0] < min_t:
-                color = p[1]
-                min_t = p[0]
-
-        if color:
+        time = sampler.get(TIME_DIMENSION)
+
+        if aux is not None or OCCLUSION_CACHE is not None:
+            # what a ray that misses everything sees
+            guides = SKYBOX.array() + [0.0, 0.0, 0.0]
+        color, min_t = evaluate_ray(ray, shapes, time, options, sampler, guides, packet)
+        if aux is not None:
+            for l in range(6):
+                aux_sums[l] += guides[l]
+            aux_sums[6] += min_t if min_t >= 0 else VISION_RANGE
+        if min_t >= 0 and len(point_lights):
+            # without lights the color stays as evaluated, like in the numpy engine
             occlusions = []
-            for light in point_lights:
-                occlusions.append(occlusion(ray, min_t, shapes, light, time))
+            normal = Vec3(*guides[3:6]) if OCCLUSION_CACHE is not None else None
+            for l in range(len(point_lights) if light_table is None else options.light_samples):
+                dimension = light_dimension(options, l)
+                jitter = Vec3(sampler.get(dimension), sampler.get(dimension + 1), sampler.get(dimension + 2))
+                if light_table is None:
+                    occlusions.append(occlusion(ray, min_t, shapes, point_lights[l], time, jitter, normal, l))
+                else:
+                    light, weight = light_table.pick(sampler.get(dimension + LIGHT_PICK_OFFSET))
+                    occlusions.append(weight * occlusion(ray, min_t, shapes, point_lights[light], time, jitter, normal, light))
             color *= mean(occlusions)
-            colors.append(color)
-        else:
-            colors.append(SKYBOX)
 
-    # retorna media das cores
-    average = [0, 0, 0]
-    for k in range(DISTRIBUTED_RAYS):
+        count += 1
         for l in range(3):
-            average[l] += colors[k][l]
-    for k in range(3):
-        average[k] /= DISTRIBUTED_RAYS
+            delta = color[l] - average[l]
+            average[l] += delta / count
+            deviations[l] += delta * (color[l] - average[l])
+        if adaptive and count >= first_test \
+                and max(deviations) / (count * (count - 1)) < options.variance_threshold:
+            break
+
+    SAMPLE_HISTOGRAM[count] = SAMPLE_HISTOGRAM.get(count, 0) + 1
+    if aux is not None:
+        aux.extend(value / count for value in aux_sums)
     return average
 
-def intersects(ray, shape, other_shapes, time, occlusion=False, refracted=False):
-    # intersect with sphere
-    try:
-        new_center = shape.center + shape.speed_vec * time
-        oc = ray.start - new_center
-        a = ray.direction.dot(ray.direction)
-        b = 2 * oc.dot(ray.direction)
-        c = oc.dot(oc) - shape.radius * shape.radius
-        discriminant = b * b - 4 * a * c
-        if discriminant > OBJ_NEAR:
-            sqrt = math.sqrt
-            s1 = (-b - sqrt(discriminant))/ (2 * a)
-            s2 = (-b + sqrt(discriminant))/ (2 * a)
-            solution = min(s1, s2)
-            #solution = (-b - sqrt(discriminant))/ (2 * a)
-            if occlusion:
-                return solution
-            try:
-                shape.material.k_diffuse
-                # cover lambertian materials
-                return solution, shape.material.albedo * shape.material.k_diffuse
-            except AttributeError:
-                pass
-            try:
-                shape.material.k_reflectance
-                # cover reflective materials
-                reflected_ray = Ray(ray.point_at_t(solution),
-                    ray.direction.reflect(shape.normal(ray.point_at_t(solution))) \
-                    + Vec3(random.random(), random.random(), random.random()) * shape.material.fuzz)
-                hits = []
-                other_shapes_real = [x for x in other_shapes if x != shape]
-                for s in other_shapes_real:
-                    reflected_intersection = intersects(reflected_ray, s, other_shapes_real, time)
-                    if reflected_intersection[0] > OBJ_NEAR:
-                        hits.append(reflected_intersection)
-                hits.sort(key=lambda val: val[0])
-                try:
-                    return solution, hits[0][1] * shape.material.k_reflectance + \
-                            shape.material.albedo * (1 - shape.material.k_reflectance)
-                except IndexError:
-                    return solution, SKYBOX * shape.material.k_reflectance + \
-                            shape.material.albedo * (1 - shape.material.k_reflectance)
-            except AttributeError:
-                pass
-            try:
-                shape.material.k_attenuation
-                # cover dielectric materials
-                new_direction = ray.direction.refract(shape.normal(ray.point_at_t(solution)), 1/shape.material.k_refraction)
-                if refracted:
-                    new_direction = ray.direction.refract(-shape.normal(ray.point_at_t(solution)), shape.material.k_refraction)
-                refracted_ray = Ray(ray.point_at_t(solution) + new_direction * OBJ_NEAR, new_direction)
-                    #+ Vec3(1, 1, 1) * random.random() * shape.material.fuzz)
-                hits = []
-                other_shapes_real = [x for x in other_shapes if x != shape]
-                for s in other_shapes_real:
-                    refracted_intersection = None
-                    if refracted:
-                        refracted_intersection = intersects(refracted_ray, s, other_shapes_real, time, refracted=False)
-                    else:
-                        refracted_intersection = intersects(refracted_ray, s, other_shapes_real, time, refracted=True)
-                    if refracted_intersection[0] > OBJ_NEAR:
-                        hits.append(refracted_intersection)
-                hits.sort(key=lambda val: val[0])
-                try:
-                    return solution, shape.material.albedo * shape.material.k_attenuation + \
-                            hits[0][1] * (1 - shape.material.k_attenuation)
-                except IndexError:
-                    return solution, shape.material.albedo * shape.material.k_attenuation + \
-                            SKYBOX * (1 - shape.material.k_attenuation)
-            except AttributeError:
-                pass
+def sphere_solution(ray, shape, time, from_inside=False):
+    # nearest root of the ray/sphere equation, None if the ray misses. a sphere is only seen from
+    # the inside (far root) by a ray that was refracted into it
+    # instead of moving the sphere, the ray origin is moved into its object space, with plain floats
+    center = shape.center
+    speed = shape.speed_vec
+    start = ray.start
+    ox = start.x - (center.x + speed.x * time)
+    oy = start.y - (center.y + speed.y * time)
+    oz = start.z - (center.z + speed.z * time)
+    direction = ray.direction
+    dx, dy, dz = direction.x, direction.y, direction.z
+    a = dx * dx + dy * dy + dz * dz
+    b = 2 * (ox * dx + oy * dy + oz * dz)
+    c = ox * ox + oy * oy + oz * oz - shape.radius * shape.radius
+    discriminant = b * b - 4 * a * c
+    if discriminant > OBJ_NEAR:
+        sqrt = math.sqrt
+        s1 = (-b - sqrt(discriminant))/ (2 * a)
+        s2 = (-b + sqrt(discriminant))/ (2 * a)
+        if from_inside and min(s1, s2) <= OBJ_NEAR:
+            return max(s1, s2)
+        return min(s1, s2)
+    return None
+
+def closest_hit(ray, shapes, time, inside=None, roots=None):
+    # returns (t, shape, triangle or sphere index for meshes and sphere sets) of the closest hit, shape is None on a miss.
+    # roots maps the shapes with a hierarchy to the subtrees the ray can reach, when it is known (see PacketFrustum)
+    closest_t = VISION_RANGE
+    closest = None
+    closest_triangle = -1
+    if INSTRUMENTATION:
+        COUNTERS['sphere_tests'] += sum(1 for shape in shapes if isinstance(shape, Sphere))
+    for shape in shapes:
+        if isinstance(shape, Sphere):
+            t = sphere_solution(ray, shape, time, shape is inside)
+            triangle = -1
+            if t is None:
+                continue
+        elif isinstance(shape, SphereSet):
+            t, triangle = sphere_set_closest_hit(ray, shape, time, shape is inside, None if roots is None else roots.get(shape))
+            if triangle < 0:
+                continue
         else:
-            if occlusion:
-                return -1
-            return -1, SKYBOX
-    except AttributeError:
-        pass
-    
-    # intersect with triangle
-    intersections = []
-
-    for i in range(0, len(shape.faces), 3):
-        intersections.append(intersect_with_triangle(ray, shape, other_shapes, time,
-            shape.vertices[shape.faces[i]] + shape.speed_vec * time,
-            shape.vertices[shape.faces[i+1]] + shape.speed_vec * time,
-            shape.vertices[shape.faces[i+2]] + shape.speed_vec * time,
-            shape.normal_indices[i], shape.normal_indices[i+1], shape.normal_indices[i+2]))
-    
-    if len(intersections):
-        intersections.sort(key=lambda val: val[0])
-        for i in intersections:
-            if i[0] > OBJ_NEAR:
-                if occlusion:
-                    return i[0]
-                return i
-
-    if occlusion:
-        return -1
-    return -1, SKYBOX
-
-def intersect_with_triangle(ray, shape, shapes, time, p0, p1, p2, ni0, ni1, ni2):
-    edge0 = p1 - p0
-    edge1 = p2 - p1
-    edge2 = p0 - p2
-
-    # computing plane intersection first
-    p0p1 = p1 - p0
-    p0p2 = p2 - p0
-    p_normal = p0p1.cross(p0p2)
-    area2 = p_normal.lenght()
-
-    # find intersection point with plane
-    # check if they're parallel
-    n_dot_ray_dir = p_normal.dot(ray.direction)
-    if abs(n_dot_ray_dir) < OBJ_NEAR:
-        # they're parallel (or almost), no intersection
-        return -1, SKYBOX
-    
-    d = p_normal.dot(p0)
+            t, triangle = mesh_closest_hit(ray, shape, time, None if roots is None else roots.get(shape))
+            if triangle < 0:
+                continue
+        if t >= OBJ_NEAR and t < closest_t:
+            closest_t, closest, closest_triangle = t, shape, triangle
+    return closest_t, closest, closest_triangle
 
-    # compute t
-    t = (p_normal.dot(ray.start) + d) / n_dot_ray_dir
-    
-    # check if triangle if behind
-    if t < 0:
-        return -1, SKYBOX     
+def evaluate_ray(ray, shapes, time, options, sampler, guides=None, packet=None):
+    # every material blends its own color with at most one secondary ray, so the color of a path is a
+    # sum of weighted terms. the stack holds the rays still to be traced with the weight they carry,
+    # the depth and the shape they are travelling inside of (after a refraction).
+    # returns the color and the distance to the first hit (-1 on a miss). guides, when given, gets the
+    # color of the material and the normal at the first hit. the primary ray only tests the shapes of its
+    # packet when there is one
+    color = Vec3()
+    first_t = -1
+    stack = [(ray, 1.0, 0, None)]
+    while stack:
+        ray, weight, depth, inside = stack.pop()
+        if depth > options.max_depth:
+            color += SKYBOX * weight
+            continue
+        if depth > options.roulette_depth:
+            # russian roulette: dim paths are dropped, survivors are scaled up to stay unbiased
+            survival = min(1.0, weight)
+            if sampler.get(BOUNCE_DIMENSION + BOUNCE_DIMENSIONS * depth + ROULETTE_OFFSET) >= survival:
+                continue
+            weight /= survival
 
-    # compute intersection point
-    ip = ray.start + ray.direction * t
-    
-    # inside-outside test
-    vp0 = ip - p0
-    cr = edge0.cross(vp0)
-    if p_normal.dot(cr) < 0:
-        return -1, SKYBOX
-
-    vp1 = ip - p1
-    cr = edge1.cross(vp1)
-    if p_normal.dot(cr) < 0:
-        return -1, SKYBOX
-
-    vp2 = ip - p2
-    cr = edge2.cross(vp2)
-    if p_normal.dot(cr) < 0:
-        return -1, SKYBOX    
-
-    # if all tests passed, the ray hits the triangle
-    try:
-        # cover lambertian materials
-        return t, shape.material.albedo * shape.material.k_diffuse
-    except AttributeError:
-        pass
-    try:
-        # cover reflective materials
-        shape.material.k_reflectance
-        reflected_ray = Ray(ray.point_at_t(t),
-                    ray.direction.reflect(shape.vertex_normals[ni0].interpolate(shape.vertex_normals[ni1], shape.vertex_normals[ni2])) \
-                    + Vec3(random.random(), random.random(), random.random()) * shape.material.fuzz)
-        hits = []
-        other_shapes_real = [x for x in shapes if x != shape]
-        for s in other_shapes_real:
-            reflected_intersection = intersects(reflected_ray, s, other_shapes_real, time)
-            if reflected_intersection[0] > OBJ_NEAR:
-                hits.append(reflected_intersection)
-        hits.sort(key=lambda val: val[0])
-        try:
-            return t, hits[0][1] * shape.material.k_reflectance + \
-                    shape.material.albedo * (1 - shape.material.k_reflectance)
-        except IndexError:
-            return t, SKYBOX * shape.material.k_reflectance + \
-                    shape.material.albedo * (1 - shape.material.k_reflectance)
-    except AttributeError:
-        pass
-    try:
-        # cover dielectric materials
-        shape.material.k_attenuation
-        new_direction = ray.direction.refract(shape.vertex_normals[ni0].interpolate(shape.vertex_normals[ni1], shape.vertex_normals[ni2]),
-            1/shape.material.k_refraction)
-        refracted_ray = Ray(ray.point_at_t(t) + new_direction * OBJ_NEAR, new_direction)
-            #+ Vec3(1, 1, 1) * random.random() * shape.material.fuzz)
-        hits = []
-        other_shapes_real = [x for x in shapes if x != shape]
-        for s in other_shapes_real:
-            refracted_intersection = intersects(refracted_ray, s, other_shapes_real, time)
-            if refracted_intersection[0] > OBJ_NEAR:
-                hits.append(refracted_intersection)
-        hits.sort(key=lambda val: val[0])
-        try:
-            return t, shape.material.albedo * shape.material.k_attenuation + \
-                    hits[0][1] * (1 - shape.material.k_attenuation)
-        except IndexError:
-            return t, shape.material.albedo * shape.material.k_attenuation + \
-                    SKYBOX * (1 - shape.material.k_attenuation)
-    except AttributeError:
-        pass
-    
-    return -1, SKYBOX
+        if depth == 0 and packet is not None:
+            t, shape, triangle = closest_hit(ray, packet[0], time, inside, packet[1])
+        else:
+            t, shape, triangle = closest_hit(ray, shapes, time, inside)
+        if RECORDER is not None:
+            RECORDER.ray(ray, t, shape)
+        if INSTRUMENTATION:
+            DEPTH_HISTOGRAM[depth] = DEPTH_HISTOGRAM.get(depth, 0) + 1
+            COUNTERS['hits'] += shape is not None
+        if shape is None:
+            color += SKYBOX * weight
+            continue
+        shader = shape.shader
+        if shader is None:
+            # a sphere set, the shader is the one of the sphere that was hit
+            shader = shape.shaders[shape.material_ids[triangle]]
+        if depth == 0:
+            first_t = t
+            if guides is not None:
+                point = ray.point_at_t(t)
+                normal = shape.normal_at(triangle, point, time) if triangle >= 0 else shape.normal(point, time)
+                guides[:] = shader.color.array() + normal.array()
+        color += shader.color * weight
+        if shader.kind == REFLECTIVE:
+            point = ray.point_at_t(t)
+            normal = shape.normal_at(triangle, point, time) if triangle >= 0 else shape.normal(point, time)
+            dimension = BOUNCE_DIMENSION + BOUNCE_DIMENSIONS * depth + FUZZ_OFFSET
+            reflected_ray = Ray(point, ray.direction.reflect(normal) \
+                + Vec3(sampler.get(dimension), sampler.get(dimension + 1), sampler.get(dimension + 2)) * shader.fuzz)
+            stack.append((reflected_ray, weight * shader.k_secondary, depth + 1, None))
+            if INSTRUMENTATION:
+                COUNTERS['secondary_rays'] += 1
+        elif shader.kind == DIELECTRIC:
+            point = ray.point_at_t(t)
+            normal = shape.normal_at(triangle, point, time) if triangle >= 0 else shape.normal(point, time)
+            if shape is inside:
+                new_direction = ray.direction.refract(-normal, shader.k_refraction)
+                new_inside = None
+            else:
+                new_direction = ray.direction.refract(normal, 1/shader.k_refraction)
+                new_inside = shape
+            refracted_ray = Ray(point + new_direction * OBJ_NEAR, new_direction)
+            stack.append((refracted_ray, weight * shader.k_secondary, depth + 1, new_inside))
+            if INSTRUMENTATION:
+                COUNTERS['secondary_rays'] += 1
 
+    return color, first_t
 
-def occlusion(ray, point_of_intersection, shapes, light, time):
+def occlusion(ray, point_of_intersection, shapes, light, time, jitter, normal=None, light_index=None):
+    # jitter holds the 3 sample values that move the light around in its OCCLUSION_JITTER box. with an
+    # OCCLUSION_CACHE, the normal at the hit and the index of the light key the entry of the hit point
     k_occlusions = []
-    ray_to_light = Ray(ray.point_at_t(point_of_intersection),
-    light.position - ray.point_at_t(point_of_intersection) + Vec3(random.random(), random.random(), random.random()) * OCCLUSION_JITTER)
+    to_light = light.position - ray.point_at_t(point_of_intersection) + jitter * OCCLUSION_JITTER
+    ray_to_light = Ray(ray.point_at_t(point_of_intersection), to_light)
+    cache = OCCLUSION_CACHE if normal is not None else None
+    if cache is not None:
+        key = cache.key(ray_to_light.start, normal, light_index)
+        blocked = cache.lookup(key)
+        if blocked is not None:
+            return blocked * MIN_OCCLUSION + (1 - blocked) * (1 + min(0, ray_to_light.direction.dot(ray.direction)))
+    light_distance = to_light.lenght()
+    if INSTRUMENTATION:
+        COUNTERS['shadow_rays'] += 1
+    if RECORDER is not None:
+        RECORDER.ray(ray_to_light, light_distance)
+    blockers = 0
     for shape in shapes:
-        if intersects(ray_to_light, shape, shapes, time, occlusion=True) > OBJ_NEAR:
+        if occluded(ray_to_light, shape, time, light_distance):
             k_occlusions.append(MIN_OCCLUSION)
+            blockers += 1
+            if RECORDER is not None:
+                RECORDER.contribution(shape)
         else:
             k_occlusions.append(1 + min(0, ray_to_light.direction.dot(ray.direction)))
+    if cache is not None:
+        cache.add(key, blockers / len(shapes))
     return mean(k_occlusions)
 
+def occluded(ray, shape, time, max_t):
+    # any-hit query: only tells whether something blocks the ray before max_t
+    if isinstance(shape, Sphere):
+        if INSTRUMENTATION:
+            COUNTERS['sphere_tests'] += 1
+        solution = sphere_solution(ray, shape, time)
+        return solution is not None and solution > OBJ_NEAR and solution < max_t
+    if isinstance(shape, SphereSet):
+        return sphere_set_any_hit(ray, shape, time, max_t)
+    return mesh_any_hit(ray, shape, time, max_t)
+
 #######################################
-### MAIN
+### NUMPY ENGINE
 #######################################
 
-def main():
-    random.seed(time.time())
-    # pegar arguments
-    parser = argparse.ArgumentParser()
-    parser.add_argument('output_file', type=str, help='arquivo de saida')
-    parser.add_argument('-width', type=int, help='largura do arquivo de saida')
-    parser.add_argument('-height', type=int, help='altura do arquivo de saida')
+class NumpyScene:
+    def __init__(self, shapes, point_lights):
+        self.shapes = shapes
+        self.point_lights = point_lights
+        self.sphere_indices = np.array([i for i, s in enumerate(shapes) if isinstance(s, Sphere)], dtype=int)
+        self.other_indices = [i for i, s in enumerate(shapes) if not isinstance(s, Sphere)]
+        # row of each shape in the sphere arrays, -1 for shapes that are not spheres
+        self.sphere_row = np.full(len(shapes), -1, dtype=int)
+        self.sphere_row[self.sphere_indices] = np.arange(len(self.sphere_indices))
+        # and in other_indices (and mesh_bounds), -1 for spheres
+        self.other_row = np.full(len(shapes), -1, dtype=int)
+        self.other_row[self.other_indices] = np.arange(len(self.other_indices))
+        spheres = [shapes[i] for i in self.sphere_indices]
 
-    args = parser.parse_args()
-    ouf = args.output_file
-    width = 480
-    height = 340
-    if args.width:
-        width = args.width
-    if args.height:
-        height = args.height
-    
+        self.center = np.array([s.center.array() for s in spheres], dtype=float).reshape(-1, 3)
+        self.speed = np.array([s.speed_vec.array() for s in spheres], dtype=float).reshape(-1, 3)
+        self.radius = np.array([s.radius for s in spheres], dtype=float)
+        # swept boxes of the meshes, so only the rays that can reach a mesh are traced through its BVH
+        self.mesh_bounds = np.array([shapes[k].swept_bounds() for k in self.other_indices], dtype=float).reshape(-1, 6)
+
+        # the compiled materials are tabulated by shape, so meshes go through the same wavefront as spheres.
+        # the palettes of the sphere sets follow, and set_shader_rows maps the spheres of a set to their rows
+        shaders = [s.shader or s.shaders[0] for s in shapes]
+        self.set_indices = [i for i, s in enumerate(shapes) if isinstance(s, SphereSet)]
+        self.set_shader_rows = {}
+        for k in self.set_indices:
+            self.set_shader_rows[k] = len(shaders) + np.asarray(shapes[k].material_ids, dtype=int)
+            shaders.extend(shapes[k].shaders)
+        self.kind = np.array([s.kind for s in shaders], dtype=int)
+        self.color = np.array([s.color.array() for s in shaders], dtype=float).reshape(-1, 3)
+        self.k_secondary = np.array([s.k_secondary for s in shaders], dtype=float)
+        self.fuzz = np.array([s.fuzz for s in shaders], dtype=float)
+        self.k_refraction = np.array([s.k_refraction for s in shaders], dtype=float)
+
+        self.light_positions = np.array([l.position.array() for l in point_lights], dtype=float).reshape(-1, 3)
+        self.light_table = LightTable(point_lights) if point_lights else None
+        self.skybox = np.array(SKYBOX.array(), dtype=float)
+        # the sphere sets are walked by whole batches of rays, on views of their arrays
+        self.sphere_sets = {k: NumpySphereSet(shapes[k]) for k in self.set_indices}
+
+# a round of a batched walk costs about the same for one ray as for a thousand, so once fewer rays than
+# this are still walking they finish ray by ray
+NP_WALK_MIN_RAYS = 16
+
+class NumpySphereSet:
+    # numpy views (no copies) of the flat arrays of a SphereSet and of its BVH, for the batched walks of
+    # np_sphere_set_closest_hit and np_sphere_set_blocked
+    def __init__(self, sphere_set):
+        self.shape = sphere_set
+        bvh = sphere_set.bvh
+        self.bounds = np.asarray(bvh.bounds).reshape(-1, 6)
+        self.nodes = np.asarray(bvh.nodes).reshape(-1, 2)
+        self.primitives = np.asarray(bvh.primitives)
+        self.centers = np.asarray(sphere_set.centers).reshape(-1, 3)
+        self.speeds = np.asarray(sphere_set.speeds).reshape(-1, 3)
+        self.radii = np.asarray(sphere_set.radii)
+        self.leaf_size = int(self.nodes[:, 1].max())
+        # a walk pops one node and pushes at most two, so a stack never holds more than one node per level
+        # of the hierarchy, plus the subtrees it starts from. the hierarchy of a shared scene does not carry
+        # its depth, it is counted level by level
+        self.depth = 0
+        level = np.zeros(1, dtype=int)
+        while len(level):
+            self.depth += 1
+            inner = level[self.nodes[level, 1] == 0]
+            level = np.concatenate([self.nodes[inner, 0], self.nodes[inner, 0] + 1])
+
+    def entries(self, nodes, origins, inverse):
+        # slab test of every ray against the box of its node, or of each of its nodes when nodes has a column
+        # per box: the entry distance, inf where the ray misses
+        box = self.bounds[nodes]
+        if nodes.ndim == 2:
+            origins, inverse = origins[:, None], inverse[:, None]
+        t1 = (box[..., :3] - origins) * inverse
+        t2 = (box[..., 3:] - origins) * inverse
+        lower = np.minimum(t1, t2)
+        upper = np.maximum(t1, t2)
+        # the reductions over the 3 axes spelled out, a reduce over such a short axis is slower
+        near = np.maximum(np.maximum(np.maximum(lower[..., 0], lower[..., 1]), lower[..., 2]), 0)
+        far = np.minimum(np.minimum(upper[..., 0], upper[..., 1]), upper[..., 2])
+        return np.where(far >= near, near, np.inf)
+
+    def leaf_spheres(self, first, count):
+        # the spheres of every leaf in a row of leaf_size slots, and which slots are in the leaf
+        slots = np.arange(self.leaf_size)
+        in_leaf = slots < count[:, None]
+        return self.primitives[np.where(in_leaf, first[:, None] + slots, 0)], in_leaf
+
+    def roots(self, k, origins, directions, a, times):
+        # both roots of the ray/sphere equation of every ray against its spheres k, and where they exist.
+        # the operations are the ones of sphere_set_closest_hit, in the same order, so the roots are the same
+        ox = origins[..., 0] - (self.centers[k, 0] + self.speeds[k, 0] * times)
+        oy = origins[..., 1] - (self.centers[k, 1] + self.speeds[k, 1] * times)
+        oz = origins[..., 2] - (self.centers[k, 2] + self.speeds[k, 2] * times)
+        b = 2 * (ox * directions[..., 0] + oy * directions[..., 1] + oz * directions[..., 2])
+        c = ox * ox + oy * oy + oz * oz - self.radii[k] * self.radii[k]
+        discriminant = b * b - 4 * a * c
+        root = np.sqrt(np.maximum(discriminant, 0))
+        s1 = (-b - root) / (2 * a)
+        s2 = (-b + root) / (2 * a)
+        return np.minimum(s1, s2), np.maximum(s1, s2), discriminant > OBJ_NEAR
+
+def np_dot(a, b):
+    return np.einsum('ij,ij->i', a, b)
+
+def np_normalize(v):
+    lenght = np.sqrt(np_dot(v, v))[:, None]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(lenght > 0, v / lenght, 0.0)
+
+def np_to_vec3(v):
+    return Vec3(float(v[0]), float(v[1]), float(v[2]))
+
+def np_box_entry(box, origins, directions):
+    # slab test of many rays against one box: the entry distance, or inf where the ray misses it
+    with np.errstate(divide='ignore'):
+        inverse = np.where(directions == 0, 1e30, 1 / np.where(directions == 0, 1, directions))
+    t1 = (box[:3] - origins) * inverse
+    t2 = (box[3:] - origins) * inverse
+    t_near = np.maximum(np.minimum(t1, t2).max(axis=1), 0)
+    t_far = np.maximum(t1, t2).min(axis=1)
+    return np.where(t_far >= t_near, t_near, np.inf)
+
+def np_inverse_direction(directions):
+    with np.errstate(divide='ignore'):
+        return np.where(directions == 0, 1e30, 1 / np.where(directions == 0, 1, directions))
+
+def np_sphere_set_closest_hit(sphere_set, origins, directions, times, from_inside, closest_t, roots=None):
+    # sphere_set_closest_hit for a batch of rays: each ray has a stack of its own and walks the hierarchy
+    # nearer child first, and every round pops one node of every ray that still has some, so the rays go
+    # down together and the tests of a round are done as arrays. closest_t holds the distance each ray has
+    # to beat and is lowered in place; returns the index of the sphere hit by each ray, -1 for none
+    n = len(origins)
+    inverse = np_inverse_direction(directions)
+    a = directions[:, 0] * directions[:, 0] + directions[:, 1] * directions[:, 1] + directions[:, 2] * directions[:, 2]
+    hit = np.full(n, -1, dtype=int)
+    starts = np.array([0] if roots is None else list(roots), dtype=int)
+    # the stacks of all the rays in one flat array, capacity slots per ray
+    capacity = sphere_set.depth + len(starts) + 1
+    stack_nodes = np.zeros(n * capacity, dtype=int)
+    stack_t = np.zeros(n * capacity)
+    base = np.arange(n) * capacity
+    size = np.zeros(n, dtype=int)
+    boxes = len(starts) * n
+    spheres = 0
+
+    # the subtrees to start from go in farther first, as in root_stack
+    entries = sphere_set.entries(np.broadcast_to(starts, (n, len(starts))), origins, inverse)
+    order = np.argsort(-entries, axis=1, kind='stable')
+    for column in range(len(starts)):
+        node_entries = np.take_along_axis(entries, order[:, column:column + 1], axis=1)[:, 0]
+        rays = np.flatnonzero(node_entries < closest_t)
+        stack_nodes[base[rays] + size[rays]] = starts[order[rays, column]]
+        stack_t[base[rays] + size[rays]] = node_entries[rays]
+        size[rays] += 1
+
+    active = np.flatnonzero(size)
+    while len(active):
+        if len(active) < NP_WALK_MIN_RAYS:
+            # the walk ray by ray starts over, and only a sphere nearer than the ones found so far counts
+            for r in active.tolist():
+                ray = Ray(np_to_vec3(origins[r]), np_to_vec3(directions[r]))
+                hit_t, k = sphere_set_closest_hit(ray, sphere_set.shape, float(times[r]), bool(from_inside[r]), roots)
+                if k >= 0 and hit_t < closest_t[r]:
+                    closest_t[r], hit[r] = hit_t, k
+            break
+        size[active] -= 1
+        top = base[active] + size[active]
+        rays = active[stack_t[top] < closest_t[active]]
+        first, count = sphere_set.nodes[stack_nodes[top[stack_t[top] < closest_t[active]]]].T
+        leaf = count > 0
+
+        if leaf.any():
+            # every slot of the leaves against its ray, a ray pops one node per round so it has one row
+            leaf_rays = rays[leaf]
+            k, in_leaf = sphere_set.leaf_spheres(first[leaf], count[leaf])
+            spheres += int(count[leaf].sum())
+            near, far, valid = sphere_set.roots(k, origins[leaf_rays, None], directions[leaf_rays, None], a[leaf_rays, None],
+                times[leaf_rays, None])
+            t = np.where(from_inside[leaf_rays, None] & (near <= OBJ_NEAR), far, near)
+            t = np.where(valid & in_leaf & (t >= OBJ_NEAR), t, np.inf)
+            # the first sphere of the leaf wins a tie, like the strict comparison of the walk ray by ray
+            column = t.argmin(axis=1)
+            t = t[np.arange(len(t)), column]
+            nearer = t < closest_t[leaf_rays]
+            closest_t[leaf_rays[nearer]] = t[nearer]
+            hit[leaf_rays[nearer]] = k[nearer, column[nearer]]
+
+        rays, first = rays[~leaf], first[~leaf]
+        boxes += 2 * len(rays)
+        left, right = sphere_set.entries(first[:, None] + [0, 1], origins[rays], inverse[rays]).T
+        # the farther child goes first so the nearer one is popped first, the right one on a tie
+        left_first = left >= right
+        far_nodes, far_t = np.where(left_first, first, first + 1), np.where(left_first, left, right)
+        near_nodes, near_t = np.where(left_first, first + 1, first), np.where(left_first, right, left)
+        far_valid = far_t < closest_t[rays]
+        near_valid = near_t < closest_t[rays]
+        slots = base[rays] + size[rays]
+        stack_nodes[slots[far_valid]] = far_nodes[far_valid]
+        stack_t[slots[far_valid]] = far_t[far_valid]
+        slots += far_valid
+        stack_nodes[slots[near_valid]] = near_nodes[near_valid]
+        stack_t[slots[near_valid]] = near_t[near_valid]
+        size[rays] += far_valid.astype(int) + near_valid
+        active = active[size[active] > 0]
+
+    if INSTRUMENTATION:
+        COUNTERS['box_tests'] += boxes
+        COUNTERS['sphere_tests'] += spheres
+    return hit
+
+def np_sphere_set_blocked(sphere_set, points, to_light, times, light_distance):
+    # sphere_set_any_hit for a batch of shadow rays, walked like np_sphere_set_closest_hit: a ray leaves
+    # the walk at the first sphere it hits before its light
+    n = len(points)
+    inverse = np_inverse_direction(to_light)
+    a = to_light[:, 0] * to_light[:, 0] + to_light[:, 1] * to_light[:, 1] + to_light[:, 2] * to_light[:, 2]
+    blocked = np.zeros(n, dtype=bool)
+    capacity = sphere_set.depth + 2
+    stack_nodes = np.zeros(n * capacity, dtype=int)
+    base = np.arange(n) * capacity
+    size = (sphere_set.entries(np.zeros(n, dtype=int), points, inverse) <= light_distance).astype(int)
+    boxes = n
+    spheres = 0
+    exits = 0
+
+    active = np.flatnonzero(size)
+    while len(active):
+        if len(active) < NP_WALK_MIN_RAYS:
+            for r in active.tolist():
+                ray_to_light = Ray(np_to_vec3(points[r]), np_to_vec3(to_light[r]))
+                blocked[r] = sphere_set_any_hit(ray_to_light, sphere_set.shape, float(times[r]), light_distance[r])
+            break
+        size[active] -= 1
+        first, count = sphere_set.nodes[stack_nodes[base[active] + size[active]]].T
+        leaf = count > 0
+
+        if leaf.any():
+            leaf_rays = active[leaf]
+            k, in_leaf = sphere_set.leaf_spheres(first[leaf], count[leaf])
+            spheres += int(count[leaf].sum())
+            near, far, valid = sphere_set.roots(k, points[leaf_rays, None], to_light[leaf_rays, None], a[leaf_rays, None],
+                times[leaf_rays, None])
+            hits = leaf_rays[(valid & in_leaf & (near > OBJ_NEAR) & (near < light_distance[leaf_rays, None])).any(axis=1)]
+            blocked[hits] = True
+            size[hits] = 0
+            exits += len(hits)
+
+        rays, first = active[~leaf], first[~leaf]
+        boxes += 2 * len(rays)
+        entries = sphere_set.entries(first[:, None] + [0, 1], points[rays], inverse[rays])
+        # the right child goes first so the left one is popped first, as ray by ray
+        right_valid = entries[:, 1] <= light_distance[rays]
+        left_valid = entries[:, 0] <= light_distance[rays]
+        slots = base[rays] + size[rays]
+        stack_nodes[slots[right_valid]] = first[right_valid] + 1
+        slots += right_valid
+        stack_nodes[slots[left_valid]] = first[left_valid]
+        size[rays] += right_valid.astype(int) + left_valid
+        active = active[size[active] > 0]
+
+    if INSTRUMENTATION:
+        COUNTERS['box_tests'] += boxes
+        COUNTERS['sphere_tests'] += spheres
+        COUNTERS['shadow_early_exits'] += exits
+    return blocked
+
+def np_sphere_solutions(scene, origins, directions, times, inside=None, columns=None):
+    # one row per ray, one column per sphere, -1 where the ray misses. same root rule as sphere_solution,
+    # inside holds the shape each ray travels inside of (-1 for none). columns, when given, are the only
+    # spheres (rows of the sphere arrays) tested
+    if columns is None:
+        columns = slice(None)
+    centers = scene.center[None, columns, :] + scene.speed[None, columns, :] * times[:, None, None]
+    oc = origins[:, None, :] - centers
+    a = np_dot(directions, directions)[:, None]
+    b = 2 * np.einsum('ijk,ik->ij', oc, directions)
+    c = np.einsum('ijk,ijk->ij', oc, oc) - scene.radius[None, columns] ** 2
+    discriminant = b * b - 4 * a * c
+    root = np.sqrt(np.maximum(discriminant, 0))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        near = np.minimum((-b - root) / (2 * a), (-b + root) / (2 * a))
+        far = np.maximum((-b - root) / (2 * a), (-b + root) / (2 * a))
+    solution = near
+    if inside is not None:
+        from_inside = (inside[:, None] == scene.sphere_indices[None, columns]) & (near <= OBJ_NEAR)
+        solution = np.where(from_inside, far, near)
+    return np.where(discriminant > OBJ_NEAR, solution, -1.0)
+
+def np_closest_hit(scene, origins, directions, times, inside, visible=None, roots=None):
+    # returns t (inf on a miss), the shape index (-1 on a miss) and the triangle or sphere index for hits
+    # on meshes and sphere sets. visible (shape indices) and roots (frontiers by shape index) restrict the
+    # shapes and the subtrees of their hierarchies tested to the ones of a packet
+    n = len(origins)
+    t = np.full(n, np.inf)
+    index = np.full(n, -1, dtype=int)
+    triangle = np.full(n, -1, dtype=int)
+    if visible is None:
+        columns, spheres, others = None, scene.sphere_indices, scene.other_indices
+    else:
+        columns = scene.sphere_row[visible]
+        columns = columns[columns >= 0]
+        spheres, others = scene.sphere_indices[columns], [k for k in visible if scene.sphere_row[k] < 0]
+    if len(spheres):
+        solutions = np_sphere_solutions(scene, origins, directions, times, inside, columns)
+        if INSTRUMENTATION:
+            COUNTERS['sphere_tests'] += solutions.size
+        solutions[solutions < OBJ_NEAR] = np.inf
+        column = solutions.argmin(axis=1)
+        t = solutions[np.arange(n), column]
+        index = np.where(np.isinf(t), -1, spheres[column])
+    t[t >= VISION_RANGE] = np.inf
+
+    # the rays that enter the swept box of a sphere set before the closest hit so far walk its hierarchy
+    # together, meshes are traced ray by ray
+    for k in others:
+        shape = scene.shapes[k]
+        shape_roots = None if roots is None else roots.get(k)
+        rays = np.flatnonzero(np_box_entry(scene.mesh_bounds[scene.other_row[k]], origins, directions) < t)
+        if k in scene.sphere_sets:
+            closest_t = np.minimum(t[rays], VISION_RANGE)
+            spheres = np_sphere_set_closest_hit(scene.sphere_sets[k], origins[rays], directions[rays], times[rays],
+                inside[rays] == k, closest_t, shape_roots)
+            found = spheres >= 0
+            rays = rays[found]
+            t[rays], index[rays], triangle[rays] = closest_t[found], k, spheres[found]
+            continue
+        for r in rays:
+            ray = Ray(np_to_vec3(origins[r]), np_to_vec3(directions[r]))
+            hit_t, hit_triangle = mesh_closest_hit(ray, shape, float(times[r]), shape_roots)
+            if hit_triangle >= 0 and hit_t >= OBJ_NEAR and hit_t < t[r]:
+                t[r], index[r], triangle[r] = hit_t, k, hit_triangle
+    return t, index, triangle
+
+def np_packets_closest_hit(scene, origins, directions, times, inside, labels, packets):
+    # np_closest_hit of primary rays packet by packet. labels holds the packet of every ray, packets the
+    # visible shapes and the frontiers (see PacketFrustum.cull) of each
+    t = np.full(len(origins), np.inf)
+    index = np.full(len(origins), -1, dtype=int)
+    triangle = np.full(len(origins), -1, dtype=int)
+    for p, (visible, roots) in enumerate(packets):
+        rays = np.flatnonzero(labels == p)
+        if len(rays):
+            t[rays], index[rays], triangle[rays] = np_closest_hit(scene, origins[rays], directions[rays], times[rays], inside[rays], visible, roots)
+    return t, index, triangle
+
+def np_evaluate(scene, origins, directions, times, options, draw, guides=None, packets=None):
+    # wavefront version of evaluate_ray: every primary ray owns at most one secondary ray per bounce,
+    # so each bounce is one batch of rays that add their weighted terms to the color of their owner.
+    # draw(owner, dimension, count) returns the sample values of the primary rays in owner. guides, when
+    # given, gets the color of the material and the normal at the first hit of every primary ray.
+    # packets, when given, is the packet of every primary ray and the table of np_packets_closest_hit
+    n = len(origins)
+    colors = np.zeros((n, 3))
+    first_t = np.full(n, np.inf)
+    owner = np.arange(n)
+    weight = np.ones(n)
+    inside = np.full(n, -1, dtype=int)
+
+    for depth in range(options.max_depth + 1):
+        if not len(owner):
+            break
+        if depth > options.roulette_depth:
+            # russian roulette: dim paths are dropped, survivors are scaled up to stay unbiased
+            survival = np.minimum(1.0, weight)
+            alive = draw(owner, BOUNCE_DIMENSION + BOUNCE_DIMENSIONS * depth + ROULETTE_OFFSET) < survival
+            weight = weight[alive] / survival[alive]
+            origins, directions, times, owner, inside = origins[alive], directions[alive], times[alive], owner[alive], inside[alive]
+
+        if depth == 0 and packets is not None:
+            t, index, triangle = np_packets_closest_hit(scene, origins, directions, times, inside, packets[0][owner], packets[1])
+        else:
+            t, index, triangle = np_closest_hit(scene, origins, directions, times, inside)
+        if RECORDER is not None:
+            RECORDER.np_rays(RECORDER.pixels[owner], origins, directions, np.minimum(t, VISION_RANGE), index)
+        if depth == 0:
+            first_t = t.copy()
+        miss = index < 0
+        if INSTRUMENTATION:
+            DEPTH_HISTOGRAM[depth] = DEPTH_HISTOGRAM.get(depth, 0) + len(owner)
+            COUNTERS['hits'] += len(owner) - int(miss.sum())
+        colors[owner[miss]] += scene.skybox * weight[miss][:, None]
+
+        hit = ~miss
+        index, triangle, t, weight, owner, inside = index[hit], triangle[hit], t[hit], weight[hit], owner[hit], inside[hit]
+        d, times = directions[hit], times[hit]
+        points = origins[hit] + d * t[:, None]
+        normals = np.empty_like(points)
+        sphere = triangle < 0
+        rows = scene.sphere_row[index[sphere]]
+        normals[sphere] = np_normalize(points[sphere] - scene.center[rows] - scene.speed[rows] * times[sphere][:, None])
+        for r in np.flatnonzero(~sphere):
+            normals[r] = scene.shapes[index[r]].normal_at(triangle[r], np_to_vec3(points[r]), float(times[r])).array()
+        # row of the material tables, the shape's own except for the spheres of sphere sets
+        shader = index.copy()
+        for k in scene.set_indices:
+            in_set = index == k
+            shader[in_set] = scene.set_shader_rows[k][triangle[in_set]]
+        kind = scene.kind[shader]
+        colors[owner] += scene.color[shader] * weight[:, None]
+        if depth == 0 and guides is not None:
+            guides[owner] = np.column_stack([scene.color[shader], normals])
+
+        # cover reflective materials
+        reflective = kind == REFLECTIVE
+        s = shader[reflective]
+        rd = d[reflective]
+        reflected = rd - normals[reflective] * (2 * np_dot(rd, normals[reflective]))[:, None] \
+            + draw(owner[reflective], BOUNCE_DIMENSION + BOUNCE_DIMENSIONS * depth + FUZZ_OFFSET, 3) * scene.fuzz[s][:, None]
+        reflected_rays = (points[reflective], np_normalize(reflected), times[reflective], owner[reflective],
+            weight[reflective] * scene.k_secondary[s], np.full(len(s), -1, dtype=int))
+
+        # cover dielectric materials
+        dielectric = kind == DIELECTRIC
+        s = shader[dielectric]
+        leaving = inside[dielectric] == index[dielectric]
+        dielectric_normals = np.where(leaving[:, None], -normals[dielectric], normals[dielectric])
+        with np.errstate(divide='ignore'):
+            ni_over_nt = np.where(leaving, scene.k_refraction[s], 1 / scene.k_refraction[s])
+        new_directions = np_normalize(np_refract(d[dielectric], dielectric_normals, ni_over_nt))
+        refracted_rays = (points[dielectric] + new_directions * OBJ_NEAR, new_directions, times[dielectric], owner[dielectric],
+            weight[dielectric] * scene.k_secondary[s], np.where(leaving, -1, index[dielectric]))
+
+        origins, directions, times, owner, weight, inside = \
+            [np.concatenate(arrays) for arrays in zip(reflected_rays, refracted_rays)]
+        if INSTRUMENTATION:
+            COUNTERS['secondary_rays'] += len(owner)
+
+    # rays still bouncing after the last allowed depth see the sky
+    colors[owner] += scene.skybox * weight[:, None]
+    return colors, first_t
+
+def np_refract(directions, normals, ni_over_nt):
+    unit_v = np_normalize(directions)
+    cosine = np_dot(unit_v, normals)
+    discriminant = 1 - ni_over_nt * ni_over_nt * (1 - cosine * cosine)
+    refracted = (unit_v - normals * cosine[:, None]) * ni_over_nt[:, None] - normals * np.sqrt(np.maximum(discriminant, 0))[:, None]
+    reflected = directions - normals * (2 * np_dot(directions, normals))[:, None]
+    return np.where((discriminant > 0)[:, None], refracted, reflected)
+
+def np_blocked(scene, points, to_light, light_distance, times):
+    # (n, shapes) matrix of the shapes that block every shadow ray before it reaches its light
+    n = len(points)
+    if INSTRUMENTATION:
+        COUNTERS['shadow_rays'] += n
+    blocked = np.zeros((n, len(scene.shapes)), dtype=bool)
+    if len(scene.sphere_indices):
+        solutions = np_sphere_solutions(scene, points, to_light, times)
+        blocked[:, scene.sphere_indices] = (solutions > OBJ_NEAR) & (solutions < light_distance[:, None])
+        if INSTRUMENTATION:
+            COUNTERS['sphere_tests'] += solutions.size
+    for m, k in enumerate(scene.other_indices):
+        rays = np.flatnonzero(np_box_entry(scene.mesh_bounds[m], points, to_light) < light_distance)
+        if k in scene.sphere_sets:
+            blocked[rays, k] = np_sphere_set_blocked(scene.sphere_sets[k], points[rays], to_light[rays], times[rays], light_distance[rays])
+            continue
+        for r in rays:
+            ray_to_light = Ray(np_to_vec3(points[r]), np_to_vec3(to_light[r]))
+            blocked[r, k] = occluded(ray_to_light, scene.shapes[k], float(times[r]), light_distance[r])
+    return blocked
+
+def np_occlusion(scene, origins, directions, t, times, jitter, light_samples=None, pick=None, normals=None):
+    # jitter(slot) returns the (n, 3) sample values that move the light of a slot in its OCCLUSION_JITTER box.
+    # slot l is light l, or with light_samples there are that many slots and pick(slot) returns the index of
+    # the light every ray picked from the LightTable, and its weight. with an OCCLUSION_CACHE the normals at
+    # the hits key the entries of the hit points, and only the rays without a ready entry are traced
+    n = len(origins)
+    points = origins + directions * t[:, None]
+    occlusions = np.zeros(n)
+    cache = OCCLUSION_CACHE if normals is not None else None
+    slots = len(scene.light_positions) if light_samples is None else light_samples
+    for slot in range(slots):
+        if light_samples is None:
+            lights, weight = slot, 1.0
+        else:
+            lights, weight = pick(slot)
+        to_light = scene.light_positions[lights] - points + jitter(slot) * OCCLUSION_JITTER
+        light_distance = np.sqrt(np_dot(to_light, to_light))
+        to_light = np_normalize(to_light)
+        facing = 1 + np.minimum(0, np_dot(to_light, directions))
+        if cache is None:
+            blocked = np_blocked(scene, points, to_light, light_distance, times)
+            if RECORDER is not None:
+                RECORDER.np_rays(RECORDER.pixels, points, to_light, light_distance)
+                rows, blockers = np.nonzero(blocked)
+                RECORDER.np_contributions(RECORDER.pixels[rows], blockers)
+            occlusions += weight * np.where(blocked, MIN_OCCLUSION, facing[:, None]).mean(axis=1)
+            continue
+        keys = cache.np_key(points, normals, lights)
+        fractions = cache.np_lookup(keys)
+        missing = np.flatnonzero(np.isnan(fractions))
+        # the rays of the batch that are not needed to fill their entries read them once they are filled, and
+        # are only traced when the entry is still not ready (evicted, or filled with fewer rays by a race)
+        needed = cache.np_needed(keys[missing])
+        traced = missing[needed]
+        waiting = missing[~needed]
+        blocked = np_blocked(scene, points[traced], to_light[traced], light_distance[traced], times[traced])
+        cache.np_add(keys[traced], blocked.mean(axis=1))
+        terms = np.empty(n)
+        terms[traced] = np.where(blocked, MIN_OCCLUSION, facing[traced, None]).mean(axis=1)
+        fractions[waiting] = cache.np_lookup(keys[waiting])
+        late = waiting[np.isnan(fractions[waiting])]
+        blocked = np_blocked(scene, points[late], to_light[late], light_distance[late], times[late])
+        terms[late] = np.where(blocked, MIN_OCCLUSION, facing[late, None]).mean(axis=1)
+        ready = np.setdiff1d(np.arange(n), np.concatenate([traced, late]))
+        terms[ready] = fractions[ready] * MIN_OCCLUSION + (1 - fractions[ready]) * facing[ready]
+        occlusions += weight * terms
+    return occlusions / slots
+
+def np_trace_samples(scene, i, j, k, width, height, eye, up, right, ipc, lens_radius, options, sampler, rng):
+    # color (and guides) of sample k of pixel (i, j), one primary ray per entry of the arrays
+    n = len(k)
+    def draw(owner, dimension, count=None):
+        return sampler.np_get(rng, i[owner], j[owner], k[owner], dimension, count)
+    everyone = np.arange(n)
+    sqrt_dist_rays = math.sqrt(DISTRIBUTED_RAYS)
+    pattern = (k < DISTRIBUTED_RAYS) & sampler.pattern
+    # samples past the fixed pattern are jittered over the same footprint
+    offset_x = np.where(pattern, sqrt_dist_rays - (k % sqrt_dist_rays / sqrt_dist_rays), sqrt_dist_rays - draw(everyone, PIXEL_DIMENSION))
+    offset_y = np.where(pattern, sqrt_dist_rays - (k / sqrt_dist_rays / sqrt_dist_rays), sqrt_dist_rays - draw(everyone, PIXEL_DIMENSION + 1))
+    pixel_pos = ipc + (right * (j - width / 2 + offset_x)[:, None] + up * (height / 2 - i + offset_y)[:, None]) * PIXEL_SIZE
+    lens = np.zeros((n, 3))
+    lens[:, :2] = draw(everyone, LENS_DIMENSION, 2) * (ipc - pixel_pos)[:, :2] * PIXEL_SIZE * 10 * lens_radius
+    directions = np_normalize(pixel_pos - eye + lens)
+    origins = np.tile(eye, (n, 1))
+    times = draw(everyone, TIME_DIMENSION)
+    packets = None
+    if options.packet:
+        # one packet per block of options.packet x options.packet pixels with samples in the batch
+        size = options.packet
+        blocks, labels = np.unique(np.column_stack([i // size, j // size]), axis=0, return_inverse=True)
+        frustums = [PacketFrustum(range(top * size, (top + 1) * size), range(left * size, (left + 1) * size), width, height, eye, up, right, ipc, lens_radius)
+            for top, left in blocks.tolist()]
+        packets = (labels.reshape(-1), [frustum.cull(scene.shapes) for frustum in frustums])
+
+    if RECORDER is not None:
+        RECORDER.pixels = i * width + j
+    guides = np.tile(SKYBOX.array() + [0.0, 0.0, 0.0], (n, 1)) if options.denoise or OCCLUSION_CACHE is not None else None
+    colors, t = np_evaluate(scene, origins, directions, times, options, draw, guides, packets)
+    hit = np.isfinite(t)
+    if hit.any() and len(scene.light_positions):
+        if RECORDER is not None:
+            # np_occlusion only sees the rays that hit something
+            RECORDER.pixels = RECORDER.pixels[hit]
+        hit_rows = np.flatnonzero(hit)
+        jitter = lambda slot: draw(hit_rows, light_dimension(options, slot), 3)
+        normals = guides[hit, 3:6] if OCCLUSION_CACHE is not None else None
+        if options.samples_lights(len(scene.light_positions)):
+            pick = lambda slot: scene.light_table.np_pick(draw(hit_rows, light_dimension(options, slot) + LIGHT_PICK_OFFSET))
+            occlusions = np_occlusion(scene, origins[hit], directions[hit], t[hit], times[hit], jitter, options.light_samples, pick, normals)
+        else:
+            occlusions = np_occlusion(scene, origins[hit], directions[hit], t[hit], times[hit], jitter, normals=normals)
+        colors[hit] *= occlusions[:, None]
+    # the AUX_CHANNELS guides of every sample for the denoiser, None without it
+    aux = np.column_stack([guides, np.minimum(t, VISION_RANGE)]) if options.denoise else None
+    return colors, aux
+
+def trace_tile_numpy(scene, rows, columns, width, height, camera_eye, camera_up, camera_right, camera_front, focal_dist, aperture, framebuffer, options, sampler, pixels=None):
+    rng = np.random.default_rng([random.getrandbits(32), rows.start, columns.start])
+    eye = np.array(camera_eye.array(), dtype=float)
+    up = np.array(camera_up.array(), dtype=float)
+    right = np.array(camera_right.array(), dtype=float)
+    lens_radius = aperture / 2
+    ipc = eye + np.array(camera_front.array(), dtype=float) * focal_dist
+
+    # pixels in row-major order, or only the ones given (flat indices into the image)
+    if pixels is None:
+        pixel_i, pixel_j = np.meshgrid(np.arange(rows.start, rows.stop), np.arange(columns.start, columns.stop), indexing='ij')
+        pixel_i, pixel_j = pixel_i.ravel(), pixel_j.ravel()
+    else:
+        pixel_i, pixel_j = np.divmod(np.array(pixels, dtype=int), width)
+    count = len(pixel_i)
+    counts = np.zeros(count, dtype=int)
+    sums = np.zeros((count, 3))
+    squares = np.zeros((count, 3))
+    aux_sums = np.zeros((count, AUX_CHANNELS)) if options.denoise else None
+
+    # every round traces a batch of min_samples more rays for the pixels that have not converged, the first
+    # one enough for the convergence test. without adaptive sampling there is a single round of max_samples rays
+    batch = options.min_samples if options.adaptive() else options.max_samples
+    first_test = options.first_test(sampler.pattern)
+    round_size = max(batch, first_test)
+    active = np.arange(count)
+    while len(active):
+        samples = np.minimum(round_size, options.max_samples - counts[active])
+        round_size = batch
+        owner = np.repeat(active, samples)
+        k = counts[owner] + np.arange(len(owner)) - np.repeat(np.cumsum(samples) - samples, samples)
+        colors, aux = np_trace_samples(scene, pixel_i[owner], pixel_j[owner], k, width, height, eye, up, right, ipc, lens_radius, options, sampler, rng)
+        np.add.at(sums, owner, colors)
+        if aux is not None:
+            np.add.at(aux_sums, owner, aux)
+        np.add.at(squares, owner, colors * colors)
+        counts[active] += samples
+
+        n = counts[active][:, None]
+        variance = (squares[active] - sums[active] ** 2 / n) / np.maximum(n - 1, 1) / n
+        converged = (n[:, 0] >= first_test) & (variance.max(axis=1) < options.variance_threshold)
+        active = active[~converged & (counts[active] < options.max_samples)]
+
+    for count, pixel_count in zip(*np.unique(counts, return_counts=True)):
+        SAMPLE_HISTOGRAM[int(count)] = SAMPLE_HISTOGRAM.get(int(count), 0) + int(pixel_count)
+    colors = (sums / counts[:, None]).tolist()
+    aux = (aux_sums / counts[:, None]).tolist() if aux_sums is not None else [None] * count
+    if pixels is None:
+        framebuffer.write_tile(rows, columns, [c for color in colors for c in color],
+            [a for values in aux for a in values] if aux_sums is not None else None)
+    else:
+        for i, j, color, values in zip(pixel_i.tolist(), pixel_j.tolist(), colors, aux):
+            framebuffer.write_tile(range(i, i + 1), range(j, j + 1), color, values)
+
+#######################################
+### SHARED SCENE
+#######################################
+
+MATERIAL_PARAMS = {
+    'lambert': ('k_diffuse',),
+    'reflective': ('k_reflectance', 'fuzz'),
+    'dielectric': ('k_refraction', 'k_attenuation'),
+    'phong': ('shading', 'k_specular'),
+}
+MATERIAL_STRIDE = 6
+SPHERE_STRIDE = 8
+MESH_STRIDE = 12
+LIGHT_STRIDE = 6
+
+class SharedScene:
+    # the whole scene packed once into a shared memory block. only the block name and the layout
+    # (offset, typecode and lenght of each segment) are pickled to the workers, which rebuild the
+    # shapes on top of memoryviews into the block instead of receiving their own copy
+    def __init__(self, shapes, point_lights):
+        materials = []
+        material_ids = {}
+        def material_id(material):
+            if id(material) not in material_ids:
+                material_ids[id(material)] = len(materials)
+                materials.append(material)
+            return material_ids[id(material)]
+
+        # meshes sharing their arrays (mesh instances, or the same geometry loaded once) share their segments too
+        geometry_ids = {}
+        segments = {}
+        shape_table = array('i')
+        sphere_table = array('d')
+        mesh_table = array('d')
+        set_count = 0
+        for shape in shapes:
+            if isinstance(shape, Sphere):
+                shape_table.extend((0, len(sphere_table) // SPHERE_STRIDE))
+                sphere_table.extend(shape.center.array() + [shape.radius] + shape.speed_vec.array() + [material_id(shape.material)])
+            elif isinstance(shape, SphereSet):
+                # the set's arrays and BVH as they are, plus its palette as ids into the material table
+                prefix = 'set' + str(set_count) + '.'
+                shape_table.extend((3, set_count))
+                set_count += 1
+                for key, typecode in SPHERE_SET_ARRAYS:
+                    segments[prefix + key] = getattr(shape, key)
+                for key, typecode in BVH_ARRAYS:
+                    segments[prefix + 'bvh_' + key] = getattr(shape.bvh, key)
+                segments[prefix + 'materials'] = array('i', [material_id(material) for material in shape.materials])
+            else:
+                shape_table.extend((2 if isinstance(shape, MeshInstance) else 1, len(mesh_table) // MESH_STRIDE))
+                if id(shape.vertices) not in geometry_ids:
+                    g = geometry_ids[id(shape.vertices)] = len(geometry_ids)
+                    for key, typecode in MESH_ARRAYS:
+                        segments['mesh' + str(g) + '.' + key] = getattr(shape, key)
+                    for key, typecode in BVH_ARRAYS:
+                        segments['mesh' + str(g) + '.bvh_' + key] = getattr(shape.bvh, key)
+                mesh_table.extend(shape.speed_vec.array() + [material_id(shape.material), geometry_ids[id(shape.vertices)]])
+                # the transform of an instance, an identity placeholder for a plain mesh
+                if isinstance(shape, MeshInstance):
+                    mesh_table.extend(shape.position.array() + [shape.scale] + shape.rotation.array())
+                else:
+                    mesh_table.extend([0, 0, 0, 1, 0, 0, 0])
+
+        material_table = array('d')
+        for material in materials:
+            params = [getattr(material, name, None) for name in MATERIAL_PARAMS[material.type]]
+            params = [math.nan if value is None else value for value in params]
+            material_table.extend([MATERIAL_TYPES.index(material.type)] + material.albedo.array() + params + [math.nan] * (2 - len(params)))
+        light_table = array('d')
+        for light in point_lights:
+            light_table.extend(light.position.array() + light.color.array())
+
+        segments['shapes'] = shape_table
+        segments['spheres'] = sphere_table
+        segments['meshes'] = mesh_table
+        segments['materials'] = material_table
+        segments['lights'] = light_table
+
+        # 8 byte aligned segments, one after the other
+        self.layout = {}
+        size = 0
+        for key, data in segments.items():
+            # meshes loaded from the cache hold memoryviews instead of arrays
+            typecode = data.typecode if isinstance(data, array) else data.format
+            self.layout[key] = (size, typecode, len(data))
+            size += (len(data) * data.itemsize + 7) // 8 * 8
+        self.size = size
+        self.shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        self.name = self.shm.name
+        for key, data in segments.items():
+            view = self.view(self.shm, key)
+            view[:] = data
+            view.release()
+
+    def __getstate__(self):
+        return {'name': self.name, 'layout': self.layout, 'size': self.size}
+
+    def view(self, shm, key):
+        offset, typecode, lenght = self.layout[key]
+        return shm.buf[offset:offset + lenght * array(typecode).itemsize].cast(typecode)
+
+    def attach(self):
+        # the handle is kept in the scene object so the views stay valid while the worker runs
+        shm = self.attached = shared_memory.SharedMemory(name=self.name)
+        materials = []
+        material_table = self.view(shm, 'materials')
+        for k in range(0, len(material_table), MATERIAL_STRIDE):
+            material_type = MATERIAL_TYPES[int(material_table[k])]
+            params = {}
+            for l, name in enumerate(MATERIAL_PARAMS[material_type]):
+                value = material_table[k + 4 + l]
+                params[name] = None if math.isnan(value) else value
+            albedo = Vec3(material_table[k + 1], material_table[k + 2], material_table[k + 3])
+            materials.append(Material(type=material_type, albedo=albedo, **params))
+
+        spheres = self.view(shm, 'spheres')
+        meshes = self.view(shm, 'meshes')
+        geometries = {}
+        shapes = []
+        shape_table = self.view(shm, 'shapes')
+        for k in range(0, len(shape_table), 2):
+            kind, index = shape_table[k], shape_table[k + 1]
+            if kind == 0:
+                b = index * SPHERE_STRIDE
+                shapes.append(Sphere(Vec3(spheres[b], spheres[b + 1], spheres[b + 2]), spheres[b + 3],
+                    materials[int(spheres[b + 7])], speed_vec=Vec3(spheres[b + 4], spheres[b + 5], spheres[b + 6])))
+            elif kind == 3:
+                prefix = 'set' + str(index) + '.'
+                sphere_set = SphereSet.__new__(SphereSet)
+                for key, typecode in SPHERE_SET_ARRAYS:
+                    setattr(sphere_set, key, self.view(shm, prefix + key))
+                sphere_set.bvh = bvh_from_arrays(*[self.view(shm, prefix + 'bvh_' + key) for key, typecode in BVH_ARRAYS])
+                sphere_set.materials = [materials[k] for k in self.view(shm, prefix + 'materials')]
+                sphere_set.material = None
+                sphere_set.speed_vec = Vec3()
+                shapes.append(sphere_set)
+            else:
+                b = index * MESH_STRIDE
+                g = int(meshes[b + 4])
+                if g not in geometries:
+                    prefix = 'mesh' + str(g) + '.'
+                    geometry = geometries[g] = Mesh.__new__(Mesh)
+                    for key, typecode in MESH_ARRAYS:
+                        setattr(geometry, key, self.view(shm, prefix + key))
+                    geometry.bvh = bvh_from_arrays(*[self.view(shm, prefix + 'bvh_' + key) for key, typecode in BVH_ARRAYS])
+                material = materials[int(meshes[b + 3])]
+                speed_vec = Vec3(meshes[b], meshes[b + 1], meshes[b + 2])
+                if kind == 2:
+                    mesh = MeshInstance(geometries[g], material, Vec3(meshes[b + 5], meshes[b + 6], meshes[b + 7]), meshes[b + 8],
+                        Vec3(meshes[b + 9], meshes[b + 10], meshes[b + 11]), speed_vec=speed_vec)
+                else:
+                    mesh = Mesh.__new__(Mesh)
+                    mesh.__dict__.update(geometries[g].__dict__)
+                    mesh.material = material
+                    mesh.speed_vec = speed_vec
+                shapes.append(mesh)
+
+        lights = self.view(shm, 'lights')
+        point_lights = [PointLight(vec3_at(lights, 2 * k), vec3_at(lights, 2 * k + 1)) for k in range(len(lights) // LIGHT_STRIDE)]
+        return shapes, point_lights
+
+    def payload(self):
+        # a copy of the block, what the workers of a render farm rebuild the scene from (see shared_scene_from_payload)
+        return bytes(self.shm.buf[:self.size])
+
+    def unlink(self):
+        self.shm.close()
+        self.shm.unlink()
+
+#######################################
+### IMAGE OUTPUT
+#######################################
+
+class Framebuffer:
+    # one byte per channel, or a float accumulation buffer (sum of passes) for progressive rendering.
+    # with aux it also keeps the AUX_CHANNELS guides of the denoiser of every pixel, as floats
+    def __init__(self, width, height, accumulate=False, aux=False):
+        self.width = width
+        self.height = height
+        self.accumulate = accumulate
+        self.passes = 0
+        self.pixels = multiprocessing.Array('d' if accumulate else 'B', width * height * 3, lock=False)
+        self.aux = multiprocessing.Array('d', width * height * AUX_CHANNELS, lock=False) if aux else None
+
+    def write_tile(self, rows, columns, colors, aux=None):
+        # colors has 3 floats per pixel of the tile, row-major, and aux AUX_CHANNELS
+        n = len(columns) * 3
+        for r, i in enumerate(rows):
+            start = (i * self.width + columns.start) * 3
+            values = colors[r * n:(r + 1) * n]
+            if self.accumulate:
+                self.pixels[start:start + n] = [a + b for a, b in zip(self.pixels[start:start + n], values)]
+            else:
+                self.pixels[start:start + n] = [min(255, max(0, int(math.floor(c)))) for c in values]
+        if aux is not None and self.aux is not None:
+            n = len(columns) * AUX_CHANNELS
+            for r, i in enumerate(rows):
+                start = (i * self.width + columns.start) * AUX_CHANNELS
+                values = aux[r * n:(r + 1) * n]
+                if self.accumulate:
+                    values = [a + b for a, b in zip(self.aux[start:start + n], values)]
+                self.aux[start:start + n] = values
+
+    def tile_bytes(self, rows, columns):
+        # the bytes of a tile of a byte framebuffer, row-major, as the workers of a render farm send them
+        return b''.join(bytes(self.pixels[(i * self.width + columns.start) * 3:(i * self.width + columns.stop) * 3]) for i in rows)
+
+    def write_tile_bytes(self, rows, columns, data):
+        n = len(columns) * 3
+        for r, i in enumerate(rows):
+            start = (i * self.width + columns.start) * 3
+            self.pixels[start:start + n] = data[r * n:(r + 1) * n]
+
+    def row_bytes(self, i):
+        values = self.pixels[i * self.width * 3:(i + 1) * self.width * 3]
+        if self.accumulate:
+            passes = max(self.passes, 1)
+            return bytes(min(255, max(0, int(math.floor(v / passes)))) for v in values)
+        return bytes(values)
+
+class P3Writer:
+    def __init__(self, file_name, width, height):
+        self.file = open(file_name, 'w')
+        self.file.write('P3\n' + str(width) + ' ' + str(height) + '\n255\n')
+
+    def write_row(self, row):
+        self.file.write(' '.join(str(byte) for byte in row) + '\n')
+
+    def close(self):
+        self.file.close()
+
+class P6Writer:
+    def __init__(self, file_name, width, height):
+        self.file = open(file_name, 'wb')
+        self.file.write(('P6\n' + str(width) + ' ' + str(height) + '\n255\n').encode('ascii'))
+
+    def write_row(self, row):
+        self.file.write(row)
+
+    def close(self):
+        self.file.close()
+
+class PNGWriter:
+    # 8 bit RGB, no interlacing, every row with filter type 0. the zlib stream is written as
+    # IDAT chunks whenever the compressor hands back data
+    def __init__(self, file_name, width, height):
+        self.file = open(file_name, 'wb')
+        self.compressor = zlib.compressobj(6)
+        self.file.write(b'\x89PNG\r\n\x1a\n')
+        self.write_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+
+    def write_chunk(self, kind, data):
+        self.file.write(struct.pack('>I', len(data)) + kind + data)
+        self.file.write(struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+
+    def write_row(self, row):
+        data = self.compressor.compress(b'\x00' + row)
+        if data:
+            self.write_chunk(b'IDAT', data)
+
+    def close(self):
+        self.write_chunk(b'IDAT', self.compressor.flush())
+        self.write_chunk(b'IEND', b'')
+        self.file.close()
+
+IMAGE_WRITERS = {'p3': P3Writer, 'p6': P6Writer, 'png': PNGWriter}
+
+def image_format_of(file_name, image_format=None):
+    if image_format is None:
+        image_format = 'png' if file_name.lower().endswith('.png') else 'p6'
+    return image_format
+
+def open_image_writer(file_name, width, height, image_format=None):
+    return IMAGE_WRITERS[image_format_of(file_name, image_format)](file_name, width, height)
+
+def write_image(file_name, framebuffer, image_format=None):
+    # writes the whole framebuffer next to the file and swaps it in, so a reader never sees half an image
+    temp_file = file_name + '.' + str(os.getpid())
+    writer = IMAGE_WRITERS[image_format_of(file_name, image_format)](temp_file, framebuffer.width, framebuffer.height)
+    try:
+        for i in range(framebuffer.height):
+            writer.write_row(framebuffer.row_bytes(i))
+    finally:
+        writer.close()
+    os.replace(temp_file, file_name)
+
+#######################################
+### DENOISING
+#######################################
+
+# guides of a pixel: albedo (the color term of the first material hit, the skybox on a miss),
+# normal at the first hit (zero on a miss) and distance to it (VISION_RANGE on a miss)
+AUX_CHANNELS = 7
+DENOISE_LEVELS = 5
+# b3 spline, the 5 taps of every level of the a-trous filter
+DENOISE_KERNEL = [1 / 16, 1 / 4, 3 / 8, 1 / 4, 1 / 16]
+# widths of the edge-stopping functions: color and albedo in 0-255 units (the color one is halved at
+# every level), normal as the distance between unit vectors and depth relative to the closest of both
+DENOISE_SIGMA_COLOR = 40.0
+DENOISE_SIGMA_ALBEDO = 20.0
+DENOISE_SIGMA_NORMAL = 0.3
+DENOISE_SIGMA_DEPTH = 0.05
+
+def denoise(colors, aux, levels=DENOISE_LEVELS):
+    # edge-avoiding a-trous wavelet filter (dammertz et al. 2010). every level blurs with the 5x5 b3 kernel
+    # spread over holes of 2^level pixels, so a few cheap levels cover a wide footprint, and every tap is
+    # weighted down by how much its color and guides differ from the ones of the center pixel, so edges,
+    # silhouettes and texture in the albedo stay sharp. colors is (height, width, 3) and aux
+    # (height, width, AUX_CHANNELS), both means per pixel
+    height, width = colors.shape[:2]
+    albedo, normal, depth = aux[..., 0:3], aux[..., 3:6], aux[..., 6]
+    for level in range(levels):
+        step = 2 ** level
+        sigma_color = DENOISE_SIGMA_COLOR / step
+        margin = 2 * step
+        pad = lambda a: np.pad(a, [(margin, margin), (margin, margin)] + [(0, 0)] * (a.ndim - 2), mode='edge')
+        padded_colors, padded_albedo, padded_normal, padded_depth = pad(colors), pad(albedo), pad(normal), pad(depth)
+        total = np.zeros_like(colors)
+        weights = np.zeros((height, width))
+        for dy in range(-2, 3):
+            for dx in range(-2, 3):
+                window = (slice(margin + dy * step, margin + dy * step + height), slice(margin + dx * step, margin + dx * step + width))
+                tap_colors, tap_depth = padded_colors[window], padded_depth[window]
+                distance = np.sum((tap_colors - colors) ** 2, axis=2) / sigma_color ** 2 \
+                    + np.sum((padded_albedo[window] - albedo) ** 2, axis=2) / DENOISE_SIGMA_ALBEDO ** 2 \
+                    + np.sum((padded_normal[window] - normal) ** 2, axis=2) / DENOISE_SIGMA_NORMAL ** 2 \
+                    + np.abs(tap_depth - depth) / (DENOISE_SIGMA_DEPTH * np.maximum(np.minimum(tap_depth, depth), OBJ_NEAR))
+                weight = DENOISE_KERNEL[dy + 2] * DENOISE_KERNEL[dx + 2] * np.exp(-distance)
+                total += tap_colors * weight[..., None]
+                weights += weight
+        # the center tap always has weight, so there is no division by zero
+        colors = total / weights[..., None]
+    return colors
+
+def denoise_framebuffer(framebuffer, levels=DENOISE_LEVELS):
+    # a new float framebuffer with the filtered image of one traced with aux
+    width, height = framebuffer.width, framebuffer.height
+    passes = max(framebuffer.passes, 1) if framebuffer.accumulate else 1
+    colors = np.frombuffer(framebuffer.pixels, dtype=np.float64 if framebuffer.accumulate else np.uint8)
+    colors = colors.reshape(height, width, 3) / passes
+    aux = np.frombuffer(framebuffer.aux, dtype=np.float64).reshape(height, width, AUX_CHANNELS) / passes
+    result = Framebuffer(width, height, accumulate=True)
+    np.frombuffer(result.pixels, dtype=np.float64)[:] = denoise(colors, aux, levels).ravel()
+    return result
+
+#######################################
+### PARALLEL RENDERING
+#######################################
+
+def make_tiles(width, height, tile_size):
+    tiles = []
+    for i in range(0, height, tile_size):
+        for j in range(0, width, tile_size):
+            tiles.append((range(i, min(i + tile_size, height)), range(j, min(j + tile_size, width))))
+    return tiles
+
+def render_tile(engine, scene, tile_index, rows, columns, seed, camera, framebuffer, options, pixels=None):
+    # scene is a NumpyScene for the numpy engine, (shapes, point_lights) otherwise
+    if seed is not None:
+        # the noise of a tile depends only on the render seed and the tile, not on the worker it landed on
+        random.seed(str(seed) + ':' + str(tile_index))
+    # the sequence depends on the render seed only, pixels pick their own part of it
+    sampler = make_sampler(options.sampler, seed)
+    if engine == 'numpy':
+        trace_tile_numpy(scene, rows, columns, framebuffer.width, framebuffer.height, *camera, framebuffer, options, sampler, pixels)
+    else:
+        trace_tile(*scene, rows, columns, framebuffer.width, framebuffer.height, *camera, framebuffer, options, sampler, pixels)
+
+def render_worker(worker_id, engine, shared_scene, tiles, done, camera, framebuffer, options, occlusion_cache=None):
+    # long-lived worker: pulls tiles until it gets None, then reports how long it was busy
+    start_time = time.time()
+    reset_stats()
+    set_instrumentation(options.stats)
+    width, height = framebuffer.width, framebuffer.height
+    shapes, point_lights = shared_scene.attach()
+    compile_materials(shapes)
+    scene = NumpyScene(shapes, point_lights) if engine == 'numpy' else (shapes, point_lights)
+    set_recorder(RayRecorder(shapes, width) if options.record else None)
+    set_occlusion_cache(occlusion_cache)
+    add_phase('attach', time.time() - start_time)
+    busy_time = 0
+    tile_count = 0
+    while True:
+        tile = tiles.get()
+        if tile is None:
+            break
+        tile_index, rows, columns, seed, pixels = tile
+        tile_start = time.time()
+        render_tile(engine, scene, tile_index, rows, columns, seed, camera, framebuffer, options, pixels)
+        busy_time += time.time() - tile_start
+        add_phase('tracing', time.time() - tile_start)
+        tile_count += 1
+        done.put(('tile', worker_id, tile_index, RECORDER.take() if RECORDER is not None else None))
+    done.put(('worker', worker_id, tile_count, busy_time, time.time() - start_time, dict(COUNTERS), dict(SAMPLE_HISTOGRAM),
+        dict(DEPTH_HISTOGRAM), dict(PHASES), dict(CACHE_STATS)))
+
+def render_tiles(engine, shared_scene, camera, framebuffer, options, workers=CPUS, tile_size=TILE_SIZE, writer=None, seed=None, progress=True,
+        pixels=None, records=None, occlusion_cache=None):
+    # tiles are handed out in row-major order, so once every tile of a band of rows is done
+    # those rows are final and can be streamed to the writer. when pixels (a set of flat indices) is
+    # given only those are traced, tiles without any are not sent at all. with options.record the
+    # records of every tile are appended to records. every worker reads and fills occlusion_cache
+    width, height = framebuffer.width, framebuffer.height
+    tiles = make_tiles(width, height, tile_size)
+    tiles_per_band = (width + tile_size - 1) // tile_size
+    band_tiles = [0] * ((height + tile_size - 1) // tile_size)
+    next_band = 0
+    def write_finished_bands():
+        nonlocal next_band
+        while next_band < len(band_tiles) and band_tiles[next_band] == tiles_per_band:
+            if writer:
+                output_start = time.time()
+                for i in range(next_band * tile_size, min((next_band + 1) * tile_size, height)):
+                    writer.write_row(framebuffer.row_bytes(i))
+                add_phase('output', time.time() - output_start)
+            next_band += 1
+    tile_queue = multiprocessing.Queue()
+    done = multiprocessing.Queue()
+    sent = 0
+    for tile_index, (rows, columns) in enumerate(tiles):
+        tile_pixels = None
+        if pixels is not None:
+            tile_pixels = [i * width + j for i in rows for j in columns if i * width + j in pixels]
+            if not tile_pixels:
+                band_tiles[tile_index // tiles_per_band] += 1
+                continue
+        tile_queue.put((tile_index, rows, columns, seed, tile_pixels))
+        sent += 1
+    for k in range(workers):
+        tile_queue.put(None)
+    if options.sampler == 'bluenoise':
+        # built once here, the forked workers inherit it
+        blue_noise_mask()
+    # the bands no pixel of which is traced are final already
+    write_finished_bands()
+
+    processes = [multiprocessing.Process(target=render_worker, \
+        args=(k, engine, shared_scene, tile_queue, done, camera, framebuffer, options, occlusion_cache)) for k in range(workers)]
+    for p in processes:
+        p.start()
+
+    reports = {}
+    completed = 0
+    while len(reports) < workers:
+        try:
+            message = done.get(timeout=1)
+        except queue.Empty:
+            for p in processes:
+                if p.exitcode:
+                    raise RuntimeError('worker ' + str(p.pid) + ' terminou com codigo ' + str(p.exitcode))
+            continue
+        if message[0] == 'tile':
+            completed += 1
+            if progress:
+                print('tile ' + str(completed) + '/' + str(sent) + ' renderizado pelo worker ' + str(message[1]))
+            if records is not None:
+                records.append(message[3])
+            band_tiles[message[2] // tiles_per_band] += 1
+            write_finished_bands()
+        else:
+            reports[message[1]] = message[2:]
+
+    for p in processes:
+        p.join()
+    return [reports[k] for k in range(workers)]
+
+#######################################
+### RENDER FARM
+#######################################
+
+# every message is a json header and a binary payload, preceded by their lenghts
+FARM_HEADER = '=II'
+# seconds a worker keeps trying to reach the coordinator, and that the coordinator still waits for the
+# reports of the workers once every tile is done
+FARM_CONNECT_TIMEOUT = 30
+FARM_FINISH_TIMEOUT = 5
+# seconds the coordinator waits with no worker connected before giving up, and between the messages it prints
+# while it waits
+FARM_IDLE_TIMEOUT = 300
+FARM_WAIT_NOTICE = 10
+# a tile in flight for FARM_REISSUE_FACTOR times the median time of the finished tiles (and at least
+# FARM_MIN_REISSUE seconds) is issued again to an idle worker, and the first copy to come back is kept
+FARM_REISSUE_FACTOR = 4
+FARM_MIN_REISSUE = 1.0
+# where a worker keeps the scenes it received, by content hash, so a scene crosses the network once
+FARM_CACHE_DIR = '.farmcache'
+
+def send_message(connection, message, payload=b''):
+    header = json.dumps(message).encode('utf-8')
+    connection.sendall(struct.pack(FARM_HEADER, len(header), len(payload)) + header)
+    if payload:
+        connection.sendall(payload)
+
+def receive_exactly(connection, size):
+    data = bytearray(size)
+    view = memoryview(data)
+    received = 0
+    while received < size:
+        count = connection.recv_into(view[received:])
+        if not count:
+            raise ConnectionError('conexao fechada pelo outro lado')
+        received += count
+    return bytes(data)
+
+def receive_message(connection):
+    # returns the header and the payload of the next message
+    header_size, payload_size = struct.unpack(FARM_HEADER, receive_exactly(connection, struct.calcsize(FARM_HEADER)))
+    message = json.loads(receive_exactly(connection, header_size).decode('utf-8'))
+    return message, receive_exactly(connection, payload_size)
+
+def parse_address(address):
+    # host:port, the host defaults to the loopback
+    host, _, port = address.rpartition(':')
+    return host or '127.0.0.1', int(port)
+
+def scene_hash(layout, payload):
+    key = hashlib.sha1(json.dumps(layout, sort_keys=True).encode('ascii'))
+    key.update(payload)
+    return key.hexdigest()
+
+def shared_scene_from_payload(layout, payload):
+    # a SharedScene of this machine holding a copy of the block of the coordinator
+    scene = SharedScene.__new__(SharedScene)
+    scene.layout = {key: tuple(value) for key, value in layout.items()}
+    scene.size = len(payload)
+    scene.shm = shared_memory.SharedMemory(create=True, size=max(scene.size, 1))
+    scene.name = scene.shm.name
+    scene.shm.buf[:scene.size] = payload
+    return scene
+
+class TileSchedule:
+    # the tiles of a farm render, by index. pending tiles go out first, then the ones in flight for too long
+    # go out again to idle workers. the first copy of a tile to come back is kept, and the tiles of a lost
+    # worker that no other worker holds are pending again
+    def __init__(self, count):
+        self.count = count
+        self.pending = list(range(count))
+        # tile -> {worker id: time it was issued to that worker}
+        self.holders = {}
+        self.finished = set()
+        # seconds from issue to result of the finished tiles
+        self.times = []
+        self.reissued = 0
+        self.condition = threading.Condition()
+
+    def done(self):
+        return len(self.finished) == self.count
+
+    def next_tile(self, worker):
+        # blocks until there is a tile for worker, None once every tile is done
+        with self.condition:
+            while not self.done():
+                now = time.time()
+                if self.pending:
+                    tile = self.pending.pop(0)
+                    self.holders[tile] = {worker: now}
+                    return tile
+                tile = self.slow_tile(worker, now)
+                if tile is not None:
+                    self.holders[tile][worker] = now
+                    self.reissued += 1
+                    return tile
+                self.condition.wait(FARM_MIN_REISSUE / 2)
+            return None
+
+    def slow_tile(self, worker, now):
+        # the tile whose newest copy is the oldest, if that is too old and worker does not hold it
+        if not self.times:
+            return None
+        limit = max(FARM_MIN_REISSUE, FARM_REISSUE_FACTOR * sorted(self.times)[len(self.times) // 2])
+        candidates = [(max(holders.values()), tile) for tile, holders in self.holders.items() if worker not in holders]
+        if candidates and now - min(candidates)[0] > limit:
+            return min(candidates)[1]
+        return None
+
+    def finish(self, tile, worker):
+        # True for the first copy of a tile, the one that goes to the image
+        with self.condition:
+            holders = self.holders.pop(tile, None)
+            if tile in self.finished or holders is None:
+                return False
+            self.finished.add(tile)
+            if worker in holders:
+                self.times.append(time.time() - holders[worker])
+            self.condition.notify_all()
+            return True
+
+    def lose(self, worker):
+        with self.condition:
+            for tile, holders in list(self.holders.items()):
+                holders.pop(worker, None)
+                if not holders:
+                    del self.holders[tile]
+                    self.pending.insert(0, tile)
+            self.condition.notify_all()
+
+def serve_farm_worker(connection, worker, schedule, job, payload, tiles, framebuffer, progress):
+    # one thread of the coordinator per connected worker: sends the scene unless the worker has it cached,
+    # then one tile at a time until the schedule is done, and keeps the report the worker sends at the end
+    start_time = time.time()
+    try:
+        hello, _ = receive_message(connection)
+        worker['name'] = hello['name']
+        send_message(connection, job)
+        status, _ = receive_message(connection)
+        if not status['cached']:
+            send_message(connection, {'type': 'scene_data'}, payload)
+            worker['scene_bytes'] = len(payload)
+        while True:
+            tile = schedule.next_tile(worker['id'])
+            if tile is None:
+                break
+            rows, columns = tiles[tile]
+            send_message(connection, {'type': 'tile', 'index': tile, 'rows': [rows.start, rows.stop], 'columns': [columns.start, columns.stop]})
+            result, pixels = receive_message(connection)
+            worker['busy_time'] += result['seconds']
+            if schedule.finish(tile, worker['id']):
+                framebuffer.write_tile_bytes(rows, columns, pixels)
+                worker['tiles'] += 1
+                worker['pixels'] += len(rows) * len(columns)
+                if progress:
+                    print('tile ' + str(len(schedule.finished)) + '/' + str(schedule.count) + ' renderizado pelo worker ' + worker['name'])
+            else:
+                worker['duplicates'] += 1
+        send_message(connection, {'type': 'done'})
+        report, _ = receive_message(connection)
+        # json keys are strings, the histograms are keyed by numbers
+        worker['report'] = (report['tiles'], report['busy_time'], report['lifetime'], report['counters'],
+            {int(k): v for k, v in report['sample_histogram'].items()}, {int(k): v for k, v in report['depth_histogram'].items()},
+            report['phases'], report['cache_stats'])
+    except (OSError, ValueError, KeyError) as error:
+        worker['lost'] = worker['lost'] or str(error) or type(error).__name__
+        schedule.lose(worker['id'])
+    finally:
+        worker['lifetime'] = time.time() - start_time
+        connection.close()
+
+def farm_summary(worker):
+    # one line about the throughput of a farm worker
+    busy_time = max(worker['busy_time'], 1e-9)
+    return 'worker ' + str(worker['id']) + ' (' + worker['name'] + ', ' + worker['address'] + '): ' + str(worker['tiles']) + ' tiles, ' \
+        + str(int(worker['pixels'] / busy_time)) + ' pixels/s, ' + str(round(100 * worker['busy_time'] / max(worker['lifetime'], 1e-9), 1)) \
+        + '% do tempo ocupado, ' + ('cena enviada (' + str(worker['scene_bytes']) + ' bytes)' if worker['scene_bytes'] else 'cena do cache') \
+        + ', ' + str(worker['duplicates']) + ' copias descartadas' + (', perdido: ' + worker['lost'] if worker['lost'] else '')
+
+def render_farm(engine, shared_scene, camera, framebuffer, options, address, tile_size=TILE_SIZE, seed=None, progress=True,
+        local_workers=0, cache_dir=FARM_CACHE_DIR):
+    # coordinator of a render farm: listens on address (host:port) and hands the tiles out to the workers
+    # that connect, started with -farm-worker on any machine that reaches it, local_workers of them from here
+    # over the loopback. the tiles are seeded as in render_tiles, so the image is the same. returns the
+    # reports of the workers that finished, in the format of render_tiles, by worker id. raises TimeoutError
+    # when no worker is connected for FARM_IDLE_TIMEOUT seconds
+    width, height = framebuffer.width, framebuffer.height
+    tiles = make_tiles(width, height, tile_size)
+    payload = shared_scene.payload()
+    job = {'type': 'scene', 'hash': scene_hash(shared_scene.layout, payload), 'layout': shared_scene.layout, 'engine': engine,
+        'width': width, 'height': height, 'camera': [value.array() if isinstance(value, Vec3) else value for value in camera],
+        'options': vars(options), 'seed': seed}
+    schedule = TileSchedule(len(tiles))
+    listener = socket.create_server(parse_address(address))
+    listener.settimeout(FARM_MIN_REISSUE / 2)
+    # port 0 lets the system choose one
+    host, port = listener.getsockname()[:2]
+    print('Coordenador esperando workers em ' + host + ':' + str(port) + ' para ' + str(len(tiles)) + ' tiles')
+    local_address = '127.0.0.1:' + str(port)
+    processes = [multiprocessing.Process(target=farm_worker, args=(local_address, cache_dir)) for k in range(local_workers)]
+    for p in processes:
+        p.start()
+
+    workers = []
+    connections = []
+    threads = []
+    # since when no worker is connected, and when that was last said
+    idle_since = notice_time = time.time()
+    try:
+        while not schedule.done():
+            try:
+                connection, peer = listener.accept()
+            except socket.timeout:
+                now = time.time()
+                if any(thread.is_alive() for thread in threads):
+                    idle_since = notice_time = now
+                elif now - idle_since > FARM_IDLE_TIMEOUT:
+                    raise TimeoutError('nenhum worker conectado ha ' + str(FARM_IDLE_TIMEOUT) + ' segundos, com ' \
+                        + str(len(schedule.finished)) + ' de ' + str(schedule.count) + ' tiles prontos')
+                elif now - notice_time > FARM_WAIT_NOTICE:
+                    notice_time = now
+                    print('Nenhum worker conectado, esperando em ' + host + ':' + str(port) + ' (' + str(len(schedule.finished)) \
+                        + ' de ' + str(schedule.count) + ' tiles prontos, desiste em ' + str(int(FARM_IDLE_TIMEOUT - (now - idle_since))) + ' segundos)')
+                continue
+            connection.settimeout(None)
+            worker = {'id': len(workers), 'name': '?', 'address': peer[0] + ':' + str(peer[1]), 'tiles': 0, 'pixels': 0, 'duplicates': 0,
+                'busy_time': 0, 'lifetime': 0, 'scene_bytes': 0, 'lost': None, 'report': None}
+            workers.append(worker)
+            connections.append(connection)
+            threads.append(threading.Thread(target=serve_farm_worker,
+                args=(connection, worker, schedule, job, payload, tiles, framebuffer, progress), daemon=True))
+            threads[-1].start()
+        deadline = time.time() + FARM_FINISH_TIMEOUT
+        for thread in threads:
+            thread.join(max(0, deadline - time.time()))
+    finally:
+        listener.close()
+        # the workers still busy with a copy of a tile are dropped
+        for worker, connection, thread in zip(workers, connections, threads):
+            if thread.is_alive():
+                worker['lost'] = 'ainda ocupado no fim'
+                # a shutdown wakes the thread blocked reading from the worker, a close alone would not
+                try:
+                    connection.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                thread.join(FARM_FINISH_TIMEOUT)
+        for p in processes:
+            p.join(FARM_FINISH_TIMEOUT)
+
+    for worker in workers:
+        print(farm_summary(worker))
+    print('Farm: ' + str(len(workers)) + ' workers, ' + str(schedule.reissued) + ' tiles reenviados')
+    return {worker['id']: worker['report'] for worker in workers if worker['report'] is not None}
+
+def farm_tiles(connection, job, shared_scene, start_time):
+    # the tile loop of a farm worker, apart so the shapes (and their views into the block) are gone before
+    # the block is released. returns the number of tiles rendered
+    engine = job['engine']
+    options = RenderOptions()
+    options.__dict__.update(job['options'])
+    camera = tuple(Vec3(*value) if isinstance(value, list) else value for value in job['camera'])
+    framebuffer = Framebuffer(job['width'], job['height'])
+    reset_stats()
+    set_instrumentation(options.stats)
+    set_recorder(None)
+    set_occlusion_cache(None)
+    shapes, point_lights = shared_scene.attach()
+    compile_materials(shapes)
+    scene = NumpyScene(shapes, point_lights) if engine == 'numpy' else (shapes, point_lights)
+    add_phase('attach', time.time() - start_time)
+    busy_time = 0
+    tile_count = 0
+    while True:
+        message, _ = receive_message(connection)
+        if message['type'] == 'done':
+            break
+        rows, columns = range(*message['rows']), range(*message['columns'])
+        tile_start = time.time()
+        render_tile(engine, scene, message['index'], rows, columns, job['seed'], camera, framebuffer, options)
+        seconds = time.time() - tile_start
+        busy_time += seconds
+        add_phase('tracing', seconds)
+        tile_count += 1
+        send_message(connection, {'type': 'tile', 'index': message['index'], 'seconds': seconds}, framebuffer.tile_bytes(rows, columns))
+    send_message(connection, {'type': 'report', 'tiles': tile_count, 'busy_time': busy_time, 'lifetime': time.time() - start_time,
+        'counters': COUNTERS, 'sample_histogram': SAMPLE_HISTOGRAM, 'depth_histogram': DEPTH_HISTOGRAM, 'phases': PHASES,
+        'cache_stats': CACHE_STATS})
+    return tile_count
+
+def farm_worker(address, cache_dir=FARM_CACHE_DIR):
+    # connects to the coordinator at address, renders the tiles it hands out until it is done and sends the
+    # counters of the render back. the scene is read from cache_dir when it was received before
+    start_time = time.time()
+    while True:
+        try:
+            connection = socket.create_connection(parse_address(address))
+            break
+        except OSError:
+            if time.time() - start_time > FARM_CONNECT_TIMEOUT:
+                raise
+            time.sleep(0.5)
+    with connection:
+        send_message(connection, {'type': 'hello', 'name': socket.gethostname() + ':' + str(os.getpid())})
+        job, _ = receive_message(connection)
+        cache_file = os.path.join(cache_dir, job['hash'] + '.scene')
+        cached = os.path.exists(cache_file)
+        send_message(connection, {'type': 'scene_status', 'cached': cached})
+        if cached:
+            with open(cache_file, 'rb') as f:
+                payload = f.read()
+        else:
+            message, payload = receive_message(connection)
+            if scene_hash(job['layout'], payload) != job['hash']:
+                raise ValueError('a cena recebida nao confere com o hash ' + job['hash'])
+            os.makedirs(cache_dir, exist_ok=True)
+            temp_file = cache_file + '.' + str(os.getpid())
+            with open(temp_file, 'wb') as f:
+                f.write(payload)
+            os.replace(temp_file, cache_file)
+        print('Cena ' + job['hash'] + (' lida do cache' if cached else ' recebida: ' + str(len(payload)) + ' bytes'))
+
+        if job['engine'] == 'numpy' and np is None:
+            raise RuntimeError('o motor numpy precisa da biblioteca numpy instalada')
+        shared_scene = shared_scene_from_payload(job['layout'], payload)
+        try:
+            tile_count = farm_tiles(connection, job, shared_scene, start_time)
+        finally:
+            shared_scene.unlink()
+    print('Worker terminou: ' + str(tile_count) + ' tiles em ' + str(round(time.time() - start_time, 2)) + ' segundos')
+    return tile_count
+
+#######################################
+### STATISTICS
+#######################################
+
+def merge_reports(reports):
+    # sums the counters, histograms and phases of the worker reports
+    merged = {'counters': dict.fromkeys(COUNTERS, 0), 'sample_histogram': {}, 'depth_histogram': {}, 'worker_phases': {},
+        'occlusion_cache': dict.fromkeys(CACHE_STATS, 0)}
+    for tile_count, busy_time, lifetime, *tables in reports:
+        for totals, values in zip(merged.values(), tables):
+            for key, value in values.items():
+                totals[key] = totals.get(key, 0) + value
+    return merged
+
+def stats_report(width, height, wall_time, reports):
+    # everything known about a render, ready for json.dump. phases are wall clock seconds of the main
+    # process, worker_phases are summed over the workers
+    report = merge_reports(reports)
+    report['width'] = width
+    report['height'] = height
+    report['wall_time'] = wall_time
+    report['phases'] = dict(PHASES)
+    report['primary_rays'] = sum(count * pixels for count, pixels in report['sample_histogram'].items())
+    report['workers'] = [{'tiles': tile_count, 'busy_time': busy_time, 'lifetime': lifetime}
+        for tile_count, busy_time, lifetime, *tables in reports]
+    return report
+
+def stats_summary(report):
+    phases = report['phases']
+    counters = report['counters']
+    depths = report['depth_histogram']
+    in_seconds = lambda phase: str(round(phases.get(phase, 0), 2)) + 's'
+    return 'stats: ' + str(round(report['wall_time'], 2)) + 's' \
+        + ' | cena ' + in_seconds('scene_load') + ' (bvh ' + in_seconds('acceleration_build') + ')' \
+        + ' | tracado ' + in_seconds('tracing') + ' | saida ' + in_seconds('output') \
+        + ' | raios ' + str(report['primary_rays']) + ' primarios, ' + str(counters['secondary_rays']) + ' secundarios, ' \
+        + str(counters['shadow_rays']) + ' de sombra' \
+        + ' | testes ' + str(counters['sphere_tests']) + ' esferas, ' + str(counters['triangle_tests']) + ' triangulos, ' \
+        + str(counters['box_tests']) + ' caixas' \
+        + ' | ' + str(counters['hits']) + ' acertos' \
+        + ' | profundidade max ' + str(max(depths) if depths else 0) \
+        + ' | ' + str(counters['shadow_early_exits']) + ' sombras interrompidas cedo' \
+        + ' | ' + str(counters['packets']) + ' pacotes, ' + str(counters['culled_shapes']) + ' formas descartadas'
+
+def cache_summary(report):
+    # one line about the occlusion cache of a render, from the occlusion_cache entry of its report
+    cache = report['occlusion_cache']
+    return 'Cache de oclusao: ' + str(cache['lookups']) + ' consultas, ' \
+        + str(round(100 * cache['hits'] / max(cache['lookups'], 1), 1)) + '% de acertos, ' \
+        + str(cache['entries']) + ' de ' + str(cache['capacity']) + ' entradas ocupadas, ' \
+        + str(cache['inserts']) + ' insercoes, ' + str(cache['evictions']) + ' descartes'
+
+#######################################
+### PROGRESSIVE RENDERING
+#######################################
+
+CHECKPOINT_MAGIC = b'TP2CKPT2'
+# width, height, passes, scene seed, rng state version, rng state lenght, settings lenght
+CHECKPOINT_HEADER = '=qqqQqqq'
+
+def save_checkpoint(file_name, framebuffer, seed, rng, settings):
+    # header, the settings of the render as json, the state of the rng that seeds the passes, its gauss_next
+    # (nan for None), then the accumulation buffer as native doubles
+    version, internal, gauss_next = rng.getstate()
+    data = json.dumps(settings).encode('utf-8')
+    temp_file = file_name + '.' + str(os.getpid())
+    with open(temp_file, 'wb') as f:
+        f.write(CHECKPOINT_MAGIC + struct.pack(CHECKPOINT_HEADER, framebuffer.width, framebuffer.height, framebuffer.passes,
+            seed, version, len(internal), len(data)) + data)
+        f.write(array('Q', internal).tobytes() + struct.pack('=d', math.nan if gauss_next is None else gauss_next))
+        f.write(memoryview(framebuffer.pixels).cast('B'))
+    os.replace(temp_file, file_name)
+
+def load_checkpoint(file_name):
+    # returns (width, height, passes, seed, rng state, accumulation buffer bytes, settings)
+    with open(file_name, 'rb') as f:
+        data = f.read()
+    if data[:len(CHECKPOINT_MAGIC)] != CHECKPOINT_MAGIC:
+        raise ValueError(file_name + ' nao e um checkpoint do ray tracer')
+    offset = len(CHECKPOINT_MAGIC)
+    width, height, passes, seed, version, state_lenght, settings_lenght = struct.unpack_from(CHECKPOINT_HEADER, data, offset)
+    offset += struct.calcsize(CHECKPOINT_HEADER)
+    settings = json.loads(data[offset:offset + settings_lenght].decode('utf-8'))
+    offset += settings_lenght
+    internal = array('Q', data[offset:offset + 8 * state_lenght])
+    offset += 8 * state_lenght
+    gauss_next, = struct.unpack_from('=d', data, offset)
+    offset += 8
+    pixels = data[offset:]
+    if len(pixels) != width * height * 3 * 8:
+        raise ValueError(file_name + ' esta truncado')
+    state = (version, tuple(internal), None if math.isnan(gauss_next) else gauss_next)
+    return width, height, passes, seed, state, pixels, settings
+
+def checkpoint_mismatch(previous, settings):
+    # the settings that differ from the ones of the checkpoint, joined for the error message, None if there are none
+    changed = [key for key in sorted(set(previous) | set(settings)) if previous.get(key) != settings.get(key)]
+    return ', '.join(changed) or None
+
+def render_progressive(engine, shared_scene, camera, framebuffer, options, workers, tile_size, rng, seed,
+        output_file, image_format=None, checkpoint_file=None, target_passes=None, budget=None, occlusion_cache=None,
+        settings=None):
+    # renders whole passes into the accumulation buffer until target_passes are done or the next pass
+    # would not fit in the budget (seconds). after every pass the preview image and the checkpoint, with the
+    # settings a resume must match, are rewritten, so killing the render loses at most the pass in flight.
+    # the occlusion_cache is kept over the passes
+    start_time = time.time()
+    reports = None
+    passes = 0
+    while target_passes is None or framebuffer.passes < target_passes:
+        pass_start = time.time()
+        pass_reports = render_tiles(engine, shared_scene, camera, framebuffer, options, workers, tile_size, seed=rng.getrandbits(64),
+            occlusion_cache=occlusion_cache)
+        framebuffer.passes += 1
+        passes += 1
+        output_start = time.time()
+        write_image(output_file, framebuffer, image_format)
+        if checkpoint_file:
+            save_checkpoint(checkpoint_file, framebuffer, seed, rng, settings)
+        add_phase('output', time.time() - output_start)
+        print('Passada ' + str(framebuffer.passes) + ' renderizada em ' + str(round(time.time() - pass_start, 2)) + ' segundos')
+
+        # worker reports are summed over the passes
+        if reports is None:
+            reports = [list(report) for report in pass_reports]
+        else:
+            for report, pass_report in zip(reports, pass_reports):
+                for k in range(3):
+                    report[k] += pass_report[k]
+                for totals, values in zip(report[3:], pass_report[3:]):
+                    for key, value in values.items():
+                        totals[key] = totals.get(key, 0) + value
+
+        elapsed = time.time() - start_time
+        if budget is not None and elapsed + elapsed / passes > budget:
+            break
+
+    if not passes:
+        write_image(output_file, framebuffer, image_format)
+    return reports or []
+
+#######################################
+### INCREMENTAL RENDERING
+#######################################
+
+RECORDS_MAGIC = b'TP2REC01'
+# lenght of the json header, number of contributions, number of segments
+RECORDS_HEADER = '=qqq'
+# the segments are kept in float32, the boxes they are tested against grow by this much to make up for it
+RECORD_MARGIN = 1e-3
+
+class RayRecorder:
+    # what an incremental render keeps of every pixel: the shapes that contributed to it (hit by one of its
+    # rays or blocking one of its shadow rays) and every segment its rays travelled, as a start, a direction
+    # and a lenght in float32. filled by the worker while it traces a tile and taken when the tile is done
+    def __init__(self, shapes, width):
+        self.shape_index = {id(shape): k for k, shape in enumerate(shapes)}
+        self.shape_count = len(shapes)
+        self.width = width
+        self.pixel = 0
+        # pixel of every primary ray of the current batch of the numpy engine
+        self.pixels = None
+        self.clear()
+
+    def clear(self):
+        # contributions are stored as pixel * shape_count + shape
+        self.contributions = set()
+        self.segment_pixels = array('i')
+        self.segments = array('f')
+
+    def start_pixel(self, pixel):
+        self.pixel = pixel
+
+    def ray(self, ray, t, shape=None):
+        start, direction = ray.start, ray.direction
+        self.segment_pixels.append(self.pixel)
+        self.segments.extend((start.x, start.y, start.z, direction.x, direction.y, direction.z, t))
+        if shape is not None:
+            self.contribution(shape)
+
+    def contribution(self, shape):
+        self.contributions.add(self.pixel * self.shape_count + self.shape_index[id(shape)])
+
+    def np_rays(self, pixels, starts, directions, t, shapes=None):
+        # shapes holds the index of the shape each ray hit, -1 on a miss
+        self.segment_pixels.frombytes(pixels.astype(np.intc).tobytes())
+        self.segments.frombytes(np.column_stack([starts, directions, t]).astype(np.float32).tobytes())
+        if shapes is not None:
+            hit = shapes >= 0
+            self.np_contributions(pixels[hit], shapes[hit])
+
+    def np_contributions(self, pixels, shapes):
+        self.contributions.update((pixels * self.shape_count + shapes).tolist())
+
+    def take(self):
+        # the records of the tile: pixel and shape of every contribution, pixel of every segment and the segments
+        codes = sorted(self.contributions)
+        records = (array('i', [code // self.shape_count for code in codes]), array('i', [code % self.shape_count for code in codes]),
+            self.segment_pixels, self.segments)
+        self.clear()
+        return records
+
+def merge_records(records, previous=None, traced=()):
+    # one set of tables out of the records of the tiles, after the ones of previous for the pixels not traced again
+    merged = (array('i'), array('i'), array('i'), array('f'))
+    if previous is not None:
+        contribution_pixels, contribution_shapes, segment_pixels, segments = previous
+        for n, pixel in enumerate(contribution_pixels):
+            if pixel not in traced:
+                merged[0].append(pixel)
+                merged[1].append(contribution_shapes[n])
+        for n, pixel in enumerate(segment_pixels):
+            if pixel not in traced:
+                merged[2].append(pixel)
+                merged[3].extend(segments[7 * n:7 * n + 7])
+    for tables in records:
+        for table, values in zip(merged, tables):
+            table.extend(values)
+    return merged
+
+def scene_signatures(file_name):
+    # one string per part of a scene file the image depends on: the camera and image tables, the lights and
+    # every shape in the order load_scene creates them, with its material spelled out and, for meshes, the
+    # size and modification time of the .obj. only called on files load_scene accepted
+    scene = read_scene_file(file_name)
+    base_dir = os.path.dirname(os.path.abspath(file_name))
+    materials = scene['materials']
+    canonical = lambda value: json.dumps(value, sort_keys=True)
+    shapes = [canonical([sphere, materials[sphere['material']]]) for sphere in scene.get('spheres', [])]
+    for mesh in scene.get('meshes', []):
+        info = os.stat(os.path.normpath(os.path.join(base_dir, mesh['file'])))
+        shapes.append(canonical([mesh, materials[mesh['material']], info.st_size, info.st_mtime_ns]))
+    return {'view': canonical([scene.get('camera'), scene.get('image')]), 'lights': canonical(scene.get('lights', [])), 'shapes': shapes}
+
+def save_records(file_name, header, framebuffer, records):
+    # header, the header as json (render settings and scene signatures), the image, then the tables of merge_records
+    contribution_pixels, contribution_shapes, segment_pixels, segments = records
+    data = json.dumps(header).encode('utf-8')
+    temp_file = file_name + '.' + str(os.getpid())
+    with open(temp_file, 'wb') as f:
+        f.write(RECORDS_MAGIC + struct.pack(RECORDS_HEADER, len(data), len(contribution_pixels), len(segment_pixels)) + data)
+        f.write(memoryview(framebuffer.pixels).cast('B'))
+        for table in records:
+            f.write(table.tobytes())
+    os.replace(temp_file, file_name)
+
+def load_records(file_name):
+    # returns (header, image bytes, tables)
+    with open(file_name, 'rb') as f:
+        data = f.read()
+    if data[:len(RECORDS_MAGIC)] != RECORDS_MAGIC:
+        raise ValueError(file_name + ' nao e um arquivo de registros do ray tracer')
+    offset = len(RECORDS_MAGIC)
+    header_lenght, contributions, segment_count = struct.unpack_from(RECORDS_HEADER, data, offset)
+    offset += struct.calcsize(RECORDS_HEADER)
+    header = json.loads(data[offset:offset + header_lenght])
+    offset += header_lenght
+    image_lenght = header['settings']['width'] * header['settings']['height'] * 3
+    image = data[offset:offset + image_lenght]
+    offset += image_lenght
+    tables = []
+    for typecode, count in (('i', contributions), ('i', contributions), ('i', segment_count), ('f', 7 * segment_count)):
+        table = array(typecode)
+        table.frombytes(data[offset:offset + count * table.itemsize])
+        offset += count * table.itemsize
+        tables.append(table)
+    if len(image) != image_lenght or offset != len(data) or len(tables[3]) != 7 * segment_count:
+        raise ValueError(file_name + ' esta truncado')
+    return header, image, tuple(tables)
+
+def incremental_mismatch(previous, header):
+    # why the previous render can not be reused at all, None if it can
+    if previous['settings'] != header['settings']:
+        return 'as opcoes de renderizacao mudaram'
+    if previous['scene']['view'] != header['scene']['view']:
+        return 'a camera ou a imagem mudou'
+    if previous['scene']['lights'] != header['scene']['lights']:
+        return 'as luzes mudaram'
+    # the occlusion of a point is averaged over every shape of the scene
+    if len(previous['scene']['shapes']) != len(header['scene']['shapes']):
+        return 'o numero de formas mudou'
+    return None
+
+def changed_pixels(records, changed, boxes):
+    # pixels an edit of the shapes in changed can alter: the ones those shapes contributed to, and the ones with
+    # a segment that enters one of boxes, the swept bounds of the changed shapes where they are now. the
+    # paths of every other pixel did not meet them before and do not meet them now, so they are the same
+    contribution_pixels, contribution_shapes, segment_pixels, segments = records
+    changed = set(changed)
+    pixels = {pixel for pixel, shape in zip(contribution_pixels, contribution_shapes) if shape in changed}
+    for box in boxes:
+        box = array('d', [value - RECORD_MARGIN for value in box[:3]] + [value + RECORD_MARGIN for value in box[3:]])
+        if np is not None:
+            rows = np.frombuffer(segments, dtype=np.float32).reshape(-1, 7).astype(float)
+            entry = np_box_entry(np.array(box), rows[:, :3], rows[:, 3:6])
+            pixels.update(np.frombuffer(segment_pixels, dtype=np.intc)[entry <= rows[:, 6] + RECORD_MARGIN].tolist())
+            continue
+        for n, pixel in enumerate(segment_pixels):
+            if pixel in pixels:
+                continue
+            s = 7 * n
+            ix, iy, iz = inverse_direction(segments[s + 3], segments[s + 4], segments[s + 5])
+            if ray_box_entry(box, 0, segments[s], segments[s + 1], segments[s + 2], ix, iy, iz, segments[s + 6] + RECORD_MARGIN) >= 0:
+                pixels.add(pixel)
+    return pixels
+
+#######################################
+### SCENES
+#######################################
+
+def default_camera():
     # camera parameters
-    camera_eye = Vec3(0, 0, 0)
-    focal_dist = PIXEL_SIZE * 100
-    aperture = .5
-    camera_target = Vec3(0, 0, 5)
-    camera_up = Vec3(0, 1, 0)
+    return make_camera(Vec3(0, 0, 0), Vec3(0, 0, 5), Vec3(0, 1, 0), PIXEL_SIZE * 100, .5)
+
+def make_camera(camera_eye, camera_target, camera_up, focal_dist, aperture):
     camera_front = (camera_target - camera_eye).normalize()
     camera_right = camera_up.cross(camera_front).normalize()
     camera_up = camera_right.cross(camera_front)
+    return (camera_eye, camera_up, camera_right, camera_front, focal_dist, aperture)
 
+def random_scene(width, height):
+    # the ground plus num_shapes random spheres spread over the view, drawn from the global random
+    focal_dist = PIXEL_SIZE * 100
     # get shapes
     shapes = []
     ground_material = Material(type='lambert', albedo=Vec3(80, 80, 30), k_diffuse=0.8)
@@ -551,40 +3669,449 @@ def main():
 
     # get lights
     point_lights = [PointLight(Vec3(3, 3, 3), Vec3(255, 255, 255)), PointLight(Vec3(-3, 3, 3), Vec3(255, 255, 255))]
+    return shapes, point_lights
+
+#######################################
+### SCENE FILES
+#######################################
+
+# a scene file is a JSON or TOML table with these keys, only "materials" is required:
+#   camera = {eye, target, up, focal_dist, aperture}, every key optional (default_camera)
+#   image = {width, height}, overridden by -width and -height
+#   materials = {name = {type, albedo, and the parameters of the type in MATERIAL_PARAMS}}
+#   lights = [{position, color}]
+#   spheres = [{center, radius, material, speed}]
+#   meshes = [{file, position, scale, rotation, material, speed}], file relative to the scene file, rotation
+#     in degrees around x, y and z. every entry is a MeshInstance of the file's geometry
+# vectors are lists of 3 numbers and speed defaults to [0, 0, 0]
+SCENE_KEYS = {
+    'camera': ((), ('eye', 'target', 'up', 'focal_dist', 'aperture')),
+    'image': ((), ('width', 'height')),
+    'light': (('position', 'color'), ()),
+    'sphere': (('center', 'radius', 'material'), ('speed',)),
+    'mesh': (('file', 'material'), ('position', 'scale', 'rotation', 'speed')),
+}
+
+def scene_table(value, where, kind=None):
+    # a table with every required key of kind and no unknown one, so a typo is an error and not a default
+    if not isinstance(value, dict):
+        raise ValueError(where + ': esperava uma tabela')
+    if kind is None:
+        return value
+    required, optional = SCENE_KEYS[kind]
+    for key in required:
+        if key not in value:
+            raise ValueError(where + ': falta a chave ' + key)
+    for key in value:
+        if key not in required + optional:
+            raise ValueError(where + ': chave desconhecida ' + key)
+    return value
+
+def scene_list(value, where):
+    if not isinstance(value, list):
+        raise ValueError(where + ': esperava uma lista')
+    return value
+
+def scene_number(value, where, positive=False):
+    # bools are ints in python, but true is not a radius
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+        raise ValueError(where + ': esperava um numero')
+    if positive and value <= 0:
+        raise ValueError(where + ': deve ser positivo')
+    return float(value)
+
+def scene_vec3(value, where):
+    if not isinstance(value, list) or len(value) != 3:
+        raise ValueError(where + ': esperava uma lista de 3 numeros')
+    return Vec3(*[scene_number(v, where + '[' + str(k) + ']') for k, v in enumerate(value)])
+
+def scene_material(value, where):
+    scene_table(value, where)
+    material_type = value.get('type')
+    if material_type not in MATERIAL_PARAMS:
+        raise ValueError(where + '.type: deve ser um de ' + ', '.join(MATERIAL_TYPES))
+    params = {}
+    for key in value:
+        if key not in ('type', 'albedo') + MATERIAL_PARAMS[material_type]:
+            raise ValueError(where + ': chave desconhecida ' + key + ' para o tipo ' + material_type)
+    for key in MATERIAL_PARAMS[material_type]:
+        if key not in value:
+            raise ValueError(where + ': falta a chave ' + key)
+        params[key] = scene_number(value[key], where + '.' + key)
+    if 'albedo' not in value:
+        raise ValueError(where + ': falta a chave albedo')
+    return Material(type=material_type, albedo=scene_vec3(value['albedo'], where + '.albedo'), **params)
+
+def read_scene_file(file_name):
+    with open(file_name, 'rb') as f:
+        data = f.read()
+    decode_errors = (UnicodeDecodeError, json.JSONDecodeError) + ((tomllib.TOMLDecodeError,) if tomllib is not None else ())
+    try:
+        if file_name.lower().endswith('.toml'):
+            if tomllib is None:
+                raise ValueError(file_name + ': arquivos TOML precisam do modulo tomllib (python 3.11 ou mais novo)')
+            return tomllib.loads(data.decode('utf-8'))
+        return json.loads(data)
+    except decode_errors as e:
+        raise ValueError(file_name + ': ' + str(e))
+
+def load_scene(file_name, geometries=None):
+    # returns (camera, shapes, point_lights, width, height), width and height are None when the file has
+    # no image table. the whole file is validated before any mesh is read, and each mesh file is parsed
+    # only when a shape uses it and only once: every entry is an instance of that geometry with its own
+    # transform, material and speed. geometries maps the path to the loaded Mesh and can be shared between
+    # calls to load several scene files with the same meshes
+    if geometries is None:
+        geometries = {}
+    scene = scene_table(read_scene_file(file_name), file_name)
+    base_dir = os.path.dirname(os.path.abspath(file_name))
+    for key in scene:
+        if key not in ('camera', 'image', 'materials', 'lights', 'spheres', 'meshes'):
+            raise ValueError(file_name + ': chave desconhecida ' + key)
+    if 'materials' not in scene:
+        raise ValueError(file_name + ': falta a tabela materials')
+
+    camera_table = scene_table(scene.get('camera', {}), file_name + ': camera', 'camera')
+    eye, up, right, front, focal_dist, aperture = default_camera()
+    eye = scene_vec3(camera_table['eye'], file_name + ': camera.eye') if 'eye' in camera_table else eye
+    target = scene_vec3(camera_table['target'], file_name + ': camera.target') if 'target' in camera_table else eye + front
+    up = scene_vec3(camera_table['up'], file_name + ': camera.up') if 'up' in camera_table else Vec3(0, 1, 0)
+    if 'focal_dist' in camera_table:
+        focal_dist = scene_number(camera_table['focal_dist'], file_name + ': camera.focal_dist', positive=True)
+    if 'aperture' in camera_table:
+        aperture = scene_number(camera_table['aperture'], file_name + ': camera.aperture')
+    # normalize gives a zero vector for a zero one, so this also catches target == eye and a null up
+    if (target - eye).normalize().cross(up.normalize()).lenght() < 1e-9:
+        raise ValueError(file_name + ': camera: target deve ser diferente de eye e up nao pode ser nulo nem paralelo a direcao da camera')
+    camera = make_camera(eye, target, up, focal_dist, aperture)
+
+    image_table = scene_table(scene.get('image', {}), file_name + ': image', 'image')
+    size = []
+    for key in ('width', 'height'):
+        value = image_table.get(key)
+        if value is not None and (isinstance(value, bool) or not isinstance(value, int) or value < 1):
+            raise ValueError(file_name + ': image.' + key + ': esperava um inteiro positivo')
+        size.append(value)
+
+    materials = {}
+    for name, value in scene_table(scene['materials'], file_name + ': materials').items():
+        materials[name] = scene_material(value, file_name + ': materials.' + name)
+    def material_of(value, where):
+        if value not in materials:
+            raise ValueError(where + '.material: material desconhecido ' + str(value))
+        return materials[value]
+
+    point_lights = []
+    for k, value in enumerate(scene_list(scene.get('lights', []), file_name + ': lights')):
+        where = file_name + ': lights[' + str(k) + ']'
+        scene_table(value, where, 'light')
+        point_lights.append(PointLight(scene_vec3(value['position'], where + '.position'), scene_vec3(value['color'], where + '.color')))
+
+    shapes = []
+    for k, value in enumerate(scene_list(scene.get('spheres', []), file_name + ': spheres')):
+        where = file_name + ': spheres[' + str(k) + ']'
+        scene_table(value, where, 'sphere')
+        speed = scene_vec3(value['speed'], where + '.speed') if 'speed' in value else Vec3()
+        shapes.append(Sphere(scene_vec3(value['center'], where + '.center'), scene_number(value['radius'], where + '.radius', positive=True),
+            material_of(value['material'], where), speed_vec=speed))
+
+    # (path, position, scale, rotation, material, speed) of every mesh, read after the whole file checked out
+    placements = []
+    for k, value in enumerate(scene_list(scene.get('meshes', []), file_name + ': meshes')):
+        where = file_name + ': meshes[' + str(k) + ']'
+        scene_table(value, where, 'mesh')
+        if not isinstance(value['file'], str):
+            raise ValueError(where + '.file: esperava o caminho de um arquivo .obj')
+        path = os.path.normpath(os.path.join(base_dir, value['file']))
+        if not os.path.isfile(path):
+            raise ValueError(where + '.file: arquivo nao encontrado ' + path)
+        position = scene_vec3(value['position'], where + '.position') if 'position' in value else Vec3()
+        scale = scene_number(value['scale'], where + '.scale', positive=True) if 'scale' in value else 1.0
+        rotation = scene_vec3(value['rotation'], where + '.rotation') if 'rotation' in value else Vec3()
+        speed = scene_vec3(value['speed'], where + '.speed') if 'speed' in value else Vec3()
+        placements.append((path, position, scale, rotation, material_of(value['material'], where), speed))
+
+    for path, position, scale, rotation, material, speed in placements:
+        if path not in geometries:
+            geometries[path] = Mesh(path, Vec3(), 1, material)
+        shapes.append(MeshInstance(geometries[path], material, position, scale, rotation, speed_vec=speed))
+    return (camera, shapes, point_lights) + tuple(size)
+
+#######################################
+### MAIN
+#######################################
+
+def main():
+    # pegar arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument('output_file', type=str, nargs='?', help='arquivo de saida (nao usado com -farm-worker)')
+    parser.add_argument('-scene', type=str, help='arquivo de cena .json ou .toml (padrao: esferas aleatorias)')
+    parser.add_argument('-width', type=int, help='largura do arquivo de saida')
+    parser.add_argument('-height', type=int, help='altura do arquivo de saida')
+    parser.add_argument('-engine', choices=['python', 'numpy'], default='python', help='motor de intersecao: python puro ou vetorizado com numpy')
+    parser.add_argument('-workers', type=int, default=CPUS, help='numero de processos de renderizacao')
+    parser.add_argument('-tile', type=int, default=TILE_SIZE, help='lado dos tiles distribuidos entre os processos, em pixels')
+    parser.add_argument('-format', choices=sorted(IMAGE_WRITERS), help='formato de saida (padrao: png para .png, senao p6)')
+    parser.add_argument('-depth', type=int, default=MAX_DEPTH, help='profundidade maxima dos raios refletidos e refratados')
+    parser.add_argument('-min-samples', type=int, default=DISTRIBUTED_RAYS, help='numero minimo de raios por pixel')
+    parser.add_argument('-max-samples', type=int, help='numero maximo de raios por pixel; se maior que o minimo, a amostragem e adaptativa')
+    parser.add_argument('-threshold', type=float, default=VARIANCE_THRESHOLD, help='variancia da media de cor (por canal) abaixo da qual um pixel para de ser amostrado')
+    parser.add_argument('-sampler', choices=SAMPLERS, default='random', help='sequencia das amostras: aleatoria ou de baixa discrepancia (halton, sobol, sobol com ruido azul)')
+    parser.add_argument('-light-samples', type=int, help='raios de sombra por acerto, para luzes sorteadas pela potencia (padrao: um para cada luz)')
+    parser.add_argument('-packet', type=int, default=0, help='lado em pixels dos blocos cujos raios primarios sao tracados juntos, contra so as formas no cone do bloco (padrao: 0, raio a raio)')
+    parser.add_argument('-seed', type=int, help='semente da cena e do ruido (padrao: o relogio)')
+    parser.add_argument('-progressive', action='store_true', help='renderiza em passadas acumuladas, gravando a imagem e um checkpoint a cada passada')
+    parser.add_argument('-passes', type=int, help='numero total de passadas no modo progressivo')
+    parser.add_argument('-budget', type=float, help='tempo maximo em segundos no modo progressivo')
+    parser.add_argument('-checkpoint', type=str, help='arquivo de checkpoint do modo progressivo (padrao: <arquivo de saida>.checkpoint)')
+    parser.add_argument('-incremental', action='store_true', help='guarda as formas e os raios de cada pixel e, quando so formas da cena mudaram desde a ultima vez, retraca apenas os pixels que elas podem alterar')
+    parser.add_argument('-records', type=str, help='arquivo de registros do modo incremental (padrao: <arquivo de saida>.records)')
+    parser.add_argument('-denoise', action='store_true', help='grava tambem albedo, normal e profundidade do primeiro acerto e filtra a imagem com eles no fim (precisa do numpy); para renderizar com poucos raios por pixel')
+    parser.add_argument('-occlusion-cache', action='store_true', help='guarda quanto cada luz e bloqueada em cada celula de pontos de acerto e normais, num cache compartilhado entre os processos, e reusa nos raios e pixels vizinhos')
+    parser.add_argument('-cache-spacing', type=float, help='lado das celulas do cache de oclusao, o erro maximo de posicao (padrao: ' + str(OCCLUSION_CACHE_SPACING) + ')')
+    parser.add_argument('-cache-samples', type=int, help='raios de sombra tracados e somados em cada celula antes do cache responder por ela (padrao: ' + str(OCCLUSION_CACHE_SAMPLES) + ')')
+    parser.add_argument('-cache-memory', type=int, help='memoria do cache de oclusao em MB; cheio, perde as entradas usadas ha mais tempo (padrao: ' + str(OCCLUSION_CACHE_MEMORY) + ')')
+    parser.add_argument('-farm', type=str, help='coordena uma render farm: escuta em host:port e distribui os tiles para os workers que se conectarem, em vez dos processos locais')
+    parser.add_argument('-farm-local', type=int, default=0, help='com -farm, workers iniciados pelo proprio coordenador, pelo loopback')
+    parser.add_argument('-farm-worker', type=str, help='roda como worker da render farm coordenada em host:port e sai quando ela termina; as outras opcoes vem do coordenador')
+    parser.add_argument('-farm-cache', type=str, help='pasta onde os workers guardam as cenas recebidas, pelo hash do conteudo (padrao: ' + FARM_CACHE_DIR + ')')
+    parser.add_argument('-stats', action='store_true', help='conta raios, testes de intersecao e acertos e imprime um resumo em uma linha')
+    parser.add_argument('-stats-json', type=str, help='grava as estatisticas completas (implica -stats) nesse arquivo JSON')
+
+    args = parser.parse_args()
+    for address in (args.farm, args.farm_worker):
+        if address:
+            try:
+                parse_address(address)
+            except ValueError:
+                parser.error('endereco invalido, o formato e host:port: ' + address)
+    if args.farm_worker:
+        # the scene, the camera and the options come from the coordinator
+        try:
+            farm_worker(args.farm_worker, args.farm_cache or FARM_CACHE_DIR)
+        except OSError as error:
+            print('Conexao com o coordenador perdida: ' + str(error))
+            return 1
+        return 0
+    if args.output_file is None:
+        parser.error('o arquivo de saida e obrigatorio, exceto com -farm-worker')
+    if args.engine == 'numpy' and np is None:
+        parser.error('o motor numpy precisa da biblioteca numpy instalada')
+    if args.workers < 1 or args.tile < 1:
+        parser.error('-workers e -tile devem ser positivos')
+    if args.depth < 0:
+        parser.error('-depth nao pode ser negativo')
+    if args.light_samples is not None and args.light_samples < 1:
+        parser.error('-light-samples deve ser positivo')
+    if args.packet < 0:
+        parser.error('-packet nao pode ser negativo')
+    if args.max_samples is None:
+        args.max_samples = args.min_samples
+    if args.min_samples < 1 or args.max_samples < args.min_samples:
+        parser.error('-min-samples deve ser positivo e nao maior que -max-samples')
+    if args.seed is not None and not 0 <= args.seed < 2 ** 64:
+        parser.error('-seed deve estar entre 0 e 2^64 - 1')
+    if (args.passes is not None or args.budget is not None or args.checkpoint) and not args.progressive:
+        parser.error('-passes, -budget e -checkpoint so valem com -progressive')
+    if args.incremental and (not args.scene or args.progressive):
+        parser.error('-incremental precisa de -scene e nao vale com -progressive')
+    if args.records and not args.incremental:
+        parser.error('-records so vale com -incremental')
+    cache_settings = (args.cache_spacing, args.cache_samples, args.cache_memory)
+    if any(value is not None for value in cache_settings) and not args.occlusion_cache:
+        parser.error('-cache-spacing, -cache-samples e -cache-memory so valem com -occlusion-cache')
+    if any(value is not None and value <= 0 for value in cache_settings):
+        parser.error('-cache-spacing, -cache-samples e -cache-memory devem ser positivos')
+    if args.occlusion_cache and args.incremental:
+        parser.error('-occlusion-cache nao vale com -incremental')
+    if args.denoise and np is None:
+        parser.error('-denoise precisa da biblioteca numpy instalada')
+    if args.denoise and (args.progressive or args.incremental):
+        parser.error('-denoise nao vale com -progressive nem com -incremental')
+    if args.farm and (args.progressive or args.incremental or args.denoise or args.occlusion_cache):
+        parser.error('-farm nao vale com -progressive, -incremental, -denoise nem -occlusion-cache')
+    if args.farm_local and not args.farm or args.farm_local < 0:
+        parser.error('-farm-local so vale com -farm e nao pode ser negativo')
+    ouf = args.output_file
+    width = 480
+    height = 340
+    scene = None
+    load_start = time.time()
+    if args.scene:
+        # the size in the file is the default for -width and -height
+        try:
+            scene = load_scene(args.scene)
+        except (OSError, ValueError) as e:
+            parser.error(str(e))
+        width = scene[3] or width
+        height = scene[4] or height
+    if args.width:
+        width = args.width
+    if args.height:
+        height = args.height
+
+    # the options the image depends on: the records of a previous incremental render and the checkpoint of
+    # a progressive one are only reused with the same ones
+    settings = {'width': width, 'height': height, 'depth': args.depth, 'min_samples': args.min_samples,
+        'max_samples': args.max_samples, 'threshold': args.threshold, 'sampler': args.sampler,
+        'light_samples': args.light_samples}
+
+    # an interrupted progressive render resumes from its checkpoint, with the same scene and options
+    seed = args.seed if args.seed is not None else int(time.time() * 1000)
+    checkpoint = None
+    checkpoint_file = None
+    progressive_settings = None
+    if args.progressive:
+        checkpoint_file = args.checkpoint or ouf + '.checkpoint'
+        progressive_settings = dict(settings, engine=args.engine, scene=scene_signatures(args.scene) if args.scene else None)
+        if os.path.exists(checkpoint_file):
+            try:
+                checkpoint = load_checkpoint(checkpoint_file)
+            except (OSError, ValueError) as e:
+                parser.error(str(e))
+            changed = checkpoint_mismatch(checkpoint[6], progressive_settings)
+            if changed:
+                parser.error(checkpoint_file + ' e de outra renderizacao (mudou: ' + changed + '), apague-o para recomecar')
+            seed = checkpoint[3]
+    random.seed(seed)
+    args.stats = args.stats or bool(args.stats_json)
+
+    if scene:
+        camera, shapes, point_lights = scene[:3]
+        print('Cena: ' + args.scene)
+    else:
+        camera = default_camera()
+        shapes, point_lights = random_scene(width, height)
+    add_phase('scene_load', time.time() - load_start)
+    # instances share the BVH of their mesh, it is only built once
+    add_phase('acceleration_build', sum({id(shape.bvh): shape.bvh.build_time for shape in shapes if isinstance(shape, Mesh)}.values()))
     print('Imagem sendo renderizada: ' + str(len(shapes)) + ' formas.')
-    print('Usando ' + str(CPUS) + ' threads e ' + str(DISTRIBUTED_RAYS) + ' raios distribuidos para cada pixel.')
+    if args.max_samples > args.min_samples:
+        samples = 'de ' + str(args.min_samples) + ' a ' + str(args.max_samples) + ' raios distribuidos para cada pixel (variancia ' + str(args.threshold) + ').'
+    else:
+        samples = str(args.min_samples) + ' raios distribuidos para cada pixel.'
+    print('Usando ' + str(args.workers) + ' processos, tiles de ' + str(args.tile) + ' pixels e ' + samples)
+    print('Motor de intersecao: ' + args.engine)
+    print('Semente: ' + str(seed))
+    # seeds the tiles of every render or pass
+    rng = random.Random(random.getrandbits(64))
+
+    # an incremental render reuses the previous image and traces again only the pixels the edited shapes can
+    # change, if the rest of the scene and the options are the same
+    records_file = None
+    previous = None
+    traced = None
+    if args.incremental:
+        records_file = args.records or ouf + '.records'
+        header = {'settings': settings, 'scene': scene_signatures(args.scene)}
+        if os.path.exists(records_file):
+            try:
+                previous = load_records(records_file)
+            except (OSError, ValueError) as e:
+                parser.error(str(e))
+            reason = incremental_mismatch(previous[0], header)
+            if reason:
+                print('Renderizando a imagem inteira: ' + reason + ' desde ' + records_file)
+                previous = None
+            else:
+                changed = [k for k, (old, new) in enumerate(zip(previous[0]['scene']['shapes'], header['scene']['shapes'])) if old != new]
+                traced = changed_pixels(previous[2], changed, [shapes[k].swept_bounds() for k in changed])
+                print(str(len(changed)) + ' formas alteradas desde ' + records_file + ', ' + str(len(traced)) + ' de ' \
+                    + str(width * height) + ' pixels serao retracados')
     
     # render image
     start_time = time.time()
-    array = multiprocessing.Array('i', height * width * 3, lock=False)
-
-    processes = [None] * CPUS
-    for i in range(0, height, CPUS):
-        for k in range(CPUS):
-            if i + k < height:
-                processes[k] = multiprocessing.Process(target=trace_rays_in_row, \
-                    args=(shapes, point_lights, i + k, width, height, camera_eye, \
-                    camera_up, camera_right, camera_front, focal_dist, aperture, array))
-                processes[k].start()
-                print('renderizando linha: ' + str(i+k))
-        
-        for p in processes:
-            p.join()
-
-    '''
-    for i in range(height):
-        for j in range(width):
-            trace_rays(shapes, point_lights, i, j, width, height, \
-                        camera_eye, camera_up, camera_right, camera_front, focal_dist, pixel_array[i][j])
-    '''
+    # the denoiser filters the float means of the pixels, not the clamped bytes
+    framebuffer = Framebuffer(width, height, accumulate=args.progressive or args.denoise, aux=args.denoise)
+    if checkpoint:
+        framebuffer.passes = checkpoint[2]
+        rng.setstate(checkpoint[4])
+        memoryview(framebuffer.pixels).cast('B')[:] = checkpoint[5]
+        print('Retomando de ' + checkpoint_file + ' com ' + str(framebuffer.passes) + ' passadas')
+    if previous:
+        memoryview(framebuffer.pixels).cast('B')[:] = previous[1]
+    share_start = time.time()
+    shared_scene = SharedScene(shapes, point_lights)
+    add_phase('scene_share', time.time() - share_start)
+    print('Cena compartilhada entre os processos: ' + str(shared_scene.size) + ' bytes')
+    options = RenderOptions(max_depth=args.depth, min_samples=args.min_samples, max_samples=args.max_samples,
+        variance_threshold=args.threshold, stats=args.stats, sampler=args.sampler, record=args.incremental,
+        denoise=args.denoise, light_samples=args.light_samples, packet=args.packet)
+    occlusion_cache = None
+    if args.occlusion_cache:
+        occlusion_cache = OcclusionCache(args.cache_spacing or OCCLUSION_CACHE_SPACING, args.cache_samples or OCCLUSION_CACHE_SAMPLES,
+            args.cache_memory or OCCLUSION_CACHE_MEMORY)
+    render_start = time.time()
+    worker_ids = None
+    if args.progressive:
+        try:
+            reports = render_progressive(args.engine, shared_scene, camera, framebuffer, options, args.workers, args.tile, rng, seed,
+                ouf, args.format, checkpoint_file, args.passes, args.budget, occlusion_cache, progressive_settings)
+        finally:
+            shared_scene.unlink()
+    else:
+        # the rows of a denoised image are only final after the filter, and the tiles of a farm come back in
+        # any order, so nothing is streamed then
+        writer = None if args.denoise or args.farm else open_image_writer(ouf, width, height, args.format)
+        records = [] if args.incremental else None
+        try:
+            if args.farm:
+                try:
+                    farm_reports = render_farm(args.engine, shared_scene, camera, framebuffer, options, args.farm, args.tile,
+                        rng.getrandbits(64), local_workers=args.farm_local, cache_dir=args.farm_cache or FARM_CACHE_DIR)
+                except TimeoutError as error:
+                    print('Render farm abandonada: ' + str(error))
+                    return 1
+                # the workers of a farm keep the ids of the coordinator, even when some of them were lost
+                worker_ids = list(farm_reports)
+                reports = list(farm_reports.values())
+            else:
+                reports = render_tiles(args.engine, shared_scene, camera, framebuffer, options, args.workers, args.tile, writer, rng.getrandbits(64),
+                    pixels=traced, records=records, occlusion_cache=occlusion_cache)
+        finally:
+            shared_scene.unlink()
+            if writer:
+                writer.close()
+        if args.denoise:
+            denoise_start = time.time()
+            denoised = denoise_framebuffer(framebuffer)
+            add_phase('denoise', time.time() - denoise_start)
+            print('Imagem filtrada em ' + str(PHASES['denoise']) + ' segundos')
+            output_start = time.time()
+            write_image(ouf, denoised, args.format)
+            add_phase('output', time.time() - output_start)
+        if args.farm:
+            output_start = time.time()
+            write_image(ouf, framebuffer, args.format)
+            add_phase('output', time.time() - output_start)
+        if args.incremental:
+            records_start = time.time()
+            save_records(records_file, header, framebuffer, merge_records(records, previous and previous[2], traced or ()))
+            add_phase('records', time.time() - records_start)
+            print('Registros do modo incremental salvos em ' + records_file)
+
+    # the output written while rendering is accounted apart from the tracing
+    add_phase('tracing', time.time() - render_start - PHASES.get('output', 0) - PHASES.get('records', 0) - PHASES.get('denoise', 0))
     end_time = time.time() - start_time
     print('Imagem renderizada em ' + str(end_time) + ' segundos')
-
-    # output img
-    with open(ouf, 'w') as f:
-        f.write('P3\n' + str(width) + ' ' + str(height) + '\n255\n')
-        for byte in array:
-            f.write(str(byte) + ' ')
+    for worker_id, (tile_count, busy_time, lifetime, *tables) in zip(worker_ids or range(len(reports)), reports):
+        print('worker ' + str(worker_id) + ': ' + str(tile_count) + ' tiles, ' + str(round(100 * busy_time / lifetime, 1)) + '% do tempo ocupado')
+    report = stats_report(width, height, end_time, reports)
+    if occlusion_cache:
+        report['occlusion_cache'].update(entries=occlusion_cache.entries(), capacity=occlusion_cache.capacity)
+        print(cache_summary(report))
+    histogram = report['sample_histogram']
+    primary_rays = report['primary_rays']
+    print('Raios primarios por segundo: ' + str(int(primary_rays / end_time)))
+    print('Raios primarios: ' + str(primary_rays) + ' (' + str(round(primary_rays / (width * height), 2)) + ' por pixel, ' \
+        + str(width * height * args.max_samples * max(framebuffer.passes, 1)) + ' com o maximo fixo)')
+    for count in sorted(histogram):
+        print('  ' + str(count).rjust(4) + ' raios: ' + str(histogram[count]).rjust(7) + ' pixels')
+    if args.stats:
+        print(stats_summary(report))
+    if args.stats_json:
+        with open(args.stats_json, 'w') as f:
+            json.dump(report, f, indent=2)
 
     return 0
 